@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark suite measuring the throughput of imgwrench subcommands."""
+
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from functools import partial
+from math import sqrt
+
+import click
+import numpy as np
+import PIL
+from PIL import Image
+
+from . import __version__
+from .cli import cli_imgwrench
+from .commands.collage import _binary_tree_recursive, bric_tree, render
+from .commands.filmstrip import filmstrip
+from .commands.grid import grid
+from .commands.quad import quad
+from .commands.stack import stack
+from .lazy import LazyImage
+
+SIZES = [1, 12, 24, 50]
+
+# numbers of images of collage layouts to benchmark
+LAYOUT_COUNTS = [10, 100, 500, 2000]
+
+# aspect ratios of images of collage layouts
+LAYOUT_SIZES = [(3, 2), (2, 3), (1, 1), (16, 9), (4, 5)]
+
+# number of times a layout is scored per run
+LAYOUT_SCORES = 100
+
+# arguments of every subcommand to benchmark
+COMMANDS = [
+    ["blackwhite"],
+    ["collage"],
+    ["colorfix"],
+    ["crop"],
+    ["dither"],
+    ["filmstrip"],
+    ["flip"],
+    ["frame"],
+    ["framecrop"],
+    ["grid", "-r", "2", "-n", "2"],
+    ["quad"],
+    ["resize"],
+    ["save"],
+    ["stack"],
+]
+
+# composite subcommands benchmarked in memory, given their input images and
+# whether to resample exactly, with the number of their input images
+COMPOSITES = {
+    "collage": (
+        lambda images, exact: render(
+            bric_tree(images, 1.5), 3072, 2048, 0.01, "white", exact
+        ),
+        12,
+    ),
+    "filmstrip": (
+        lambda images, exact: filmstrip(2048, 0.025, "white", images, exact),
+        4,
+    ),
+    "grid": (
+        lambda images, exact: grid(
+            images, 4, 3, 3072, 2048, 0.01, False, "white", exact
+        ),
+        12,
+    ),
+    "quad": (
+        lambda images, exact: quad(images, 3072, 2048, 0.0, False, "white", exact),
+        4,
+    ),
+    "stack": (lambda images, exact: stack(*images, 2048, 3072, exact), 2),
+}
+
+ORIENTATION = 0x0112
+
+
+def synthetic_image(megapixels):
+    """Deterministic RGB test image of about the given number of megapixels
+    with an aspect ratio of 3:2, combining gradients and noise."""
+    width = round(sqrt(megapixels * 1e6 * 3 / 2))
+    height = round(width * 2 / 3)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 48).convert("L")
+    mirrored = gradient.transpose(Image.FLIP_LEFT_RIGHT)
+    return Image.merge("RGB", (gradient, noise, mirrored))
+
+
+def write_image(path, megapixels, rotated):
+    """Save a synthetic image as JPEG, rotated by EXIF orientation if rotated"""
+    exif = Image.Exif()
+    if rotated:
+        exif[ORIENTATION] = 6
+    synthetic_image(megapixels).save(path, quality=90, exif=exif.tobytes())
+
+
+def case_name(command, megapixels, rotated):
+    """Name of a benchmark case, e.g. 'resize @ 12MP rotated'"""
+    name = "{} @ {}MP".format(" ".join(command), megapixels)
+    return name + " rotated" if rotated else name
+
+
+def run_case(image_path, command, batch, repeat, workdir):
+    """Process batch copies of an image with a subcommand repeat times,
+    returning the wall times of all repetitions. Every copy is decoded,
+    caching of repeated images is turned off."""
+    image_list = os.path.join(workdir, "images.txt")
+    with open(image_list, "w") as f:
+        f.write(image_path + "\n")
+    args = ["-i", image_list, "-r", str(batch), "-C", "0", "-o", workdir, "-f"]
+    args += command
+    timings = []
+    for _ in range(repeat):
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            cli_imgwrench.main(args=args, prog_name="imgwrench", standalone_mode=False)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run(sizes, commands, batch, repeat, workdir):
+    """Run all benchmark cases, returning the results by case name."""
+    results = {}
+    for megapixels in sizes:
+        for rotated in [False, True]:
+            image_path = os.path.join(workdir, "bench.jpg")
+            write_image(image_path, megapixels, rotated)
+            for command in commands:
+                name = case_name(command, megapixels, rotated)
+                click.echo("Running {}...".format(name), err=True)
+                timings = run_case(image_path, command, batch, repeat, workdir)
+                median = statistics.median(timings)
+                results[name] = {
+                    "median_seconds": median,
+                    "min_seconds": min(timings),
+                    "megapixels_per_second": batch * megapixels / median,
+                }
+    return results
+
+
+def layout_images(n):
+    """Deterministic stand-ins for n images of common aspect ratios,
+    of which collage layouts only need the sizes."""
+    rnd = random.Random(n)
+    return [LazyImage(rnd.choice(LAYOUT_SIZES), None) for _ in range(n)]
+
+
+def dense_widths(tree):
+    """Widths of the leaf nodes of a collage layout solving the dense
+    system of linear equations of the BRIC algorithm, for comparison."""
+    a, b = tree.linear_equations
+    solution = np.linalg.solve(a, b)
+    return {leaf: solution[i] for leaf, i in tree.leafs_index.items()}
+
+
+def _timings(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _score(tree):
+    for _ in range(LAYOUT_SCORES):
+        tree.score(3000, 2000)
+
+
+def run_layouts(counts, repeat):
+    """Time solving collage layouts of the given numbers of images with
+    the dense and the linear BRIC solver as well as scoring them,
+    returning the results by case name."""
+    results = {}
+    for n in counts:
+        tree = _binary_tree_recursive(layout_images(n), random.Random(0), True)
+        for solver, solve in [
+            ("dense", dense_widths),
+            ("linear", type(tree).bric_widths),
+        ]:
+            name = "bric {} @ {} images".format(solver, n)
+            click.echo("Running {}...".format(name), err=True)
+            timings = _timings(partial(solve, tree), repeat)
+            median = statistics.median(timings)
+            results[name] = {
+                "median_seconds": median,
+                "min_seconds": min(timings),
+                "images_per_second": n / median,
+            }
+        name = "score @ {} images".format(n)
+        click.echo("Running {}...".format(name), err=True)
+        timings = _timings(partial(_score, tree), repeat)
+        median = statistics.median(timings)
+        results[name] = {
+            "median_seconds": median,
+            "min_seconds": min(timings),
+            "scores_per_second": LAYOUT_SCORES / median,
+        }
+    return results
+
+
+def run_composites(sizes, commands, repeat):
+    """Time resampling and pasting images of the given sizes by composite
+    subcommands in memory, exactly (cropping and resampling one after
+    another) and by a single call of `imgwrench.geometry.resample`,
+    returning the results by case name."""
+    results = {}
+    for megapixels in sizes:
+        image = synthetic_image(megapixels)
+        # landscape and portrait images, the latter are rotated by grid and quad
+        images = [image, image.transpose(Image.ROTATE_90)] * 6
+        for command in commands:
+            composite, n_images = COMPOSITES[command]
+            for exact in [True, False]:
+                name = "{} @ {}MP{}".format(command, megapixels, " exact" * exact)
+                click.echo("Running {}...".format(name), err=True)
+                func = partial(composite, images[:n_images], exact)
+                timings = _timings(func, repeat)
+                median = statistics.median(timings)
+                results[name] = {
+                    "median_seconds": median,
+                    "min_seconds": min(timings),
+                    "megapixels_per_second": n_images * megapixels / median,
+                }
+    return results
+
+
+def speedups(results):
+    """Names of composite cases with their speedup compared to resampling
+    exactly (see `run_composites`)."""
+    return [
+        (name, results[name + " exact"]["median_seconds"] / result["median_seconds"])
+        for name, result in results.items()
+        if name + " exact" in results
+    ]
+
+
+def compare(results, baseline, tolerance):
+    """Names of cases whose median time exceeds the baseline by more
+    than the tolerance (e.g. 0.1 for 10%) with their time ratio."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = result["median_seconds"] / base["median_seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+
+@click.command(name="imgwrench-bench")
+@click.option(
+    "-s",
+    "--sizes",
+    type=click.STRING,
+    default=",".join(str(size) for size in SIZES),
+    show_default=True,
+    help="comma-separated sizes of synthetic images in megapixels",
+)
+@click.option(
+    "-k",
+    "--command",
+    "selected",
+    type=click.STRING,
+    multiple=True,
+    help="only benchmark the given subcommand (may be repeated)",
+)
+@click.option(
+    "-l",
+    "--layouts",
+    type=click.STRING,
+    default=None,
+    help="benchmark collage layout solvers for comma-separated numbers of "
+    + "images (e.g. {}) instead of subcommands".format(
+        ",".join(str(n) for n in LAYOUT_COUNTS)
+    ),
+)
+@click.option(
+    "-m",
+    "--composites",
+    is_flag=True,
+    help="benchmark resampling in memory instead of subcommands, comparing "
+    + "exact resampling, for composite subcommands ({})".format(", ".join(COMPOSITES)),
+)
+@click.option(
+    "-b",
+    "--batch",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="number of images processed per run",
+)
+@click.option(
+    "-n",
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="number of runs per benchmark case",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    default=None,
+    help="write results as JSON baseline to the given file",
+)
+@click.option(
+    "-c",
+    "--compare",
+    "baseline_path",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    default=None,
+    help="compare results against a JSON baseline and fail on regressions",
+)
+@click.option(
+    "-t",
+    "--tolerance",
+    type=click.FLOAT,
+    default=0.1,
+    show_default=True,
+    help="relative slowdown compared to the baseline flagged as regression",
+)
+def cli_bench(
+    sizes,
+    selected,
+    layouts,
+    composites,
+    batch,
+    repeat,
+    output,
+    baseline_path,
+    tolerance,
+):
+    """Benchmark all imgwrench subcommands on synthetic images."""
+    sizes = [float(s) if "." in s else int(s) for s in sizes.split(",")]
+    if layouts:
+        counts = [int(n) for n in layouts.split(",")]
+        results = run_layouts(counts, repeat)
+    elif composites:
+        commands = [c for c in COMPOSITES if not selected or c in selected]
+        results = run_composites(sizes, commands, repeat)
+    else:
+        commands = [c for c in COMMANDS if not selected or c[0] in selected]
+        with tempfile.TemporaryDirectory() as workdir:
+            results = run(sizes, commands, batch, repeat, workdir)
+    for name, result in results.items():
+        if "megapixels_per_second" in result:
+            throughput = "{:8.2f} MP/s".format(result["megapixels_per_second"])
+        elif "scores_per_second" in result:
+            throughput = "{:8.0f} scores/s".format(result["scores_per_second"])
+        else:
+            throughput = "{:8.0f} images/s".format(result["images_per_second"])
+        click.echo(
+            "{:40} {:8.3f}s {}".format(name, result["median_seconds"], throughput)
+        )
+    for name, speedup in speedups(results):
+        click.echo(
+            "Speedup: {} is {:.2f} times faster than exact".format(name, speedup)
+        )
+    if output:
+        report = {
+            "imgwrench": __version__,
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "machine": platform.machine(),
+            "results": results,
+        }
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, tolerance)
+        for name, ratio in regressions:
+            click.echo("Regression: {} is {:.0%} slower".format(name, ratio - 1))
+        if regressions:
+            sys.exit(1)
+        click.echo("No regressions compared to {}".format(baseline_path))
+
+
+if __name__ == "__main__":
+    sys.exit(cli_bench())
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""Cache of decoded images for repeated and duplicate input images."""
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def image_bytes(image):
+    """Approximate memory required by the pixel data of an image."""
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+
+def file_key(path):
+    """Key of an image file, changing whenever the file changes."""
+    stat = os.stat(path)
+    return str(path), stat.st_mtime_ns, stat.st_size
+
+
+class DecodeCache:
+    """Thread-safe least recently used cache of decoded images, bounded
+    by the number of images and their total size in bytes.
+
+    Concurrent requests for an image being decoded wait for the decoding
+    thread instead of decoding the image again. Cached images are shared
+    between all requests, so they must not be modified in place."""
+
+    def __init__(self, max_bytes, max_count=64, size=image_bytes):
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self._size = size
+        self._lock = threading.Lock()
+        # futures of cached values in least recently used order
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """Cached value for key, calling load() if it is not cached yet"""
+        loading = False
+        with self._lock:
+            future = self._entries.get(key)
+            if future is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                future = self._entries[key] = Future()
+                self.misses += 1
+                loading = True
+        if not loading:
+            return future.result()
+        try:
+            value = load()
+        except BaseException as e:
+            with self._lock:
+                del self._entries[key]
+            future.set_exception(e)
+            raise
+        future.set_result(value)
+        with self._lock:
+            self._sizes[key] = self._size(value)
+            self._bytes += self._sizes[key]
+            self._evict()
+        return value
+
+    def _evict(self):
+        """Evict least recently used decoded values exceeding the bounds"""
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_count and self._bytes <= self.max_bytes:
+                break
+            if key in self._sizes:
+                del self._entries[key]
+                self._bytes -= self._sizes.pop(key)
@@ -3,16 +3,37 @@
 """Command Line Interface for Image Wrench."""
 
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from math import ceil
 from pathlib import Path
 
 import click
 from PIL import Image
 
+from . import __version__
+from .cache import DecodeCache, file_key, image_bytes
+from .fusion import fuse
+from .geometry import defer_transpose, defers_transpose, fuse_geometric
+from .incremental import load_manifest, plan, save_manifest, stale_runs
 from .info import ImageInfo
+from .lazy import LazyImage
+from .profiling import Profile
+from .strips import PNG_COLOR_TYPES, StripImage, fuse_strips, is_local, save_png
+from .stages import (
+    can_fork,
+    connect,
+    input_scale,
+    planned_size,
+    read_ahead,
+    worker_pool,
+)
 from .commands.blackwhite import cli_blackwhite
 from .commands.collage import cli_collage
 from .commands.colorfix import cli_colorfix
-from .commands.crop import cli_crop
+from .commands.crop import cli_crop, fill_scale
 from .commands.dither import cli_dither
 from .commands.filmstrip import cli_filmstrip
 from .commands.flip import cli_flip
@@ -32,26 +53,27 @@ def _xmp_from_image(img, xmp_marker=b"http://ns.adobe.com/xap/1.0/"):
                 return val
 
 
-def _write_xmp_to_image(path, xmp):
-    with open(path, "rb") as f:
-        raw_data = f.read()
-    app1_start = raw_data.rfind(b"\xFF\xE1")
-    if app1_start > 0:
-        app1_raw_len = raw_data[app1_start + 2 : app1_start + 4]
-        app1_len = int.from_bytes(app1_raw_len, "big")
-        app1_end = app1_start + 2 + app1_len
-        with open(path, "wb") as f:
-            f.write(raw_data[:app1_end])
-            f.write(b"\xFF\xE1")
-            f.write((len(xmp) + 2).to_bytes(2, "big"))
-            f.write(xmp)
-            f.write(raw_data[app1_end:])
-
-
-def _load_image(fname, i, preserve_exif):
-    """Load an image from file system and rotate according to exif"""
-    img = Image.open(fname)
-    info = ImageInfo(fname, i, img.info.get("exif"), _xmp_from_image(img))
+def _insert_xmp(data, xmp):
+    """Insert an XMP APP1 segment after the last APP1 segment of JPEG data"""
+    app1_start = data.rfind(b"\xFF\xE1")
+    if app1_start <= 0:
+        return data
+    app1_raw_len = data[app1_start + 2 : app1_start + 4]
+    app1_len = int.from_bytes(app1_raw_len, "big")
+    app1_end = app1_start + 2 + app1_len
+    return b"".join(
+        [
+            data[:app1_end],
+            b"\xFF\xE1",
+            (len(xmp) + 2).to_bytes(2, "big"),
+            xmp,
+            data[app1_end:],
+        ]
+    )
+
+
+def _exif_rotation(img, preserve_exif):
+    """Transpose method required to rotate an image according to exif"""
     # do not rotate image if exif is preserved
     # (otherwise it would be rotated twice)
     if not preserve_exif and hasattr(img, "_getexif"):
@@ -60,13 +82,139 @@ def _load_image(fname, i, preserve_exif):
         if exif is not None and orientation in exif:
             orientation = exif[orientation]
             rotations = {3: Image.ROTATE_180, 6: Image.ROTATE_270, 8: Image.ROTATE_90}
-            if orientation in rotations:
-                img = img.transpose(rotations[orientation])
+            return rotations.get(orientation)
+
+
+def _rotated_size(size, rotation):
+    if rotation in (Image.ROTATE_90, Image.ROTATE_270):
+        return size[1], size[0]
+    return size
+
+
+def _load_image(
+    fname,
+    i,
+    preserve_exif,
+    input_scale=None,
+    defer_rotation=False,
+    output_size=None,
+):
+    """Load an image from file system and rotate according to exif;
+    input_scale(size) may allow decoding JPEGs at reduced resolution,
+    unless output_size(size), the size of output images, would change;
+    if defer_rotation is set, the rotation is left to the geometric
+    operations at the start of the pipeline (see `imgwrench.geometry`)"""
+    img = Image.open(fname)
+    info = ImageInfo(fname, i, img.info.get("exif"), _xmp_from_image(img))
+    rotation = _exif_rotation(img, preserve_exif)
+    if input_scale is not None:
+        size = _rotated_size(img.size, rotation)
+        scale = input_scale(size)
+        if 0 < scale < 1:
+            # JPEG decoders pick the smallest DCT scaling (1/2, 1/4, 1/8)
+            # still covering the requested size; other formats ignore this
+            requested = [max(1, ceil(side * scale)) for side in img.size]
+            img.draft(img.mode, tuple(requested))
+            reduced = _rotated_size(img.size, rotation)
+            if output_size is not None and output_size(reduced) != output_size(size):
+                # sizes rounded at reduced resolution would differ
+                img.close()
+                img = Image.open(fname)
+    if rotation is not None and not defer_rotation:
+        img = img.transpose(rotation)
     if img.mode != "RGB":
-        return img.convert("RGB"), info
+        img = img.convert("RGB")
+    if rotation is not None and defer_rotation:
+        defer_transpose(img, rotation)
     return img, info
 
 
+def _load_lazy(fname, i, preserve_exif, draft=True):
+    """Read size and meta information of an image from file system,
+    but defer decoding to the returned LazyImage"""
+    with Image.open(fname) as img:
+        info = ImageInfo(fname, i, img.info.get("exif"), _xmp_from_image(img))
+        size = _rotated_size(img.size, _exif_rotation(img, preserve_exif))
+
+    def _load(target_size):
+        input_scale = None
+        if draft and target_size:
+            input_scale = partial(
+                fill_scale, width=target_size[0], height=target_size[1]
+            )
+        return _load_image(fname, i, preserve_exif, input_scale)[0]
+
+    return LazyImage(size, _load), info
+
+
+def _decode_image(
+    fname,
+    i,
+    preserve_exif,
+    input_scale=None,
+    defer_rotation=False,
+    output_size=None,
+):
+    """Load an image and decode its pixel data right away"""
+    img, info = _load_image(
+        fname, i, preserve_exif, input_scale, defer_rotation, output_size
+    )
+    img.load()
+    return img, info
+
+
+def _save_image(image, outpath, info, quality, preserve_exif, jpg):
+    """Save a processed image to outpath"""
+    args = dict(quality=quality)
+    if preserve_exif and info.exif:
+        args["exif"] = info.exif
+    if isinstance(image, StripImage):
+        if not jpg and image.mode in PNG_COLOR_TYPES:
+            return save_png(image, outpath, args.get("exif"))
+        # JPEG images can only be encoded from whole images
+        image = image.render()
+    if preserve_exif and jpg and info.xmp:
+        # splice XMP into the encoded image before writing it only once
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", **args)
+        with open(outpath, "wb") as f:
+            f.write(_insert_xmp(buffer.getvalue(), info.xmp))
+    else:
+        image.save(outpath, **args)
+    return outpath
+
+
+def _save_images(save, outputs, writers):
+    """Save outputs in writers background threads and yield their paths
+    in order; a write to a path waits for earlier writes to the same path."""
+    if writers < 1:
+        yield from (save(*output) for output in outputs)
+        return
+    with ThreadPoolExecutor(writers) as executor:
+        pending = deque()
+        for output in outputs:
+            outpath = output[1]
+            while len(pending) >= writers or any(p == outpath for p, _ in pending):
+                yield pending.popleft()[1].result()
+            pending.append((outpath, executor.submit(save, *output)))
+        while pending:
+            yield pending.popleft()[1].result()
+
+
+def _stage_names(image_processors):
+    """Unique names of image processors for reporting, e.g. resize, resize#2"""
+    names = {}
+    counts = {}
+    for image_processor in image_processors:
+        params = getattr(image_processor, "params", None)
+        name = params[0] if params else image_processor.__name__
+        counts[name] = counts.get(name, 0) + 1
+        if counts[name] > 1:
+            name = "{}#{}".format(name, counts[name])
+        names[image_processor] = name
+    return names
+
+
 def _repeat(it, n):
     """Repeat every element of it n times
 
@@ -167,6 +315,76 @@ def _repeat(it, n):
     show_default=True,
     help="save output images in JPEG format (otherwise PNG)",
 )
+@click.option(
+    "-J",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="number of worker processes for per-image processing",
+)
+@click.option(
+    "-P",
+    "--prefetch",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of images to load and decode ahead in background threads",
+)
+@click.option(
+    "-W",
+    "--writers",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of background threads for encoding and writing output images",
+)
+@click.option(
+    "-x",
+    "--exact",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="always decode images at full resolution and resample them without "
+    + "approximations (fused geometric operations, reduction of large images "
+    + "by composite commands) for output bit-identical to a step by step run",
+)
+@click.option(
+    "-I",
+    "--incremental",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="skip output images which are up-to-date with their input images "
+    + "and parameters according to a manifest in the output directory",
+)
+@click.option(
+    "-R",
+    "--profile-report",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    default=None,
+    help="write timings of loading, saving and all image processors "
+    + "as JSON to the given file",
+)
+@click.option(
+    "-C",
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=256,
+    show_default=True,
+    help="megabytes of decoded images kept for repeated and duplicate "
+    + "input images, used only if images repeat (0 disables caching)",
+)
+@click.option(
+    "-S",
+    "--strip-rows",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="apply crop, flip, frame, framecrop, colorfix and blackwhite at the "
+    + "end of the pipeline in strips of the given number of rows, streaming "
+    + "PNG output images (0 processes whole images)",
+)
 def cli_imgwrench(
     image_list,
     repeat,
@@ -179,6 +397,14 @@ def cli_imgwrench(
     quality,
     preserve_exif,
     jpg,
+    jobs,
+    prefetch,
+    writers,
+    exact,
+    incremental,
+    profile_report,
+    cache_size,
+    strip_rows,
 ):
     """A highly opinionated image processor for the commandline.
     Multiple subcommands can be executed sequentially to form
@@ -202,40 +428,178 @@ def pipeline(
     quality,
     preserve_exif,
     jpg,
+    jobs,
+    prefetch,
+    writers,
+    exact,
+    incremental,
+    profile_report,
+    cache_size,
+    strip_rows,
 ):
-    def _load_images():
-        with image_list:
-            for i, line in enumerate(_repeat(image_list, repeat)):
-                path = Path(line.strip()).resolve()
-                img, info = _load_image(path, i, preserve_exif)
-                click.echo("<- Processing {}...".format(info))
-                yield info, img
-
-    images = _load_images()
-    # connecting pipeline image processors
+    # resolution required by the pipeline, JPEGs may be decoded smaller
+    scale = None if exact else partial(input_scale, image_processors)
+    # as long as the sizes of output images are unchanged
+    planned = partial(planned_size, image_processors)
+
+    # the first processor may only need image sizes for a start
+    lazy = any(getattr(p, "lazy_input", False) for p in image_processors[:1])
+
+    # images rendered in strips while saving (see `strips.StripImage`)
+    if any(getattr(p, "strip_output", False) for p in image_processors[:-1]):
+        raise click.UsageError("collage --band-rows must be the last command")
+
+    # local operations at the end of the pipeline may be applied in strips
+    n_whole = len(image_processors)
+    while strip_rows and n_whole and is_local(image_processors[n_whole - 1]):
+        n_whole -= 1
+    # consecutive point and geometric operations are applied at once,
+    # geometric operations at the start also take care of exif rotation
+    processors = fuse_geometric(fuse(image_processors[:n_whole]), exact)
+    if n_whole < len(image_processors):
+        processors.append(fuse_strips(image_processors[n_whole:], strip_rows))
+    defer = defers_transpose(processors)
+    # composite commands resample images bit-exactly if required
     for image_processor in image_processors:
-        images = image_processor(images)
-    os.makedirs(outdir, exist_ok=True)
-    click.echo("--- Executing pipeline ---")
-    # executing pipeline
+        if hasattr(image_processor, "exact"):
+            image_processor.exact = exact
+
+    with image_list:
+        paths = [Path(line.strip()).resolve() for line in image_list]
+
+    # repeated and duplicate input images are decoded only once, the cache
+    # is only used for them as it would keep all other images in memory
+    cache = None
+    if cache_size and (repeat > 1 or len(set(paths)) < len(paths)):
+        cache = DecodeCache(
+            cache_size * 2**20, size=lambda loaded: image_bytes(loaded[0])
+        )
+
+    def _load(indexed_path):
+        i, path = indexed_path
+        if lazy:
+            return _load_lazy(path, i, preserve_exif, not exact)
+        if cache is not None:
+            decode = partial(
+                _decode_image, path, i, preserve_exif, scale, defer, planned
+            )
+            img, info = cache.get(file_key(path), decode)
+            return img, ImageInfo(path, i, info.exif, info.xmp)
+        if prefetch:
+            return _decode_image(path, i, preserve_exif, scale, defer, planned)
+        return _load_image(path, i, preserve_exif, scale, defer, planned)
+
+    def _sources():
+        yield from enumerate(_repeat(paths, repeat))
+
+    profile = Profile() if profile_report else None
+    stage_names = _stage_names(image_processors)
+
+    def _wrap(stage_processors, images):
+        if profile is None:
+            return images
+        # fused operations are reported as a single stage
+        stage_processors = [
+            fused for p in stage_processors for fused in getattr(p, "fused", [p])
+        ]
+        name = "+".join(stage_names[p] for p in stage_processors)
+        return profile.iterate(name, images)
+
+    def _load_images(sources):
+        loaded = ((info, img) for img, info in read_ahead(_load, sources, prefetch))
+        if profile is not None:
+            loaded = profile.iterate("load", loaded)
+        for info, img in loaded:
+            click.echo("<- Processing {}...".format(info))
+            yield info, img
+
     ext = "jpg" if jpg else "png"
     fmt = "{}{:0" + str(digits) + "d}." + ext
-    for i, (info, processed_image) in enumerate(images):
-        newfname = info.fname if keep_names else fmt.format(prefix, i * increment)
-        outpath = os.path.join(outdir, newfname)
-        if not force_overwrite and os.path.exists(outpath):
-            raise Exception(
-                ("{} already exists; use --force-overwrite " + "to overwrite").format(
+
+    def _output_name(i, fname):
+        return fname if keep_names else fmt.format(prefix, i * increment)
+
+    if jobs > 1 and not can_fork():
+        click.echo("Worker processes are not supported, running on a single core")
+    os.makedirs(outdir, exist_ok=True)
+    # runs of (first output number, sources) to be processed
+    runs = [(0, _sources())]
+    manifest = {}
+    keys = None
+    if incremental:
+        sources = list(_sources())
+        settings = (__version__, quality, jpg, preserve_exif, exact)
+        outputs = plan(image_processors, sources, settings)
+        if outputs is None:
+            click.echo("Pipeline does not support incremental execution")
+        else:
+            manifest = load_manifest(outdir)
+            keys = [output.key for output in outputs]
+            names = [
+                _output_name(i, sources[output.first][1].name)
+                for i, output in enumerate(outputs)
+            ]
+
+            def _is_stale(i, output):
+                outpath = os.path.join(outdir, names[i])
+                return manifest.get(names[i]) != output.key or not os.path.exists(
                     outpath
                 )
+
+            stale = stale_runs(outputs, _is_stale)
+            runs = [
+                (first, sources[first_position : last_position + 1])
+                for first, _, first_position, last_position in stale
+            ]
+            n_stale = sum(last - first + 1 for first, last, _, _ in stale)
+            click.echo(
+                "Skipping {} up-to-date output images".format(len(outputs) - n_stale)
             )
-        args = dict(quality=quality)
-        if preserve_exif and info.exif:
-            args["exif"] = info.exif
-        processed_image.save(outpath, **args)
-        if preserve_exif and jpg and info.xmp:
-            _write_xmp_to_image(outpath, info.xmp)
-        click.echo("-> Saved {}".format(outpath))
+    click.echo("--- Executing pipeline ---")
+    # executing pipeline
+    saved_keys = {}
+    # one pool of worker processes for all runs, forked before any
+    # prefetch or writer threads are started
+    executor = worker_pool(processors, jobs) if runs else None
+
+    def _outputs():
+        claimed = set()
+        for first, sources in runs:
+            # connecting pipeline image processors
+            images = connect(_load_images(sources), processors, jobs, _wrap, executor)
+            for i, (info, processed_image) in enumerate(images, first):
+                newfname = _output_name(i, info.fname)
+                outpath = os.path.join(outdir, newfname)
+                # outputs of earlier incremental runs may be replaced
+                replaceable = keys is not None and newfname in manifest
+                if not force_overwrite and (
+                    outpath in claimed or (os.path.exists(outpath) and not replaceable)
+                ):
+                    raise Exception(
+                        (
+                            "{} already exists; use --force-overwrite " + "to overwrite"
+                        ).format(outpath)
+                    )
+                claimed.add(outpath)
+                if keys is not None:
+                    saved_keys[outpath] = keys[i]
+                yield processed_image, outpath, info, quality, preserve_exif, jpg
+
+    save = _save_image if profile is None else profile.timed("save", _save_image)
+    try:
+        for outpath in _save_images(save, _outputs(), writers):
+            if keys is not None:
+                manifest[os.path.basename(outpath)] = saved_keys.pop(outpath)
+            if profile is not None:
+                profile.bytes_written += os.path.getsize(outpath)
+            click.echo("-> Saved {}".format(outpath))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if keys is not None:
+            save_manifest(outdir, manifest)
+        if profile is not None:
+            profile.save(profile_report)
     click.echo("--- Pipeline execution completed ---")
 
 
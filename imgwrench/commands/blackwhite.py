@@ -2,19 +2,31 @@
 
 import click
 
+from ..fusion import GRAYSCALE, point
+from ..stages import per_image, resolution
+
 
 def blackwhite(image):
     """Convert color images to black and white."""
     return image.convert("L")
 
 
+def _blackwhite_point(mode, histogram):
+    if mode == "RGB":
+        return GRAYSCALE
+    if mode == "L":
+        return "L", [list(range(256))]
+
+
 @click.command(name="blackwhite")
 def cli_blackwhite():
     """Convert color images to black and white."""
     click.echo("Initializing blackwhite with parameters {}".format(locals()))
 
-    def _blackwhite(images):
-        for info, image in images:
-            yield info, blackwhite(image)
+    @point(_blackwhite_point)
+    @resolution()
+    @per_image
+    def _blackwhite(image):
+        return blackwhite(image)
 
     return _blackwhite
@@ -1,19 +1,29 @@
 """Create a collage from multiple images."""
 
+import multiprocessing
 import random
-from math import floor, ceil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from math import ceil, exp, floor, log
 from abc import ABC, abstractmethod
 
 import click
 from PIL import Image
 import numpy as np
 
+from ..geometry import resample, resamples
+from ..lazy import LazyImage, materialize
 from ..param import COLOR
+from ..stages import aggregate, chunks, lazy_input, read_ahead
+from ..strips import StripImage
 
 
 class LayoutNode(ABC):
     """Node in a layout tree structure; base class for specific types."""
 
+    __slots__ = ()
+
     @abstractmethod
     def to_string(self, indent=0, weight=None):
         raise NotImplementedError("to_string is not implemented")
@@ -37,6 +47,13 @@ class LayoutNode(ABC):
         """Sum of fractions of image area that are cut away."""
         raise NotImplementedError("cut_loss is not implemented")
 
+    @abstractmethod
+    def cut_loss_areas(self, container_aspect_ratio, width, height, areas):
+        """Sum of fractions of image area that are cut away (see `cut_loss`);
+        appends the areas of leaf nodes to areas given width and height of
+        the node, such that scoring needs a single traversal of the tree."""
+        raise NotImplementedError("cut_loss_areas is not implemented")
+
     def normalized_cut_loss(self, container_aspect_ratio):
         """Sum of fractions of image area that are cut away
         normalized by number of images."""
@@ -46,31 +63,40 @@ class LayoutNode(ABC):
 
     def relative_areas(self, width, height):
         """Relative area of leaf nodes"""
+        areas = []
+        self.cut_loss_areas(width / height, width, height, areas)
         area = width * height
-        for (x, y, w, h, img) in self.positions(0, 0, width, height):
-            yield w * h / area
+        return [a / area for a in areas]
+
+    def _balance_score(self, relative_areas):
+        target_area = 1 / self.leaf_count
+        areas = np.array(relative_areas)
+        return np.prod(np.minimum(areas / target_area, 1)) ** target_area
 
     def balance_score(self, width, height):
         """Score function penalizing different image sizes.
         Between 0 and 1. Equal to 1 if every image has the same area."""
-        target_area = 1 / self.leaf_count
-        areas = np.array(list(self.relative_areas(width, height)))
-        return np.prod(np.minimum(areas / target_area, 1)) ** target_area
+        return self._balance_score(self.relative_areas(width, height))
 
     def score(self, width, height):
         """Score function to compare layouts, between 0 (worst) and 1 (best)."""
-        return (1 - self.normalized_cut_loss(width / height)) * self.balance_score(
-            width, height
-        )
+        areas = []
+        cut_loss = self.cut_loss_areas(width / height, width, height, areas)
+        area = width * height
+        balance_score = self._balance_score([a / area for a in areas])
+        return (1 - cut_loss / self.leaf_count) * balance_score
 
     @property
+    @abstractmethod
     def leaf_count(self):
-        return len(list(self.aspect_ratios(1.0)))
+        """Number of leaf nodes"""
+        pass
 
     @property
+    @abstractmethod
     def leafs(self):
-        for _, node in self.aspect_ratios(1.0):
-            yield node
+        """Leaf nodes from left to right and top to bottom"""
+        pass
 
     @property
     def leafs_index(self):
@@ -86,6 +112,28 @@ class LayoutNode(ABC):
     def set_weights_from_widths(tree, widths):
         pass
 
+    @abstractmethod
+    def uncropped_aspect_ratio(self, aspect_ratios):
+        """Aspect ratio of the node if no image is cropped; stores the
+        aspect ratios of all nodes of the subtree in aspect_ratios."""
+        pass
+
+    @abstractmethod
+    def uncropped_widths(self, width, aspect_ratios, widths):
+        """Store widths of leaf nodes in widths given the width of the node
+        and aspect_ratios computed by `uncropped_aspect_ratio`."""
+        pass
+
+    def bric_widths(self):
+        """Widths of leaf nodes for a total width of 1, such that no image is
+        cropped; i.e. the solution of `linear_equations` computed in linear
+        time, bottom-up for aspect ratios and top-down for widths."""
+        aspect_ratios = {}
+        self.uncropped_aspect_ratio(aspect_ratios)
+        widths = {}
+        self.uncropped_widths(1.0, aspect_ratios, widths)
+        return widths
+
     @property
     def linear_equations(self):
         width, height, coeff = self.width_height_coeff()
@@ -101,18 +149,43 @@ class LayoutNode(ABC):
 
 class LayoutBranch(LayoutNode):
     """Non-leaf node in a layout tree structure;
-    base class for specific types."""
+    base class for specific types.
+
+    Metrics of the child nodes are cached when assigning content, so
+    child nodes must not be changed afterwards except for their weights."""
+
+    __slots__ = ("_content", "_normalized_content", "_leaf_count")
 
     def __init__(self, content):
-        self.content = list(content)
+        self.content = content
         assert self.content, "Cannot create {} without content".format(
             self.__class__.__name__
         )
 
+    @property
+    def content(self):
+        """Child nodes with their weights as list of (weight, node) tuples"""
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = list(content)
+        total = sum(w for w, _ in self._content)
+        self._normalized_content = [(w / total, node) for w, node in self._content]
+        self._leaf_count = sum(node.leaf_count for _, node in self._content)
+
     @property
     def normalized_content(self):
-        total = sum(w for w, _ in self.content)
-        return [(w / total, node) for w, node in self.content]
+        return self._normalized_content
+
+    @property
+    def leaf_count(self):
+        return self._leaf_count
+
+    @property
+    def leafs(self):
+        for _, node in self._content:
+            yield from node.leafs
 
     def to_string(self, indent=0, weight=None):
         yield "{}{} {}:".format(
@@ -127,6 +200,8 @@ class LayoutBranch(LayoutNode):
 class Row(LayoutBranch):
     """Row node in a layout tree structure."""
 
+    __slots__ = ()
+
     def positions(self, x, y, width, height):
         offset = 0.0
         for w, node in self.normalized_content:
@@ -144,6 +219,12 @@ class Row(LayoutBranch):
             node.cut_loss(container_aspect_ratio * w) for w, node in self.content
         )
 
+    def cut_loss_areas(self, container_aspect_ratio, width, height, areas):
+        return sum(
+            node.cut_loss_areas(container_aspect_ratio * w, v * width, height, areas)
+            for (w, node), (v, _) in zip(self._content, self._normalized_content)
+        )
+
     def width_height_coeff(self):
         width = {}
         height = {}
@@ -170,10 +251,25 @@ class Row(LayoutBranch):
         self.content = list(zip(rel_widths, nodes))
         return sum_widths, widths_heights[0][1]
 
+    def uncropped_aspect_ratio(self, aspect_ratios):
+        # nodes of same height, widths add up
+        aspect_ratio = sum(
+            node.uncropped_aspect_ratio(aspect_ratios) for _, node in self.content
+        )
+        aspect_ratios[self] = aspect_ratio
+        return aspect_ratio
+
+    def uncropped_widths(self, width, aspect_ratios, widths):
+        height = width / aspect_ratios[self]
+        for _, node in self.content:
+            node.uncropped_widths(aspect_ratios[node] * height, aspect_ratios, widths)
+
 
 class Column(LayoutBranch):
     """Column node in a layout tree structure."""
 
+    __slots__ = ()
+
     def positions(self, x, y, width, height):
         offset = 0.0
         for w, node in self.normalized_content:
@@ -191,6 +287,12 @@ class Column(LayoutBranch):
             node.cut_loss(container_aspect_ratio / w) for w, node in self.content
         )
 
+    def cut_loss_areas(self, container_aspect_ratio, width, height, areas):
+        return sum(
+            node.cut_loss_areas(container_aspect_ratio / w, width, v * height, areas)
+            for (w, node), (v, _) in zip(self._content, self._normalized_content)
+        )
+
     def width_height_coeff(self):
         width = {}
         height = {}
@@ -217,12 +319,36 @@ class Column(LayoutBranch):
         self.content = list(zip(rel_heights, nodes))
         return widths_heights[0][0], sum_heights
 
+    def uncropped_aspect_ratio(self, aspect_ratios):
+        # nodes of same width, heights add up
+        height = sum(
+            1 / node.uncropped_aspect_ratio(aspect_ratios) for _, node in self.content
+        )
+        aspect_ratio = 1 / height
+        aspect_ratios[self] = aspect_ratio
+        return aspect_ratio
+
+    def uncropped_widths(self, width, aspect_ratios, widths):
+        for _, node in self.content:
+            node.uncropped_widths(width, aspect_ratios, widths)
+
 
 class LayoutLeaf(LayoutNode):
     """Leaf node in a layout tree structure; contains a single image."""
 
+    __slots__ = ("image", "image_aspect_ratio")
+
     def __init__(self, image):
         self.image = image
+        self.image_aspect_ratio = image.size[0] / image.size[1]
+
+    @property
+    def leaf_count(self):
+        return 1
+
+    @property
+    def leafs(self):
+        yield self
 
     def positions(self, x, y, width, height):
         yield (x, y, width, height, self.image)
@@ -234,22 +360,29 @@ class LayoutLeaf(LayoutNode):
     def aspect_ratios(self, container_aspect_ratio):
         yield container_aspect_ratio, self
 
-    @property
-    def image_aspect_ratio(self):
-        return self.image.size[0] / self.image.size[1]
-
     def cut_loss(self, container_aspect_ratio):
         """Fraction of image area that is cut away."""
         ai = self.image_aspect_ratio
         ac = container_aspect_ratio
         return (ai - ac) / ai if ai > ac else (1 / ai - 1 / ac) * ai
 
+    def cut_loss_areas(self, container_aspect_ratio, width, height, areas):
+        areas.append(width * height)
+        return self.cut_loss(container_aspect_ratio)
+
     def width_height_coeff(self):
         return {self: 1}, {self: 1 / self.image_aspect_ratio}, []
 
     def set_weights_from_widths(self, widths_index):
         return widths_index[self], widths_index[self] / self.image_aspect_ratio
 
+    def uncropped_aspect_ratio(self, aspect_ratios):
+        aspect_ratios[self] = self.image_aspect_ratio
+        return aspect_ratios[self]
+
+    def uncropped_widths(self, width, aspect_ratios, widths):
+        widths[self] = width
+
 
 def _binary_tree_recursive(images, rnd, is_row):
     images = list(images)
@@ -272,15 +405,13 @@ def bric_tree(images, aspect_ratio, rnd=None):
     by C. Brian Atkins."""
     rnd = rnd or random.Random(0)
     tree = _binary_tree_recursive(images, rnd, aspect_ratio >= 1)
-    a, b = tree.linear_equations
-    solution = np.linalg.solve(a, b)
-    widths = {leaf: solution[i] for leaf, i in tree.leafs_index.items()}
-    tree.set_weights_from_widths(widths)
+    tree.set_weights_from_widths(tree.bric_widths())
     return tree
 
 
-def crop(image, width, height):
-    """Center crop image and resize to width * height."""
+def crop(image, width, height, exact=False):
+    """Center crop image and resize to width * height (see
+    `imgwrench.geometry.resample`)."""
     actual_ratio = image.size[0] / image.size[1]
     target_ratio = width / height
     if target_ratio > actual_ratio:  # need to crop height
@@ -295,14 +426,12 @@ def crop(image, width, height):
         right = image.size[0] - ceil(crop_pixels / 2)
         upper = 0
         lower = image.size[1]
-    image = image.crop((left, upper, right, lower))
-    return image.resize((width, height), Image.LANCZOS)
+    return resample(image, (width, height), (left, upper, right, lower), exact=exact)
 
 
-def render(tree, width, height, frame_width, color):
-    """Render layout tree structure to given width and height
-    with specified frame; returns a PIL.Image."""
-    collg = Image.new("RGB", (width, height), color)
+def _tiles(tree, width, height, frame_width):
+    """Positions and sizes of images within frames in a collage of
+    width * height, as tuples (x, y, w, h, image)"""
     frame_half_pixels = round(frame_width * max(width, height) / 2)
     frame_pixels = frame_half_pixels * 2
     inner_width = width - frame_pixels
@@ -314,28 +443,617 @@ def render(tree, width, height, frame_width, color):
         inner_h = int(h) - frame_pixels
         inner_x = int(x) + frame_half_pixels
         inner_y = int(y) + frame_half_pixels
-        resized_img = crop(img, inner_w, inner_h)
-        collg.paste(resized_img, (inner_x, inner_y))
+        yield inner_x, inner_y, inner_w, inner_h, img
+
+
+def render(tree, width, height, frame_width, color, exact=False, threads=0):
+    """Render layout tree structure to given width and height
+    with specified frame, resampling images in threads concurrently;
+    returns a PIL.Image."""
+    collg = Image.new("RGB", (width, height), color)
+
+    def _tile(tile):
+        x, y, w, h, img = tile
+        # decode lazy images at the resolution required
+        return x, y, crop(materialize(img, (w, h)), w, h, exact)
+
+    tiles = _tiles(tree, width, height, frame_width)
+    for x, y, resized_img in read_ahead(_tile, tiles, threads):
+        collg.paste(resized_img, (x, y))
     return collg
 
 
-def collage(images, width, height, frame_width, color, seed, n_tries=1):
-    """Create a collage from multiple images."""
+class _Bands:
+    """Collage rendered in regions of consecutive horizontal bands (see
+    `imgwrench.strips.StripImage`), resampling images when the first band
+    intersects them and dropping them after the last one."""
+
+    def __init__(self, tiles, size, color, exact):
+        self.size = size
+        self.mode = "RGB"
+        self.color = color
+        self.exact = exact
+        # tiles from top to bottom
+        self.tiles = sorted(tiles, key=lambda tile: tile[1])
+        self._next = 0
+        self._resized = []
+        self._upper = 0
+
+    def region(self, box):
+        left, upper, right, lower = box
+        if upper < self._upper:
+            # start over for a band above the previous one
+            self._next = 0
+            self._resized = []
+        self._upper = upper
+        self._resized = [
+            (x, y, img) for x, y, img in self._resized if y + img.size[1] > upper
+        ]
+        while self._next < len(self.tiles) and self.tiles[self._next][1] < lower:
+            x, y, w, h, img = self.tiles[self._next]
+            self._next += 1
+            if y + h > upper:
+                img = crop(materialize(img, (w, h)), w, h, self.exact)
+                self._resized.append((x, y, img))
+        region = Image.new("RGB", (right - left, lower - upper), self.color)
+        for x, y, img in self._resized:
+            tile_box = (
+                max(left, x) - x,
+                max(upper, y) - y,
+                min(right, x + img.size[0]) - x,
+                min(lower, y + img.size[1]) - y,
+            )
+            if tile_box[0] < tile_box[2] and tile_box[1] < tile_box[3]:
+                region.paste(
+                    img.crop(tile_box),
+                    (x + tile_box[0] - left, y + tile_box[1] - upper),
+                )
+        return region
+
+
+def render_bands(tree, width, height, frame_width, color, rows, exact=False):
+    """Render layout tree structure like `render`, but in horizontal bands
+    of at most rows rows while saving the returned
+    `imgwrench.strips.StripImage`, such that only the images intersecting a
+    band are held in memory besides the band."""
+    tiles = list(_tiles(tree, width, height, frame_width))
+    return StripImage(_Bands(tiles, (width, height), color, exact), rows)
+
+
+def random_tree(images, width, height, seed, permute=False):
+    """Random layout tree of width * height created with the given seed (see
+    `bric_tree`), with images assigned to leafs by `permute_images` if
+    permute is set, otherwise in order."""
+    rnd = random.Random(seed)
+    tree = bric_tree(images, width / height, rnd)
+    if permute:
+        tree = permute_images(tree, width, height, rnd)
+    return tree
+
+
+def _best_try(sizes, width, height, permute, seeds):
+    """Best score of layouts of images of given sizes created with the given
+    seeds, and the first of the seeds achieving it."""
+    # layouts only depend on image sizes
+    images = [LazyImage(size, None) for size in sizes]
+    best = None
+    for i in seeds:
+        score = random_tree(images, width, height, i, permute).score(width, height)
+        if best is None or score > best[0]:
+            best = score, i
+    return best
+
+
+def best_seed(images, width, height, seed, n_tries=1, jobs=1, permute=False):
+    """Seed of the best scoring layout among n_tries layouts created with
+    consecutive seeds starting from seed (see `random_tree`), evaluated in
+    jobs processes.
+    Of equally scoring layouts, the one with the smallest seed is chosen,
+    like when evaluating the layouts one after another."""
+    sizes = [image.size for image in images]
+    seeds = range(seed, seed + n_tries)
+    best_try = partial(_best_try, sizes, width, height, permute)
+    if jobs <= 1 or n_tries <= 1:
+        return best_try(seeds)[1]
+    n_chunks = min(n_tries, 4 * jobs)
+    chunks = [seeds[i::n_chunks] for i in range(n_chunks)]
+    # spawned workers are safe to start while the pipeline runs threads
+    with ProcessPoolExecutor(
+        min(jobs, n_chunks), mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        results = list(executor.map(best_try, chunks))
+    return max(results, key=lambda result: (result[0], -result[1]))[1]
+
+
+# temperature of simulated annealing at the start of every cooling cycle,
+# divided by the number of images (moving a single image changes the
+# balance score of a layout by a fraction of about that size)
+ANNEAL_TEMPERATURE = 1.0
+
+# length of a cooling cycle of simulated annealing in steps per image
+ANNEAL_STEPS_PER_IMAGE = 50
+
+# seconds taken by a step of simulated annealing on a reference machine,
+# per step and per image of the layout (every step scores a whole layout)
+ANNEAL_SECONDS_PER_STEP = 1.5e-5
+ANNEAL_SECONDS_PER_IMAGE = 1.2e-6
+
+# swaps of random pairs of images tried by `permute_images` per image
+PERMUTE_SWAPS_PER_IMAGE = 4
+
+
+class _Shape:
+    """Immutable binary layout tree for local search (see `anneal`), caching
+    leaf count and aspect ratio (if no image is cropped) of every subtree.
+    Images are assigned to the leafs from left to right, leafs only keep
+    their aspect ratio. Changing a shape creates new nodes on the path to
+    the root only and shares all other subtrees."""
+
+    __slots__ = ("is_row", "left", "right", "leaf_count", "aspect_ratio")
+
+    def __init__(self, is_row, left=None, right=None, aspect_ratio=None):
+        self.is_row = is_row
+        self.left = left
+        self.right = right
+        if left is None:
+            self.leaf_count = 1
+            self.aspect_ratio = aspect_ratio
+        elif is_row:
+            self.leaf_count = left.leaf_count + right.leaf_count
+            self.aspect_ratio = left.aspect_ratio + right.aspect_ratio
+        else:
+            self.leaf_count = left.leaf_count + right.leaf_count
+            self.aspect_ratio = 1 / (1 / left.aspect_ratio + 1 / right.aspect_ratio)
+
+
+def _shape_from_tree(tree):
+    if isinstance(tree, LayoutLeaf):
+        return _Shape(None, aspect_ratio=tree.image_aspect_ratio)
+    shapes = [_shape_from_tree(node) for _, node in tree.content]
+    # nested rows (columns) are equivalent to a single row (column)
+    shape = shapes[0]
+    for right in shapes[1:]:
+        shape = _Shape(isinstance(tree, Row), shape, right)
+    return shape
+
+
+def _tree_from_shape(shape, images):
+    """Layout tree of images for a shape, weighted by the BRIC algorithm"""
+    images = iter(images)
+
+    def _tree(shape):
+        if shape.left is None:
+            return LayoutLeaf(next(images))
+        layout = Row if shape.is_row else Column
+        return layout([(1, _tree(shape.left)), (1, _tree(shape.right))])
+
+    tree = _tree(shape)
+    tree.set_weights_from_widths(tree.bric_widths())
+    return tree
+
+
+def _reshape(shape, aspect_ratios):
+    """Shape of the same structure with leafs of the given aspect ratios"""
+    if shape.left is None:
+        return _Shape(None, aspect_ratio=next(aspect_ratios))
+    left = _reshape(shape.left, aspect_ratios)
+    return _Shape(shape.is_row, left, _reshape(shape.right, aspect_ratios))
+
+
+def _shape_score(shape, aspect_ratio):
+    """Score of the layout of a shape with the given aspect ratio, equal to
+    `LayoutNode.score` of the BRIC layout tree of the shape."""
+    # images are cropped by the same fraction wherever they are placed
+    ratio = aspect_ratio / shape.aspect_ratio
+    n = shape.leaf_count
+    log_balance = 0.0
+    # relative areas of images from their widths for a layout of width 1
+    stack = [(shape, 1.0)]
+    while stack:
+        node, width = stack.pop()
+        if node.left is None:
+            area = shape.aspect_ratio * width * width / node.aspect_ratio
+            if area * n < 1:
+                log_balance += log(area * n)
+        elif node.is_row:
+            scale = width / node.aspect_ratio
+            stack.append((node.left, node.left.aspect_ratio * scale))
+            stack.append((node.right, node.right.aspect_ratio * scale))
+        else:
+            stack.append((node.left, width))
+            stack.append((node.right, width))
+    return min(ratio, 1 / ratio) * exp(log_balance / n)
+
+
+def _random_branch(shape, rnd):
+    """Path from shape to a branch chosen uniformly at random, and the
+    index of the first leaf of the branch"""
+    i = rnd.randrange(shape.leaf_count - 1)
+    path = [shape]
+    start = 0
+    while True:
+        node = path[-1]
+        left_branches = node.left.leaf_count - 1
+        if i == left_branches:
+            return path, start
+        if i < left_branches:
+            path.append(node.left)
+        else:
+            i -= left_branches + 1
+            start += node.left.leaf_count
+            path.append(node.right)
+
+
+def _replace(path, shape):
+    """Root of a shape with the last node of path replaced by shape"""
+    old = path[-1]
+    for parent in reversed(path[:-1]):
+        if parent.left is old:
+            shape = _Shape(parent.is_row, shape, parent.right)
+        else:
+            shape = _Shape(parent.is_row, parent.left, shape)
+        old = parent
+    return shape
+
+
+def _pop_leaf(shape, last):
+    """Shape without its first or last leaf, and that leaf"""
+    child = shape.right if last else shape.left
+    if child.left is None:
+        return (shape.left if last else shape.right), child
+    rest, leaf = _pop_leaf(child, last)
+    if last:
+        return _Shape(shape.is_row, shape.left, rest), leaf
+    return _Shape(shape.is_row, rest, shape.right), leaf
+
+
+def _push_leaf(shape, leaf, last, is_row):
+    """Shape with an additional first or last leaf, joined with the former
+    first or last leaf in a row if is_row is set, otherwise in a column"""
+    if shape.left is None:
+        return _Shape(is_row, shape, leaf) if last else _Shape(is_row, leaf, shape)
+    if last:
+        right = _push_leaf(shape.right, leaf, last, not shape.is_row)
+        return _Shape(shape.is_row, shape.left, right)
+    left = _push_leaf(shape.left, leaf, last, not shape.is_row)
+    return _Shape(shape.is_row, left, shape.right)
+
+
+def _neighbor(shape, aspect_ratios, rnd):
+    """Random neighbor of a shape of at least two leafs, changing a random
+    branch by flipping it from row to column or vice versa, by moving its
+    split point by one image or by swapping the structure of its subtrees
+    (reassigning the images in order)."""
+    path, start = _random_branch(shape, rnd)
+    node = path[-1]
+    move = rnd.randrange(3)
+    if move == 0:
+        return _replace(path, _Shape(not node.is_row, node.left, node.right))
+    if move == 1:
+        to_right = rnd.random() < 0.5
+        if node.leaf_count > 2:
+            # move the split point towards the larger subtree
+            to_right = node.left.leaf_count > 1 and (
+                to_right or node.right.leaf_count == 1
+            )
+            if to_right:
+                left, leaf = _pop_leaf(node.left, True)
+                right = _push_leaf(node.right, leaf, False, not node.is_row)
+            else:
+                right, leaf = _pop_leaf(node.right, False)
+                left = _push_leaf(node.left, leaf, True, not node.is_row)
+            return _replace(path, _Shape(node.is_row, left, right))
+    ratios = iter(aspect_ratios[start : start + node.leaf_count])
+    left = _reshape(node.right, ratios)
+    return _replace(path, _Shape(node.is_row, left, _reshape(node.left, ratios)))
+
+
+def _leaf_path(shape, index):
+    """Path from shape to its leaf of the given index"""
+    path = [shape]
+    while path[-1].left is not None:
+        node = path[-1]
+        if index < node.left.leaf_count:
+            path.append(node.left)
+        else:
+            index -= node.left.leaf_count
+            path.append(node.right)
+    return path
+
+
+def _swapped(items, i, j):
+    items = list(items)
+    items[i], items[j] = items[j], items[i]
+    return items
+
+
+def _swap_leafs(shape, aspect_ratios, i, j):
+    """Shape with the images of leafs i and j swapped, where aspect_ratios
+    are the aspect ratios of all leafs; only the paths to both leafs are
+    rebuilt."""
+    leaf = _Shape(None, aspect_ratio=aspect_ratios[j])
+    shape = _replace(_leaf_path(shape, i), leaf)
+    leaf = _Shape(None, aspect_ratio=aspect_ratios[i])
+    return _replace(_leaf_path(shape, j), leaf)
+
+
+def _slot_aspect_ratios(shape, aspect_ratio):
+    """Aspect ratios of the leafs of a shape of aspect_ratio if all leafs
+    had the same area"""
+    if shape.left is None:
+        return [aspect_ratio]
+    slots = []
+    for child in (shape.left, shape.right):
+        fraction = child.leaf_count / shape.leaf_count
+        if shape.is_row:
+            slots.extend(_slot_aspect_ratios(child, aspect_ratio * fraction))
+        else:
+            slots.extend(_slot_aspect_ratios(child, aspect_ratio / fraction))
+    return slots
+
+
+def permute_images(tree, width, height, rnd):
+    """Layout tree of width * height of the same structure as tree with its
+    images assigned to other leafs: images are matched to leafs by sorting
+    both by aspect ratio (of leafs of equal area, see
+    `_slot_aspect_ratios`), if this scores better than the order of tree,
+    then pairs of images chosen with the random number generator rnd are
+    swapped if this improves the score."""
+    leafs = list(tree.leafs)
+    images = [leaf.image for leaf in leafs]
+    aspect_ratios = [leaf.image_aspect_ratio for leaf in leafs]
     aspect_ratio = width / height
-    best_tree = None
-    best_score = None
-    for i in range(seed, seed + n_tries):
-        tree = bric_tree(images, aspect_ratio, random.Random(i))
-        best_tree = best_tree or tree
-        best_score = tree.score(width, height) if best_score is None else best_score
-        score = tree.score(width, height)
-        if score > best_score:
-            best_tree = tree
-            best_score = score
+    shape = _shape_from_tree(tree)
+    score = _shape_score(shape, aspect_ratio)
+    order = list(range(len(images)))
+    slots = _slot_aspect_ratios(shape, aspect_ratio)
+    by_slot = sorted(order, key=slots.__getitem__)
+    by_image = sorted(order, key=aspect_ratios.__getitem__)
+    matched_order = list(order)
+    for slot, image in zip(by_slot, by_image):
+        matched_order[slot] = image
+    matched = _reshape(shape, (aspect_ratios[i] for i in matched_order))
+    matched_score = _shape_score(matched, aspect_ratio)
+    if matched_score > score:
+        shape, score, order = matched, matched_score, matched_order
+    ratios = [aspect_ratios[i] for i in order]
+    for _ in range(PERMUTE_SWAPS_PER_IMAGE * len(images) if len(images) > 1 else 0):
+        i, j = rnd.sample(range(len(images)), 2)
+        candidate = _swap_leafs(shape, ratios, i, j)
+        candidate_score = _shape_score(candidate, aspect_ratio)
+        if candidate_score > score:
+            shape, score = candidate, candidate_score
+            order = _swapped(order, i, j)
+            ratios = _swapped(ratios, i, j)
+    return _tree_from_shape(shape, [images[i] for i in order])
+
+
+def anneal_steps(n_images, time_budget):
+    """Number of steps of simulated annealing of a layout of n_images images
+    taking about time_budget seconds on a reference machine. The number of
+    steps does not depend on the machine, so neither does the layout found
+    (see `anneal`)."""
+    seconds = ANNEAL_SECONDS_PER_STEP + ANNEAL_SECONDS_PER_IMAGE * n_images
+    return int(time_budget / seconds)
+
+
+def anneal(tree, width, height, rnd, max_steps, permute=False):
+    """Improve a layout tree of width * height by simulated annealing,
+    keeping the order of images unless permute is set, which adds swaps of
+    images between leafs to the moves of the search. Returns the best
+    layout tree found within max_steps steps and the number of steps taken.
+    The sequence of layouts explored only depends on the random number
+    generator rnd, max_steps only decides how many of them are explored.
+    Every step scores the whole layout (see `_shape_score`)."""
+    leafs = list(tree.leafs)
+    images = [leaf.image for leaf in leafs]
+    aspect_ratios = [leaf.image_aspect_ratio for leaf in leafs]
+    aspect_ratio = width / height
+    current = best = _shape_from_tree(tree)
+    current_score = best_score = _shape_score(current, aspect_ratio)
+    current_order = best_order = list(range(len(images)))
+    cycle = ANNEAL_STEPS_PER_IMAGE * len(images)
+    step = 0
+    while len(images) > 1 and step < max_steps:
+        if step and step % cycle == 0:
+            # reheat, starting from the best layout found so far
+            current, current_score = best, best_score
+            current_order = best_order
+        temperature = ANNEAL_TEMPERATURE / len(images)
+        temperature *= 1 - (step % cycle) / cycle
+        ratios = [aspect_ratios[i] for i in current_order]
+        candidate_order = current_order
+        if permute and rnd.random() < 0.5:
+            i, j = rnd.sample(range(len(images)), 2)
+            candidate = _swap_leafs(current, ratios, i, j)
+            candidate_order = _swapped(current_order, i, j)
+        else:
+            candidate = _neighbor(current, ratios, rnd)
+        score = _shape_score(candidate, aspect_ratio)
+        if score >= current_score or rnd.random() < exp(
+            (score - current_score) / temperature
+        ):
+            current, current_score = candidate, score
+            current_order = candidate_order
+            if score > best_score:
+                best, best_score, best_order = candidate, score, current_order
+        step += 1
+    return _tree_from_shape(best, [images[i] for i in best_order]), step
+
+
+# largest number of images laid out by exhaustive search
+EXHAUSTIVE_MAX_IMAGES = 10
+
+# kind of layouts composed by exhaustive search
+_COLUMN, _ROW, _LEAF = 0, 1, 2
+
+
+def _layouts(aspect_ratios, start, stop, memo):
+    """All distinct binary layouts of the images start to stop with the given
+    aspect_ratios (in order), as arrays of their kinds, aspect ratios (if no
+    image is cropped), area fractions of their images and the split points
+    and indices of the layouts of their left and right parts. Layouts of
+    contiguous ranges of images are memoized in memo."""
+    if (start, stop) in memo:
+        return memo[start, stop]
+    if stop - start == 1:
+        layouts = (
+            np.array([_LEAF]),
+            np.array([aspect_ratios[start]]),
+            np.ones((1, 1)),
+            np.array([-1]),
+            np.array([-1]),
+            np.array([-1]),
+        )
+        memo[start, stop] = layouts
+        return layouts
+    parts = []
+    for kind in (_COLUMN, _ROW):
+        for split in range(start + 1, stop):
+            left_layouts = _layouts(aspect_ratios, start, split, memo)
+            right_layouts = _layouts(aspect_ratios, split, stop, memo)
+            # a row (column) on the right of a row (column) gives the same
+            # layout as a row (column) on the left, so it is skipped
+            (rights,) = np.nonzero(right_layouts[0] != kind)
+            left_ratios = left_layouts[1][:, np.newaxis]
+            right_ratios = right_layouts[1][rights][np.newaxis, :]
+            if kind == _ROW:
+                ratios = left_ratios + right_ratios
+                left_area = left_ratios / ratios
+            else:
+                ratios = left_ratios * right_ratios / (left_ratios + right_ratios)
+                left_area = right_ratios / (left_ratios + right_ratios)
+            fractions = np.concatenate(
+                [
+                    left_layouts[2][:, np.newaxis, :] * left_area[..., np.newaxis],
+                    right_layouts[2][rights][np.newaxis, :, :]
+                    * (1 - left_area[..., np.newaxis]),
+                ],
+                axis=2,
+            )
+            count = ratios.size
+            parts.append(
+                (
+                    np.full(count, kind),
+                    ratios.ravel(),
+                    fractions.reshape(count, stop - start),
+                    np.full(count, split),
+                    np.repeat(np.arange(len(left_layouts[0])), len(rights)),
+                    np.tile(rights, len(left_layouts[0])),
+                )
+            )
+    layouts = tuple(np.concatenate(arrays) for arrays in zip(*parts))
+    memo[start, stop] = layouts
+    return layouts
+
+
+def _layout_tree(memo, images, start, stop, index):
+    kinds, _, _, splits, lefts, rights = memo[start, stop]
+    if kinds[index] == _LEAF:
+        return LayoutLeaf(images[start])
+    split = splits[index]
+    layout = Row if kinds[index] == _ROW else Column
+    return layout(
+        [
+            (1, _layout_tree(memo, images, start, split, lefts[index])),
+            (1, _layout_tree(memo, images, split, stop, rights[index])),
+        ]
+    )
+
+
+def exhaustive_tree(images, width, height):
+    """Best scoring layout tree of width * height among all binary layouts
+    of images in order, weighted by the BRIC algorithm. All layouts are
+    scored (see `LayoutNode.score`) by dynamic programming over contiguous
+    ranges of images, so this is limited to a few images (see
+    `EXHAUSTIVE_MAX_IMAGES`)."""
+    images = list(images)
+    assert images, "No layout without images"
+    assert len(images) <= EXHAUSTIVE_MAX_IMAGES, "Too many images"
+    aspect_ratios = [image.size[0] / image.size[1] for image in images]
+    memo = {}
+    _, ratios, fractions, _, _, _ = _layouts(aspect_ratios, 0, len(images), memo)
+    # cut loss of images and balance of image areas as in `LayoutNode.score`
+    ratio = width / height / ratios
+    areas = np.minimum(fractions * len(images), 1)
+    balance = np.exp(np.log(areas).mean(axis=1))
+    scores = np.minimum(ratio, 1 / ratio) * balance
+    tree = _layout_tree(memo, images, 0, len(images), np.argmax(scores))
+    tree.set_weights_from_widths(tree.bric_widths())
+    return tree
+
+
+def collage(
+    images,
+    width,
+    height,
+    frame_width,
+    color,
+    seed,
+    n_tries=1,
+    jobs=1,
+    time_budget=None,
+    exhaustive=False,
+    permute=False,
+    band_rows=0,
+    exact=False,
+    threads=0,
+):
+    """Create a collage from multiple images; if time_budget is given, the
+    best of n_tries random layouts is improved by local search (see
+    `anneal`) for about that many seconds, converted to a number of steps
+    by `anneal_steps`. If exhaustive is set, the best of
+    all layouts is chosen for up to `EXHAUSTIVE_MAX_IMAGES` images. Images
+    are laid out in order unless permute is set (see `permute_images`).
+    If band_rows is given, the collage is rendered in bands of that many
+    rows while saving it (see `render_bands`). Images are resampled
+    bit-exactly if exact is set (see `imgwrench.geometry.resample`), by
+    threads threads concurrently (see `render`)."""
+    aspect_ratio = width / height
+    if exhaustive and len(images) > EXHAUSTIVE_MAX_IMAGES:
+        print(
+            "Too many images for exhaustive search ({} > {}), trying random "
+            "layouts".format(len(images), EXHAUSTIVE_MAX_IMAGES)
+        )
+        exhaustive = False
+    start = time.perf_counter()
+    if exhaustive:
+        best_tree = exhaustive_tree(images, width, height)
+        if permute:
+            best_tree = permute_images(best_tree, width, height, random.Random(seed))
+        print("Searched all layouts in {:.2f}s".format(time.perf_counter() - start))
+    else:
+        i = best_seed(images, width, height, seed, n_tries, jobs, permute)
+        elapsed = time.perf_counter() - start
+        print(
+            "Evaluated {} layouts in {:.2f}s ({:.0f} tries/s)".format(
+                n_tries, elapsed, n_tries / elapsed if elapsed else float("inf")
+            )
+        )
+        best_tree = random_tree(images, width, height, i, permute)
+        if time_budget is not None:
+            start = time.perf_counter()
+            best_tree, steps = anneal(
+                best_tree,
+                width,
+                height,
+                random.Random(seed),
+                anneal_steps(len(images), time_budget),
+                permute=permute,
+            )
+            print(
+                "Searched {} neighboring layouts in {:.2f}s".format(
+                    steps, time.perf_counter() - start
+                )
+            )
     print("Cut loss is {:.2f}".format(best_tree.normalized_cut_loss(aspect_ratio)))
     print("Balance score is {:.2f}".format(best_tree.balance_score(width, height)))
     print("Overall score is {:.2f}".format(best_tree.score(width, height)))
-    return render(best_tree, width, height, frame_width, color)
+    if band_rows:
+        return render_bands(
+            best_tree, width, height, frame_width, color, band_rows, exact
+        )
+    return render(best_tree, width, height, frame_width, color, exact, threads)
 
 
 @click.command(name="collage")
@@ -388,15 +1106,102 @@ def collage(images, width, height, frame_width, color, seed, n_tries=1):
     show_default=True,
     help="number of tries for layout generation",
 )
-def cli_collage(width, height, frame_width, color, seed, number_tries):
+@click.option(
+    "-J",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="number of worker processes evaluating layouts",
+)
+@click.option(
+    "-t",
+    "--time-budget",
+    type=click.FloatRange(min=0),
+    default=None,
+    help="seconds for improving the best random layout by simulated "
+    + "annealing after all tries, converted to a number of steps taking that "
+    + "long on a reference machine (the same layout on every machine)",
+)
+@click.option(
+    "-e",
+    "--exhaustive",
+    is_flag=True,
+    help="choose the best of all layouts for up to {} images".format(
+        EXHAUSTIVE_MAX_IMAGES
+    ),
+)
+@click.option(
+    "-p",
+    "--permute/--keep-order",
+    default=False,
+    show_default=True,
+    help="assign images to the places of the layout fitting their aspect "
+    + "ratio, otherwise keep the order of images",
+)
+@click.option(
+    "-b",
+    "--band-rows",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="render the collage in bands of the given number of rows while "
+    + "saving it, streaming PNG output; must be the last command "
+    + "(0 renders the whole collage)",
+)
+@click.option(
+    "-T",
+    "--threads",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of threads resampling images concurrently "
+    + "(0 resamples them one after another)",
+)
+def cli_collage(
+    width,
+    height,
+    frame_width,
+    color,
+    seed,
+    number_tries,
+    jobs,
+    time_budget,
+    exhaustive,
+    permute,
+    band_rows,
+    threads,
+):
     """Create a collage from multiple images."""
     click.echo("Initializing collage with parameters {}".format(locals()))
+    if exhaustive and time_budget is not None:
+        raise click.BadParameter(
+            "cannot be combined with --exhaustive", param_hint="'--time-budget'"
+        )
 
+    @aggregate(chunks())
+    @lazy_input
+    @resamples
     def _collage(image_infos):
         image_infos = list(image_infos)
         images = [img for _, img in image_infos]
         yield image_infos[0][0], collage(
-            images, width, height, frame_width, color, seed, number_tries
+            images,
+            width,
+            height,
+            frame_width,
+            color,
+            seed,
+            number_tries,
+            jobs,
+            time_budget,
+            exhaustive,
+            permute,
+            band_rows,
+            _collage.exact,
+            threads,
         )
 
+    # collages rendered while saving cannot be processed any further
+    _collage.strip_output = band_rows > 0
     return _collage
@@ -1,50 +1,89 @@
 """Fix colors of images by stretching their channel histograms to full
 range."""
 
+import json
+import os
+from functools import partial
+
 import click
-from PIL import Image
 import numpy as np
+from PIL import Image
 
-from ..param import COLOR
+from ..fusion import point
+from ..incremental import source_key
+from ..lazy import LazyImage, materialize
+from ..param import COLOR, RATIO
+from ..stages import (
+    aggregate,
+    full_resolution,
+    lazy_input,
+    per_image,
+    resolution,
+    rolls,
+)
 
 
 DEFAULT_LEVEL = 0.01
+DEFAULT_STATS_SCALE = 1.0
 
 
-def _quantiles_iter(img, level):
-    assert img.mode == "RGB"
+def _quantiles_iter(h, level):
     assert level > 0 and level < 1
-    h = img.histogram()
-    for i in range(3):
-        channel_h = h[i * 256 : (i + 1) * 256]
-        n_pixels = sum(channel_h)
+    for channel_h in h:
+        cumulative = np.cumsum(channel_h)
+        n_pixels = int(cumulative[-1])
         low = int(level * n_pixels)
         high = int((1 - level) * n_pixels) + 1
-        s = 0
-        searching_low = True
-        for i, p in enumerate(channel_h):
-            s += p
-            if searching_low:
-                if s >= low:
-                    yield i
-                    searching_low = False
-                    continue
-            else:
-                if s >= high:
-                    yield i
-                    break
+        # first values with cumulative histogram reaching low and high
+        i_low = int(np.searchsorted(cumulative, low))
+        yield i_low
+        # high quantile is searched after low quantile only
+        i_high = i_low + 1 + int(np.searchsorted(cumulative[i_low + 1 :], high))
+        if i_high < 256:
+            yield i_high
+
 
+def sample(img, stats_scale):
+    """Sample pixels of img on a regular grid with both sides scaled by
+    stats_scale, keeping the distribution of pixel values (unlike
+    averaging resampling filters which shrink the tails)."""
+    if stats_scale >= 1:
+        return img
+    size = tuple(max(1, round(side * stats_scale)) for side in img.size)
+    return img.resize(size, Image.NEAREST)
 
-def quantiles(img, level=DEFAULT_LEVEL):
-    """Compute high and low quantiles to the given level"""
-    r_low, r_high, g_low, g_high, b_low, b_high = list(_quantiles_iter(img, level))
+
+def histogram(img, stats_scale=DEFAULT_STATS_SCALE):
+    """Channel histograms of img (or of a sample of its pixels, see
+    `sample`) as array of shape (3, 256)."""
+    assert img.mode == "RGB"
+    return np.array(sample(img, stats_scale).histogram()).reshape(3, 256)
+
+
+def histogram_quantiles(h, level=DEFAULT_LEVEL):
+    """Compute high and low quantiles to the given level from channel
+    histograms h, e.g. summed histograms of several images."""
+    r_low, r_high, g_low, g_high, b_low, b_high = list(_quantiles_iter(h, level))
     return (r_low, r_high), (g_low, g_high), (b_low, b_high)
 
 
-def colorfix_quantiles(img, level=DEFAULT_LEVEL):
+def quantiles(img, level=DEFAULT_LEVEL, stats_scale=DEFAULT_STATS_SCALE):
+    """Compute high and low quantiles to the given level.
+
+    If stats_scale is less than 1, quantiles are estimated from a sample
+    of n pixels (see `sample`). By the Dvoretzky-Kiefer-Wolfowitz
+    inequality, the fraction of pixels below an estimated quantile then
+    deviates from level by more than sqrt(ln(2 / p) / (2 * n)) with
+    probability at most p, e.g. by 0.0045 for p = 0.001 and a 12MP image
+    with stats_scale 1/8 (187,500 pixels), assuming the sampled pixels
+    represent the image like random ones would."""
+    return histogram_quantiles(histogram(img, stats_scale), level)
+
+
+def colorfix_quantiles(img, level=DEFAULT_LEVEL, stats_scale=DEFAULT_STATS_SCALE):
     """Fix colors by stretching channel histograms between given quantiles
     to full range."""
-    channel_quantiles = quantiles(img, level)
+    channel_quantiles = quantiles(img, level, stats_scale)
     return stretch_histogram(img, channel_quantiles)
 
 
@@ -60,21 +99,104 @@ def _inner_cutoffs(first_cutoffs, second_cutoffs):
         yield max(first[0], second[0]), min(first[1], second[1])
 
 
-def colorfix_quantiles_fixed_cutoff(img, level, lower_cutoff, upper_cutoff):
+def colorfix_quantiles_fixed_cutoff(
+    img, level, lower_cutoff, upper_cutoff, stats_scale=DEFAULT_STATS_SCALE
+):
     """Fix colors by stretching channel histogram between inner values
     of given quantiles and cutoff colors to full range."""
-    channel_quantiles = quantiles(img, level)
+    channel_quantiles = quantiles(img, level, stats_scale)
+    return stretch_histogram_fixed_cutoff(
+        img, channel_quantiles, lower_cutoff, upper_cutoff
+    )
+
+
+def stretch_histogram_fixed_cutoff(img, channel_quantiles, lower_cutoff, upper_cutoff):
+    """Stretch channel histograms between inner values of given quantiles
+    and cutoff colors to full range."""
     cutoffs = list(zip(lower_cutoff, upper_cutoff))
     combined = list(_inner_cutoffs(channel_quantiles, cutoffs))
     return stretch_histogram(img, combined)
 
 
-def stretch_histogram(img, cutoffs):
-    """Stretch channel histograms between given cutoffs to full range."""
-    # convert PIL image to numpy array for processing
-    arr = np.array(img).astype(np.int16)
+def _load_stats_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_stats_cache(path, stats_cache):
+    with open(path + ".tmp", "w") as f:
+        json.dump(stats_cache, f)
+    os.replace(path + ".tmp", path)
+
+
+def _roll_histogram(info, image, stats_scale, stats_cache):
+    """Channel histograms of an input image of a roll (see `histogram`);
+    if the image is a `LazyImage`, its histograms are kept in stats_cache.
+    Lazy images are decoded at full resolution, as decoding at reduced
+    resolution averages pixels and shrinks the tails of the histograms."""
+    if not isinstance(image, LazyImage):
+        return histogram(image, stats_scale)
+    # histograms of pixels sampled from the full resolution image
+    key = "{}@{}/sampled".format(source_key(info.path), stats_scale)
+    if key not in stats_cache:
+        stats_cache[key] = histogram(image.open(), stats_scale).tolist()
+    return np.array(stats_cache[key])
+
+
+def _rolls(images, roll_size):
+    roll = []
+    for item in images:
+        roll.append(item)
+        if len(roll) == roll_size:
+            yield roll
+            roll = []
+    if roll:
+        yield roll
+
+
+def colorfix_rolls(
+    images, fix, roll_size, level, stats_scale=DEFAULT_STATS_SCALE, stats_cache=None
+):
+    """Fix colors of rolls of roll_size consecutive images (all images if
+    roll_size is 0) using common quantiles computed from the histograms
+    of all images of a roll. fix(img, channel_quantiles) fixes a single
+    image. Images are processed in two passes per roll: histograms of
+    pixels sampled according to stats_scale are computed first, and colors
+    are fixed afterwards. Histograms of lazy images are kept in stats_cache, the
+    path of a JSON file, if given."""
+    cache = _load_stats_cache(stats_cache) if stats_cache else {}
+    for roll in _rolls(images, roll_size):
+        h = sum(
+            _roll_histogram(info, image, stats_scale, cache) for info, image in roll
+        )
+        if stats_cache:
+            _save_stats_cache(stats_cache, cache)
+        channel_quantiles = histogram_quantiles(h, level)
+        for info, image in roll:
+            yield info, fix(materialize(image), channel_quantiles)
+
+
+def _stretch_lut(low, high):
+    """Lookup table stretching channel values between low and high
+    to full range."""
     # type int16 is required to prevent stretched colors from overflowing
-    # arr.shape = (height, width, channel)
+    values = np.arange(256, dtype=np.int16)
+    if low == 0 and high == 255:
+        return values  # no stretching required
+    # stretch colors betweem low and high to full range
+    stretched = (values - low) / (high - low) * 256
+    stretched = stretched.astype(np.int16)
+    # cut off anything that has been scaled under or over full range
+    return np.maximum(np.minimum(stretched, 255), 0)
+
+
+def stretch_luts(cutoffs):
+    """Lookup tables stretching channel histograms between given cutoffs
+    to full range."""
+    luts = []
     # iterate over all three color channels (red, green, blue)
     for idx_channel in range(3):
         low, high = cutoffs[idx_channel]
@@ -84,17 +206,14 @@ def stretch_histogram(img, cutoffs):
         assert high <= 255, (
             "high value for channel {} is {}, but must be 255" " or less"
         ).format(idx_channel, high)
-        if low == 0 and high == 255:
-            continue  # no stretching required, save some cpu cycles
-        channel = arr[:, :, idx_channel]
-        # stretch colors betweem low and high to full range
-        stretched = (channel - low) / (high - low) * 256
-        stretched = stretched.astype(np.int16)
-        # cut off anything that has been scaled under or over full range
-        channel[:, :] = np.maximum(np.minimum(stretched, 255), 0)
-    # convert back to uint8 (lossless after range cutoff)
-    # ... and to PIL image
-    return Image.fromarray(arr.astype(np.uint8))
+        luts.append(_stretch_lut(low, high))
+    return luts
+
+
+def stretch_histogram(img, cutoffs):
+    """Stretch channel histograms between given cutoffs to full range."""
+    # a single pass over the image applies the lookup tables of all channels
+    return img.point(np.concatenate(stretch_luts(cutoffs)).tolist())
 
 
 QUANTILES = "quantiles"
@@ -151,21 +270,91 @@ QUANTILES_FIXED_CUTOFF = "quantiles-fixed-cutoff"
     "relevant for --method=fixed-cutoff "
     "and --method=quantiles-fixed-cutoff",
 )
-def cli_colorfix(method, alpha, lower_cutoff, upper_cutoff):
+@click.option(
+    "-s",
+    "--stats-scale",
+    type=RATIO,
+    default=str(DEFAULT_STATS_SCALE),
+    show_default=True,
+    help="estimate quantiles from a sample of pixels with image sides "
+    "scaled by this factor (e.g. 1/8), trading accuracy for speed; "
+    "relevant for --method=quantiles "
+    "and --method=quantiles-fixed-cutoff",
+)
+@click.option(
+    "-r",
+    "--roll-size",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="number of consecutive images (0 for all images) sharing quantiles "
+    "computed from their combined histograms, e.g. all images of a film roll; "
+    "relevant for --method=quantiles "
+    "and --method=quantiles-fixed-cutoff",
+)
+@click.option(
+    "-c",
+    "--stats-cache",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    default=None,
+    help="JSON file for caching histograms of input images in "
+    "roll mode (--roll-size other than 1)",
+)
+def cli_colorfix(
+    method, alpha, lower_cutoff, upper_cutoff, stats_scale, roll_size, stats_cache
+):
     """Fix colors by stretching channel histograms to full range."""
     click.echo("Initializing colorfix with parameters {}".format(locals()))
+    if stats_scale > 1:
+        raise click.BadParameter(
+            "must not be larger than 1", param_hint="'--stats-scale'"
+        )
 
-    def _colorfix(images):
-        for info, image in images:
+    if roll_size != 1 and method != FIXED_CUTOFF:
+
+        def _fix(image, channel_quantiles):
+            if method == QUANTILES:
+                return stretch_histogram(image, channel_quantiles)
+            return stretch_histogram_fixed_cutoff(
+                image, channel_quantiles, lower_cutoff, upper_cutoff
+            )
+
+        @aggregate(rolls(roll_size or None))
+        @resolution(input_scale=full_resolution)
+        @lazy_input
+        def _colorfix_rolls(images):
+            return colorfix_rolls(
+                images, _fix, roll_size, alpha, stats_scale, stats_cache
+            )
+
+        return _colorfix_rolls
+
+    def _colorfix_point(mode, histogram_of):
+        if mode != "RGB":
+            return None
+        cutoffs = list(zip(lower_cutoff, upper_cutoff))
+        if method != FIXED_CUTOFF:
+            h = histogram_of(partial(histogram, stats_scale=stats_scale))
+            channel_quantiles = histogram_quantiles(h, alpha)
             if method == QUANTILES:
-                yield info, colorfix_quantiles(image, alpha)
-            elif method == FIXED_CUTOFF:
-                yield info, colorfix_fixed_cutoff(image, lower_cutoff, upper_cutoff)
-            elif method == QUANTILES_FIXED_CUTOFF:
-                yield info, colorfix_quantiles_fixed_cutoff(
-                    image, alpha, lower_cutoff, upper_cutoff
-                )
+                cutoffs = channel_quantiles
             else:
-                raise NotImplementedError("{} not implemented".format(method))
+                cutoffs = list(_inner_cutoffs(channel_quantiles, cutoffs))
+        return "RGB", stretch_luts(cutoffs)
+
+    @point(_colorfix_point)
+    @resolution(input_scale=full_resolution)
+    @per_image
+    def _colorfix(image):
+        if method == QUANTILES:
+            return colorfix_quantiles(image, alpha, stats_scale)
+        elif method == FIXED_CUTOFF:
+            return colorfix_fixed_cutoff(image, lower_cutoff, upper_cutoff)
+        elif method == QUANTILES_FIXED_CUTOFF:
+            return colorfix_quantiles_fixed_cutoff(
+                image, alpha, lower_cutoff, upper_cutoff, stats_scale
+            )
+        else:
+            raise NotImplementedError("{} not implemented".format(method))
 
     return _colorfix
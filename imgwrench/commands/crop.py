@@ -4,12 +4,15 @@ from math import floor, ceil
 
 import click
 
+from ..geometry import CROP, geometric
 from ..param import RATIO
+from ..stages import per_image, resolution
 
 
-def crop(image, aspect_ratio):
-    """Crop images to the given aspect ratio."""
-    width, height = image.size[0], image.size[1]
+def crop_box(size, aspect_ratio):
+    """Box (left, upper, right, lower) for cropping an image of given size
+    to the given aspect ratio."""
+    width, height = size
     long_side = max(width, height)
     short_side = min(width, height)
     actual_ratio = long_side / short_side
@@ -31,7 +34,24 @@ def crop(image, aspect_ratio):
     if height > width:
         upper, left = left, upper
         lower, right = right, lower
-    return image.crop((left, upper, right, lower))
+    return left, upper, right, lower
+
+
+def cropped_size(size, aspect_ratio):
+    """Size of an image of given size after cropping to aspect ratio."""
+    left, upper, right, lower = crop_box(size, aspect_ratio)
+    return right - left, lower - upper
+
+
+def fill_scale(size, width, height):
+    """Factor by which an image of given size can be scaled down such that
+    it still covers width * height after center cropping."""
+    return max(width / size[0], height / size[1])
+
+
+def crop(image, aspect_ratio):
+    """Crop images to the given aspect ratio."""
+    return image.crop(crop_box(image.size, aspect_ratio))
 
 
 @click.command(name="crop")
@@ -47,8 +67,10 @@ def cli_crop(aspect_ratio):
     """Crop images to the given aspect ratio."""
     click.echo("Initializing crop with parameters {}".format(locals()))
 
-    def _crop(images):
-        for info, image in images:
-            yield info, crop(image, aspect_ratio)
+    @resolution(output_size=lambda size: cropped_size(size, aspect_ratio))
+    @geometric(lambda size: [(CROP, crop_box(size, aspect_ratio))])
+    @per_image
+    def _crop(image):
+        return crop(image, aspect_ratio)
 
     return _crop
@@ -1,13 +1,27 @@
 """Apply black-white dithering to images."""
 
+from functools import partial
+
 import click
 from PIL import ImageEnhance
 
+from ..fusion import point, probe_lut
+from ..stages import per_image, resolution
+
+
+def brighten(image, brightness_factor):
+    """Adjust brightness of images."""
+    return ImageEnhance.Brightness(image).enhance(brightness_factor)
+
+
+def finish(image):
+    """Dither images to black and white."""
+    return image.convert("1")
+
 
 def dither(image, brightness_factor):
     """Apply black-white dithering to images."""
-    image = ImageEnhance.Brightness(image).enhance(brightness_factor)
-    return image.convert("1")
+    return finish(brighten(image, brightness_factor))
 
 
 @click.command(name="dither")
@@ -24,8 +38,19 @@ def cli_dither(brightness_factor):
     """Apply black-white dithering to images."""
     click.echo("Initializing dither with parameters {}".format(locals()))
 
-    def _dither(images):
-        for info, image in images:
-            yield info, dither(image, brightness_factor)
+    luts = {}
+
+    def _dither_point(mode, histogram):
+        if mode in ("L", "RGB"):
+            if mode not in luts:
+                brighten_image = partial(brighten, brightness_factor=brightness_factor)
+                luts[mode] = probe_lut(brighten_image, mode)
+            return mode, luts[mode]
+
+    @point(_dither_point, finish)
+    @resolution()
+    @per_image
+    def _dither(image):
+        return dither(image, brightness_factor)
 
     return _dither
@@ -3,10 +3,12 @@
 import click
 from PIL import Image
 
+from ..geometry import resample, resamples
 from ..param import COLOR
+from ..stages import aggregate, chunks, resolution
 
 
-def filmstrip(height, frame_width, color, images):
+def filmstrip(height, frame_width, color, images, exact=False):
     """Stack all images horizontally, creating a filmstrip."""
     images = list(images)
     frame_pixels = round(frame_width * height)
@@ -19,7 +21,7 @@ def filmstrip(height, frame_width, color, images):
     for i, img in enumerate(images):
         w = int(img.size[0] / img.size[1] * (height - 2 * frame_pixels))
         h = height - 2 * frame_pixels
-        resized_img = img.resize((w, h), Image.LANCZOS)
+        resized_img = resample(img, (w, h), exact=exact)
         framed_image.paste(resized_img, (offset, frame_pixels))
         offset += w + frame_pixels
     return framed_image
@@ -55,10 +57,22 @@ def cli_filmstrip(height, frame_width, color):
     """Stack all images horizontally, creating a filmstrip."""
     click.echo("Initializing filmstrip with parameters {}".format(locals()))
 
+    def _input_scale(size, scale):
+        frame_pixels = round(frame_width * height)
+        return (height - 2 * frame_pixels) / size[1] * scale
+
+    # the width of a filmstrip depends on all its images
+    @aggregate(chunks())
+    @resolution(output_size=lambda size: None, input_scale=_input_scale)
+    @resamples
     def _filmstrip(images):
         images = list(images)
         yield images[0][0], filmstrip(
-            height, frame_width, color, [img for info, img in images]
+            height,
+            frame_width,
+            color,
+            [img for info, img in images],
+            _filmstrip.exact,
         )
 
     return _filmstrip
@@ -4,6 +4,9 @@ import click
 
 from PIL import Image
 
+from ..geometry import TRANSPOSE, geometric
+from ..stages import per_image, resolution
+
 
 def flip(image):
     """Flip/mirror images left-right."""
@@ -15,8 +18,10 @@ def cli_flip():
     """Flip/mirror images left-right."""
     click.echo("Initializing flip with parameters {}".format(locals()))
 
-    def _flip(images):
-        for info, image in images:
-            yield info, flip(image)
+    @resolution()
+    @geometric(lambda size: [(TRANSPOSE, Image.FLIP_LEFT_RIGHT)])
+    @per_image
+    def _flip(image):
+        return flip(image)
 
     return _flip
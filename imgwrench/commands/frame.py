@@ -3,15 +3,27 @@
 import click
 from PIL import Image
 
+from ..geometry import FRAME, geometric
 from ..param import COLOR
+from ..stages import per_image, resolution
+
+
+def frame_pixels(size, width):
+    """Frame width in pixels for an image of given size."""
+    return round(width * max(size))
+
+
+def framed_size(size, width):
+    """Size of an image of given size after framing with frame width."""
+    pixels = frame_pixels(size, width)
+    return size[0] + 2 * pixels, size[1] + 2 * pixels
 
 
 def frame(image, width, color):
     """Put a monocolor frame around images."""
-    frame_pixels = round(width * max(image.size))
-    new_size = (image.size[0] + 2 * frame_pixels, image.size[1] + 2 * frame_pixels)
-    framed_image = Image.new("RGB", new_size, color)
-    framed_image.paste(image, (frame_pixels, frame_pixels))
+    pixels = frame_pixels(image.size, width)
+    framed_image = Image.new("RGB", framed_size(image.size, width), color)
+    framed_image.paste(image, (pixels, pixels))
     return framed_image
 
 
@@ -37,8 +49,10 @@ def cli_frame(frame_width, color):
     """Put a monocolor frame around images."""
     click.echo("Initializing frame with parameters {}".format(locals()))
 
-    def _frame(images):
-        for info, image in images:
-            yield info, frame(image, frame_width, color)
+    @resolution(output_size=lambda size: framed_size(size, frame_width))
+    @geometric(lambda size: [(FRAME, frame_pixels(size, frame_width), color)])
+    @per_image
+    def _frame(image):
+        return frame(image, frame_width, color)
 
     return _frame
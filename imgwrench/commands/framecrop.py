@@ -3,9 +3,11 @@ from math import floor
 
 import click
 
+from ..geometry import CROP, FRAME, geometric
 from ..param import COLOR, RATIO
-from .crop import crop
-from .frame import frame
+from ..stages import per_image, resolution
+from .crop import crop, crop_box, cropped_size
+from .frame import frame, frame_pixels, framed_size
 
 
 def _floor(x, digits):
@@ -40,6 +42,19 @@ def framecrop(image, aspect_ratio, width, color):
     return frame(cropped_image, width, color)
 
 
+def framecrop_geometry(size, aspect_ratio, width, color):
+    """Geometric operations of a framecrop operation on an image of given
+    size (see `imgwrench.geometry.geometric`)."""
+    box = crop_box(size, crop_ratio(aspect_ratio, width))
+    cropped = box[2] - box[0], box[3] - box[1]
+    return [(CROP, box), (FRAME, frame_pixels(cropped, width), color)]
+
+
+def framecropped_size(size, aspect_ratio, width):
+    """Size of an image of given size after a framecrop operation."""
+    return framed_size(cropped_size(size, crop_ratio(aspect_ratio, width)), width)
+
+
 @click.command(name="framecrop")
 @click.option(
     "-a",
@@ -73,8 +88,12 @@ def cli_framecrop(aspect_ratio, frame_width, color):
     # for side effect of checking valid aspect_ratio and frame_width:
     crop_ratio(aspect_ratio, frame_width)
 
-    def _framecrop(images):
-        for info, image in images:
-            yield info, framecrop(image, aspect_ratio, frame_width, color)
+    @resolution(
+        output_size=lambda size: framecropped_size(size, aspect_ratio, frame_width)
+    )
+    @geometric(lambda size: framecrop_geometry(size, aspect_ratio, frame_width, color))
+    @per_image
+    def _framecrop(image):
+        return framecrop(image, aspect_ratio, frame_width, color)
 
     return _framecrop
@@ -5,11 +5,37 @@ from itertools import islice
 import click
 from PIL import Image
 
+from ..geometry import resample, resamples, transposed_size
 from ..param import COLOR
-from .crop import crop
+from ..stages import aggregate, chunks, read_ahead, resolution
+from .crop import crop_box, fill_scale
 
 
-def grid(images, rows, columns, width, height, frame_width, double_inner_frame, color):
+def _cell_size(rows, columns, width, height, frame_width, double_inner_frame):
+    """Size of a single cell of a grid in landscape orientation."""
+    width, height = max(width, height), min(width, height)
+    frame_pixels = frame_width * width
+    dbl = 2 if double_inner_frame else 1
+    total_frame_pixels_width = ((columns - 1) * dbl + 2) * frame_pixels
+    total_frame_pixels_height = ((rows - 1) * dbl + 2) * frame_pixels
+    single_width = (width - total_frame_pixels_width) / columns
+    single_height = (height - total_frame_pixels_height) / rows
+    return single_width, single_height
+
+
+def grid(
+    images,
+    rows,
+    columns,
+    width,
+    height,
+    frame_width,
+    double_inner_frame,
+    color,
+    exact=False,
+    threads=0,
+):
+    """Collect images into a grid, resampling them in threads concurrently."""
     assert images
     assert len(images) <= rows * columns
     is_landscape = width >= height
@@ -18,21 +44,27 @@ def grid(images, rows, columns, width, height, frame_width, double_inner_frame,
     result = Image.new(mode="RGB", size=(width, height), color=color)
     frame_pixels = frame_width * width
     dbl = 2 if double_inner_frame else 1
-    total_frame_pixels_width = ((columns - 1) * dbl + 2) * frame_pixels
-    total_frame_pixels_height = ((rows - 1) * dbl + 2) * frame_pixels
-    single_width = (width - total_frame_pixels_width) / columns
-    single_height = (height - total_frame_pixels_height) / rows
+    single_width, single_height = _cell_size(
+        rows, columns, width, height, frame_width, double_inner_frame
+    )
     ratio = single_width / single_height
-    for i, img in enumerate(images):
+    size = int(single_width), int(single_height)
+
+    def _cell(indexed_image):
+        i, img = indexed_image
+        method = None
         if (ratio >= 1 and img.size[0] < img.size[1]) or (
             ratio < 1 and img.size[0] >= img.size[1]
         ):
-            img = img.transpose(Image.ROTATE_90)
-        img = crop(img, ratio)
-        img = img.resize((int(single_width), int(single_height)))
+            method = Image.ROTATE_90
+        box = crop_box(transposed_size(img.size, method), ratio)
+        img = resample(img, size, box, method, exact, Image.BICUBIC)
         x = int(i // rows * (single_width + dbl * frame_pixels) + frame_pixels)
         y = int(i % rows * (single_height + dbl * frame_pixels) + frame_pixels)
-        result.paste(img, (x, y))
+        return img, (x, y)
+
+    for img, position in read_ahead(_cell, enumerate(images), threads):
+        result.paste(img, position)
     if not is_landscape:
         result = result.transpose(Image.ROTATE_270)
     return result
@@ -97,10 +129,34 @@ def grid(images, rows, columns, width, height, frame_width, double_inner_frame,
     help="color of the frame as a color name, hex value "
     + "or in rgb(...) function form",
 )
-def cli_grid(rows, columns, width, height, frame_width, double_inner_frame, color):
+@click.option(
+    "-T",
+    "--threads",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of threads resampling images concurrently "
+    + "(0 resamples them one after another)",
+)
+def cli_grid(
+    rows, columns, width, height, frame_width, double_inner_frame, color, threads
+):
     """Collects images into a grid."""
     click.echo("Initializing grid with parameters {}".format(locals()))
 
+    def _input_scale(size, scale):
+        is_landscape = width >= height
+        cell_rows, cell_columns = (rows, columns) if is_landscape else (columns, rows)
+        single_width, single_height = _cell_size(
+            cell_rows, cell_columns, width, height, frame_width, double_inner_frame
+        )
+        if (single_width >= single_height) != (size[0] >= size[1]):
+            size = size[1], size[0]
+        return fill_scale(size, int(single_width), int(single_height)) * scale
+
+    @aggregate(chunks(rows * columns))
+    @resolution(output_size=lambda size: (width, height), input_scale=_input_scale)
+    @resamples
     def _grid(images):
         images = iter(images)
         while True:
@@ -116,6 +172,8 @@ def cli_grid(rows, columns, width, height, frame_width, double_inner_frame, colo
                     frame_width,
                     double_inner_frame,
                     color,
+                    _grid.exact,
+                    threads,
                 )
             else:
                 break
@@ -5,12 +5,36 @@ from itertools import islice
 import click
 from PIL import Image
 
+from ..geometry import resample, resamples
 from ..param import COLOR
-from .crop import crop
-from .resize import resize
+from ..stages import aggregate, chunks, read_ahead, resolution
+from .crop import crop_box, cropped_size, fill_scale
+from .resize import resized_size
 
 
-def quad(quad_images, width, height, frame_width, double_inner_frame, color):
+def _cell_size(width, height, frame_width, double_inner_frame):
+    """Size of a single cell of a quad in landscape orientation."""
+    width, height = max(width, height), min(width, height)
+    frame_pixels = frame_width * width
+    dbl = 1 if double_inner_frame else 0
+    total_frame_pixels = (3 + dbl) * frame_pixels
+    single_width = (width - total_frame_pixels) / 2
+    single_height = (height - total_frame_pixels) / 2
+    return single_width, single_height
+
+
+def quad(
+    quad_images,
+    width,
+    height,
+    frame_width,
+    double_inner_frame,
+    color,
+    exact=False,
+    threads=0,
+):
+    """Collect up to four images to a quad, resampling them in threads
+    concurrently."""
     assert quad_images
     assert len(quad_images) <= 4
     is_landscape = width >= height
@@ -18,18 +42,24 @@ def quad(quad_images, width, height, frame_width, double_inner_frame, color):
     result = Image.new(mode="RGB", size=(width, height), color=color)
     frame_pixels = frame_width * width
     dbl = 1 if double_inner_frame else 0
-    total_frame_pixels = (3 + dbl) * frame_pixels
-    ratio = (width - total_frame_pixels) / (height - total_frame_pixels)
-    single_width = (width - total_frame_pixels) / 2
-    single_height = (height - total_frame_pixels) / 2
-    for i, img in enumerate(quad_images):
-        if img.size[0] < img.size[1]:
-            img = img.transpose(Image.ROTATE_90)
-        img = crop(img, ratio)
-        img = resize(img, single_width)
+    single_width, single_height = _cell_size(
+        width, height, frame_width, double_inner_frame
+    )
+    ratio = single_width / single_height
+
+    def _cell(indexed_image):
+        i, img = indexed_image
+        method = Image.ROTATE_90 if img.size[0] < img.size[1] else None
+        size = max(img.size), min(img.size)
+        box = crop_box(size, ratio)
+        size = resized_size(cropped_size(size, ratio), single_width)
+        img = resample(img, size, box, method, exact)
         x = int(i % 2 * (single_width + (1 + dbl) * frame_pixels) + frame_pixels)
         y = int(int(i / 2) * (single_height + (1 + dbl) * frame_pixels) + frame_pixels)
-        result.paste(img, (x, y))
+        return img, (x, y)
+
+    for img, position in read_ahead(_cell, enumerate(quad_images), threads):
+        result.paste(img, position)
     if not is_landscape:
         result = result.transpose(Image.ROTATE_270)
     return result
@@ -78,10 +108,29 @@ def quad(quad_images, width, height, frame_width, double_inner_frame, color):
     help="color of the frame as a color name, hex value "
     + "or in rgb(...) function form",
 )
-def cli_quad(width, height, frame_width, double_inner_frame, color):
+@click.option(
+    "-T",
+    "--threads",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="number of threads resampling images concurrently "
+    + "(0 resamples them one after another)",
+)
+def cli_quad(width, height, frame_width, double_inner_frame, color, threads):
     """Collects four images to a quad."""
     click.echo("Initializing quad with parameters {}".format(locals()))
 
+    def _input_scale(size, scale):
+        single_width, single_height = _cell_size(
+            width, height, frame_width, double_inner_frame
+        )
+        size = max(size), min(size)
+        return fill_scale(size, single_width, single_height) * scale
+
+    @aggregate(chunks(4))
+    @resolution(output_size=lambda size: (width, height), input_scale=_input_scale)
+    @resamples
     def _quad(images):
         images = iter(images)
         while True:
@@ -95,6 +144,8 @@ def cli_quad(width, height, frame_width, double_inner_frame, color):
                     frame_width,
                     double_inner_frame,
                     color,
+                    _quad.exact,
+                    threads,
                 )
             else:
                 break
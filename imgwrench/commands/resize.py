@@ -3,13 +3,19 @@
 import click
 from PIL import Image
 
+from ..geometry import RESIZE, geometric
+from ..stages import per_image, resolution
+
+
+def resized_size(size, maxsize):
+    """Size of an image of given size after resizing to maxsize."""
+    ratio = float(maxsize) / max(size)
+    return int(size[0] * ratio), int(size[1] * ratio)
+
 
 def resize(image, maxsize):
     """Resize image to maxsize (longer) side length preserving aspect ratio."""
-    ratio = float(maxsize) / max(image.size)
-    return image.resize(
-        (int(image.size[0] * ratio), int(image.size[1] * ratio)), Image.LANCZOS
-    )
+    return image.resize(resized_size(image.size, maxsize), Image.LANCZOS)
 
 
 @click.command(name="resize")
@@ -25,8 +31,13 @@ def cli_resize(maxsize):
     """Resize images to a maximum side length preserving aspect ratio."""
     click.echo("Initializing resize with parameters {}".format(locals()))
 
-    def _resize(images):
-        for info, image in images:
-            yield info, resize(image, maxsize)
+    @resolution(
+        output_size=lambda size: resized_size(size, maxsize),
+        input_scale=lambda size, scale: maxsize * scale / max(size),
+    )
+    @geometric(lambda size: [(RESIZE, resized_size(size, maxsize))], resampling=True)
+    @per_image
+    def _resize(image):
+        return resize(image, maxsize)
 
     return _resize
@@ -2,14 +2,17 @@
 
 import click
 
+from ..stages import per_image, resolution
+
 
 @click.command(name="save")
 def cli_save():
     """No-op to enable saving of images without any processing."""
     click.echo("Initializing save (no-op) without parameters")
 
-    def _save(images):
-        for info, image in images:
-            yield info, image
+    @resolution()
+    @per_image
+    def _save(image):
+        return image
 
     return _save
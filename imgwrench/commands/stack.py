@@ -3,16 +3,36 @@
 import click
 from PIL import Image
 
+from ..geometry import resample, resamples
+from ..stages import aggregate, resolution
 
-def stack(img1, img2, width, height):
+
+def _stack_ratio(size, width, height):
+    """Resize ratio of an image of given size within a stack."""
+    return min(float(height) / 2 / size[1], float(width) / size[0])
+
+
+def _pairs(indices):
+    """Positions of image pairs in a stack, starting at even indices."""
+    pairs = []
+    last_position = None
+    for position, index in enumerate(indices):
+        if index % 2 == 0:
+            last_position = position
+        else:
+            pairs.append([last_position, position])
+    return pairs
+
+
+def stack(img1, img2, width, height, exact=False):
     """Stack images vertically, empty space in the middle."""
-    ratio1 = min(float(height) / 2 / img1.size[1], float(width) / img1.size[0])
-    resized_img1 = img1.resize(
-        (int(img1.size[0] * ratio1), int(img1.size[1] * ratio1)), Image.LANCZOS
+    ratio1 = _stack_ratio(img1.size, width, height)
+    resized_img1 = resample(
+        img1, (int(img1.size[0] * ratio1), int(img1.size[1] * ratio1)), exact=exact
     )
-    ratio2 = min(float(height) / 2 / img2.size[1], float(width) / img2.size[0])
-    resized_img2 = img2.resize(
-        (int(img2.size[0] * ratio2), int(img2.size[1] * ratio2)), Image.LANCZOS
+    ratio2 = _stack_ratio(img2.size, width, height)
+    resized_img2 = resample(
+        img2, (int(img2.size[0] * ratio2), int(img2.size[1] * ratio2)), exact=exact
     )
     stacked = Image.new(mode="RGB", size=(width, height), color=(255, 255, 255))
     stacked.paste(resized_img1, (0, 0))
@@ -41,6 +61,12 @@ def cli_stack(width, height):
     """Stacks pairs of images vertically, empty space in the middle."""
     click.echo("Initializing stack with parameters {}".format(locals()))
 
+    @aggregate(_pairs)
+    @resolution(
+        output_size=lambda size: (width, height),
+        input_scale=lambda size, scale: _stack_ratio(size, width, height) * scale,
+    )
+    @resamples
     def _stack(images):
         last_info = None
         last_image = None
@@ -49,6 +75,6 @@ def cli_stack(width, height):
                 last_info = info
                 last_image = image
             else:
-                yield last_info, stack(last_image, image, width, height)
+                yield last_info, stack(last_image, image, width, height, _stack.exact)
 
     return _stack
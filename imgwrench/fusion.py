@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""Fusion of consecutive point operations into a single pass over images."""
+
+import numpy as np
+from PIL import Image
+
+from .stages import resolution
+
+# rows processed at once when converting to grayscale
+STRIP_PIXELS = 2**20
+
+GRAYSCALE = "L", None
+
+
+def point(transform, finish=None):
+    """Decorator declaring that a per-image processor (see
+    `imgwrench.stages.per_image`) is a point operation, i.e. every output
+    pixel value only depends on the input pixel value at the same position,
+    which allows fusing consecutive point operations into a single pass.
+
+    transform(mode, histogram) returns (mode, luts) describing the operation
+    on images of the given mode, where luts is a list of lookup tables (256
+    values) for all bands, or `GRAYSCALE` for converting RGB images to L.
+    histogram(func) returns the histograms func(image) computes for its
+    input image (e.g. `imgwrench.commands.colorfix.histogram`, an array of
+    bands x 256 values). transform returns None if the operation cannot be
+    fused for mode. finish(image) is applied to the result of the point
+    operation if the processor does more than that (e.g. dithering).
+    Results must be identical to those of the unfused processor."""
+
+    def _decorate(image_processor):
+        image_processor.point = transform
+        image_processor.finish = finish
+        return image_processor
+
+    return _decorate
+
+
+def probe_lut(func, mode):
+    """Lookup tables for all bands of mode derived by applying func,
+    a point operation on PIL images, to all possible values."""
+    values = Image.frombytes("L", (256, 1), bytes(range(256)))
+    probe = Image.merge(mode, [values] * Image.getmodebands(mode))
+    return [np.asarray(band)[0] for band in func(probe).split()]
+
+
+class Points:
+    """Point operations applied to an image so far, not yet rendered"""
+
+    def __init__(self, image):
+        self._reset(image)
+
+    def _reset(self, image):
+        self.image = image
+        self.mode = image.mode
+        self.luts = [np.arange(256) for _ in image.getbands()]
+        # lookup table applied after converting RGB to L
+        self.gray_lut = None
+
+    def histogram(self, func):
+        """Histograms computed by func for the image with all operations
+        applied, i.e. histograms of the input image remapped by the lookup
+        tables (point operations commute with sampling pixels)"""
+        if self.gray_lut is not None:
+            self._reset(self.render())
+        return np.array(
+            [
+                np.bincount(lut, weights=h, minlength=256).astype(int)
+                for lut, h in zip(self.luts, func(self.image))
+            ]
+        )
+
+    def apply(self, mode, luts):
+        """Apply a point operation, returning False if this is not possible"""
+        if luts is None:
+            if self.mode != "RGB":
+                return False
+            self.mode = "L"
+            self.gray_lut = np.arange(256)
+        elif mode != self.mode or len(luts) != len(self.luts):
+            return False
+        elif self.gray_lut is not None:
+            self.gray_lut = np.asarray(luts[0])[self.gray_lut]
+        else:
+            self.luts = [np.asarray(lut)[old] for lut, old in zip(luts, self.luts)]
+        return True
+
+    def _render_luts(self, image):
+        luts = np.concatenate(self.luts)
+        if (luts == np.tile(np.arange(256), len(self.luts))).all():
+            return image
+        return image.point(luts.tolist())
+
+    def render(self):
+        """Image with all operations applied"""
+        if self.gray_lut is None:
+            image = self._render_luts(self.image)
+            # a copy only if no lookup table changes the image, such that
+            # the result never aliases the input image
+            return image.copy() if image is self.image else image
+        # conversion to L by Pillow itself, in strips of the image such that
+        # only the final image is allocated at full size
+        gray_lut = self.gray_lut.tolist()
+        width, height = self.image.size
+        gray = Image.new("L", self.image.size)
+        rows = max(1, STRIP_PIXELS // width)
+        for top in range(0, height, rows):
+            box = (0, top, width, min(top + rows, height))
+            strip = self._render_luts(self.image.crop(box)).convert("L")
+            gray.paste(strip.point(gray_lut), box)
+        return gray
+
+
+def _run(image_processors, image):
+    points = None
+    for image_processor in image_processors:
+        if points is None and image.mode in ("L", "RGB"):
+            points = Points(image)
+        if points is not None:
+            result = image_processor.point(points.mode, points.histogram)
+            if result is not None and points.apply(*result):
+                if image_processor.finish is not None:
+                    image = image_processor.finish(points.render())
+                    points = None
+                continue
+            image = points.render()
+            points = None
+        image = image_processor.per_image(image)
+    return image if points is None else points.render()
+
+
+def fuse(image_processors):
+    """Replace runs of consecutive point operations (see `point`) by single
+    per-image processors applying them in a single pass."""
+    fused = []
+    run = []
+    for image_processor in list(image_processors) + [None]:
+        if hasattr(image_processor, "point") and hasattr(image_processor, "per_image"):
+            run.append(image_processor)
+            continue
+        if len(run) > 1:
+            fused.append(_fused(run))
+        else:
+            fused.extend(run)
+        run = []
+        if image_processor is not None:
+            fused.append(image_processor)
+    return fused
+
+
+def _fused(image_processors):
+    def _run_fused(image):
+        return _run(image_processors, image)
+
+    def _process(images):
+        for info, image in images:
+            yield info, _run_fused(image)
+
+    _process.__name__ = "+".join(p.__name__ for p in image_processors)
+    _process.per_image = _run_fused
+    _process.fused = image_processors
+    return resolution()(_process)
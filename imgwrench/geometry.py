@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""Fusion of consecutive geometric operations into a single resampling."""
+
+from PIL import Image
+
+from .stages import resolution
+
+# key of image info holding a transposition not yet applied to the image
+PENDING_TRANSPOSE = "imgwrench.transpose"
+
+CROP = "crop"
+TRANSPOSE = "transpose"
+RESIZE = "resize"
+FRAME = "frame"
+
+_SWAPPING = {Image.ROTATE_90, Image.ROTATE_270, Image.TRANSPOSE, Image.TRANSVERSE}
+
+# images resampled by `resample` are reduced by an integer factor first as
+# long as they stay this many times larger than the target size
+REDUCING_GAP = 3.0
+
+
+def geometric(transform, resampling=False):
+    """Decorator declaring that a per-image processor (see
+    `imgwrench.stages.per_image`) is a geometric operation, which allows
+    fusing consecutive geometric operations into a single resampling.
+
+    transform(size) returns the list of primitive operations the processor
+    applies to an image of the given size, each one of (CROP, box),
+    (TRANSPOSE, method), (RESIZE, size) using Lanczos resampling or
+    (FRAME, frame_pixels, color). Results must be identical to those of
+    the unfused processor when applying the operations one by one.
+    resampling declares that the processor may return RESIZE operations,
+    otherwise it can be applied to parts of images (see `imgwrench.strips`)."""
+
+    def _decorate(image_processor):
+        image_processor.geometry = transform
+        image_processor.resampling = resampling
+        return image_processor
+
+    return _decorate
+
+
+def defer_transpose(image, method):
+    """Mark image to be transposed by method later on, by the geometric
+    operations fused at the start of a pipeline."""
+    image.info[PENDING_TRANSPOSE] = method
+    return image
+
+
+def transposed_size(size, method):
+    """Size of an image of the given size after transposing it by method"""
+    return (size[1], size[0]) if method in _SWAPPING else size
+
+
+def untranspose_box(box, size, method):
+    """Box in a transposed image mapped to the box it covers in the
+    image of the given size before transposing it by method"""
+    left, upper, right, lower = box
+    width, height = size
+    if method == Image.FLIP_LEFT_RIGHT:
+        return width - right, upper, width - left, lower
+    if method == Image.FLIP_TOP_BOTTOM:
+        return left, height - lower, right, height - upper
+    if method == Image.ROTATE_90:
+        return width - lower, left, width - upper, right
+    if method == Image.ROTATE_180:
+        return width - right, height - lower, width - left, height - upper
+    if method == Image.ROTATE_270:
+        return upper, height - right, lower, height - left
+    raise NotImplementedError("transpose method {}".format(method))
+
+
+def resample(image, size, box=None, method=None, exact=False, resampling=Image.LANCZOS):
+    """Image transposed by method (if given), cropped to box (left, upper,
+    right, lower; by default all of it) and resampled to size in a single
+    call: the box is resampled from the source image without copying it,
+    reducing large images by an integer factor first (see `REDUCING_GAP`),
+    and only the result is transposed. If exact is set, the operations are
+    applied one after another instead, giving bit-identical results."""
+    if box is None:
+        box = (0, 0) + transposed_size(image.size, method)
+    if exact:
+        if method is not None:
+            image = image.transpose(method)
+        if box != (0, 0) + image.size:
+            image = image.crop(box)
+        return image.resize(size, resampling)
+    if method is None:
+        return image.resize(size, resampling, box=box, reducing_gap=REDUCING_GAP)
+    box = untranspose_box(box, image.size, method)
+    size = transposed_size(size, method)
+    image = image.resize(size, resampling, box=box, reducing_gap=REDUCING_GAP)
+    return image.transpose(method)
+
+
+def resamples(image_processor):
+    """Decorator declaring that an image processor resamples images by
+    `resample`, giving bit-identical results if its exact attribute is set
+    (by the pipeline, see `imgwrench.cli`)."""
+    image_processor.exact = False
+    return image_processor
+
+
+class _Geometry:
+    """Geometric operations applied to an image so far, not yet rendered:
+    crop box in the image, resampled size, transpositions and frames"""
+
+    def __init__(self, image, exact):
+        self.exact = exact
+        self.image = image
+        self.box = (0, 0) + image.size
+        self.resampled = None
+        self.transpositions = []
+        self.frames = []
+        pending = image.info.get(PENDING_TRANSPOSE)
+        if pending is not None:
+            self.transpositions.append(pending)
+
+    def _content_size(self):
+        """Size of the image content before transpositions"""
+        if self.resampled is not None:
+            return self.resampled
+        left, upper, right, lower = self.box
+        return right - left, lower - upper
+
+    def _sizes(self):
+        """Sizes of the image content before every transposition"""
+        sizes = [self._content_size()]
+        for method in self.transpositions:
+            sizes.append(transposed_size(sizes[-1], method))
+        return sizes
+
+    @property
+    def size(self):
+        """Size of the image with all operations applied"""
+        width, height = self._sizes()[-1]
+        frame_pixels = sum(frame[0] for frame in self.frames)
+        return width + 2 * frame_pixels, height + 2 * frame_pixels
+
+    def apply(self, operation):
+        """Apply a primitive operation, returning False if this is not possible"""
+        kind = operation[0]
+        if kind == TRANSPOSE:
+            # frames are symmetric and can be transposed along with the image
+            self.transpositions.append(operation[1])
+            return True
+        if kind == FRAME:
+            self.frames.append(operation[1:])
+            return True
+        if self.frames:
+            return False
+        # resampling commutes with neither cropping nor transpositions bit by bit
+        if self.exact and self.resampled is not None:
+            return False
+        if kind == RESIZE:
+            if self.exact and self.transpositions:
+                return False
+            size = operation[1]
+            for method in self.transpositions:
+                size = transposed_size(size, method)
+            self.resampled = size
+            return True
+        if kind == CROP:
+            box = operation[1]
+            sizes = self._sizes()
+            for method, size in zip(
+                reversed(self.transpositions), reversed(sizes[:-1])
+            ):
+                box = untranspose_box(box, size, method)
+            left, upper, right, lower = self.box
+            scale_x, scale_y = 1, 1
+            if self.resampled is not None:
+                scale_x = (right - left) / self.resampled[0]
+                scale_y = (lower - upper) / self.resampled[1]
+                self.resampled = box[2] - box[0], box[3] - box[1]
+            self.box = (
+                left + box[0] * scale_x,
+                upper + box[1] * scale_y,
+                left + box[2] * scale_x,
+                upper + box[3] * scale_y,
+            )
+            return True
+        raise NotImplementedError("geometric operation {}".format(kind))
+
+    def render(self):
+        """Image with all operations applied"""
+        image = self.image
+        if self.resampled is not None:
+            image = resample(image, self.resampled, self.box, exact=self.exact)
+        elif self.box != (0, 0) + image.size:
+            image = image.crop(self.box)
+        for method in self.transpositions:
+            image = image.transpose(method)
+        if self.frames:
+            # paint frames from outside in, then paste the image
+            frames = list(reversed(self.frames))
+            canvas = Image.new("RGB", self.size, frames[0][1])
+            offset = frames[0][0]
+            for frame_pixels, color in frames[1:]:
+                inner = canvas.size[0] - offset, canvas.size[1] - offset
+                canvas.paste(color, (offset, offset) + inner)
+                offset += frame_pixels
+            canvas.paste(image, (offset, offset))
+            image = canvas
+        image.info.pop(PENDING_TRANSPOSE, None)
+        return image
+
+
+def _run(image_processors, image, exact):
+    geometry = _Geometry(image, exact)
+    for image_processor in image_processors:
+        for operation in image_processor.geometry(geometry.size):
+            if not geometry.apply(operation):
+                geometry = _Geometry(geometry.render(), exact)
+                geometry.apply(operation)
+    return geometry.render()
+
+
+def fuse_geometric(image_processors, exact=False):
+    """Replace runs of consecutive geometric operations (see `geometric`)
+    by single per-image processors resampling images at most once.
+
+    A run at the start of the pipeline is replaced even if it consists of
+    a single processor; it applies transpositions deferred while loading
+    images (see `defer_transpose` and `defers_transpose`). If exact is
+    set, only operations are fused which give bit-identical results;
+    otherwise, consecutive crops and resizes are combined into a single
+    resampling of the source image."""
+    fused = []
+    run = []
+    for image_processor in list(image_processors) + [None]:
+        if hasattr(image_processor, "geometry") and hasattr(
+            image_processor, "per_image"
+        ):
+            run.append(image_processor)
+            continue
+        if len(run) > 1 or (run and not fused):
+            fused.append(_fused(run, exact))
+        else:
+            fused.extend(run)
+        run = []
+        if image_processor is not None:
+            fused.append(image_processor)
+    return fused
+
+
+def defers_transpose(image_processors):
+    """True if the first of image_processors applies transpositions
+    deferred while loading images"""
+    return bool(image_processors) and hasattr(image_processors[0], "geometry_fused")
+
+
+def _fused(image_processors, exact):
+    def _run_fused(image):
+        return _run(image_processors, image, exact)
+
+    def _process(images):
+        for info, image in images:
+            yield info, _run_fused(image)
+
+    _process.__name__ = "+".join(p.__name__ for p in image_processors)
+    _process.per_image = _run_fused
+    _process.fused = image_processors
+    _process.geometry_fused = True
+    return resolution()(_process)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental pipeline execution skipping up-to-date output images."""
+
+import hashlib
+import json
+import os
+
+MANIFEST = ".imgwrench-manifest.json"
+
+
+def _digest(*parts):
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def source_key(path):
+    """Key of a source image file, changing whenever the file changes."""
+    stat = os.stat(path)
+    return _digest(str(path), stat.st_size, stat.st_mtime_ns)
+
+
+class Output:
+    """Output image of a planned pipeline: its key and the positions
+    of all source images it is made of."""
+
+    def __init__(self, key, positions):
+        self.key = key
+        self.positions = positions
+
+    @property
+    def first(self):
+        return min(self.positions)
+
+    @property
+    def last(self):
+        return max(self.positions)
+
+
+def plan(image_processors, sources, settings):
+    """Plan which output images a pipeline will produce from sources, a list
+    of (index, path) tuples, without processing any image. Every output is
+    keyed by its sources, the parameters of all image processors and the
+    given settings. Returns None if an image processor does not declare its
+    parameters or how it combines images (see `imgwrench.stages`)."""
+    items = [
+        (source_key(path), [position], index)
+        for position, (index, path) in enumerate(sources)
+    ]
+    for image_processor in image_processors:
+        params = getattr(image_processor, "params", None)
+        if params is None:
+            return None
+        if hasattr(image_processor, "per_image"):
+            items = [
+                (_digest(params, key), positions, index)
+                for key, positions, index in items
+            ]
+            continue
+        groups = getattr(image_processor, "groups", None)
+        if groups is None:
+            return None
+        grouped = []
+        for group in groups([index for _, _, index in items]):
+            if None in group:
+                return None
+            key = _digest(params, *[items[position][0] for position in group])
+            positions = [p for position in group for p in items[position][1]]
+            grouped.append((key, positions, items[group[0]][2]))
+        items = grouped
+    return [Output(_digest(settings, key), positions) for key, positions, _ in items]
+
+
+def stale_runs(outputs, is_stale):
+    """Runs of consecutive outputs for which is_stale(number, output) holds,
+    as (first output number, last output number, first source position,
+    last source position). Outputs sharing source images with a stale output
+    are processed along with it, as they are made of the same input images."""
+    runs = []
+    for i, output in enumerate(outputs):
+        shared = runs and runs[-1][1] == i - 1 and output.first <= runs[-1][3]
+        if not shared and not is_stale(i, output):
+            continue
+        first, first_position = i, output.first
+        while first > 0 and outputs[first - 1].last >= first_position:
+            first -= 1
+            first_position = min(first_position, outputs[first].first)
+        if runs and runs[-1][1] >= first - 1:
+            runs[-1][1] = i
+            runs[-1][3] = max(runs[-1][3], output.last)
+        else:
+            runs.append([first, i, first_position, output.last])
+    return [tuple(run) for run in runs]
+
+
+def load_manifest(outdir):
+    """Keys of output images written by earlier runs in outdir."""
+    try:
+        with open(os.path.join(outdir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(outdir, manifest):
+    """Save keys of output images written to outdir."""
+    path = os.path.join(outdir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+"""Images whose pixel data is decoded only when required."""
+
+
+class LazyImage:
+    """Stand-in for an image of known size whose pixel data
+    is decoded only when calling `open`."""
+
+    def __init__(self, size, load):
+        self.size = size
+        self._load = load
+
+    def open(self, size=None):
+        """Decode the image; if size (width, height) is given, the image
+        may be decoded at reduced resolution still covering size."""
+        return self._load(size)
+
+
+def materialize(image, size=None):
+    """PIL image from either a PIL image or a `LazyImage`."""
+    if isinstance(image, LazyImage):
+        return image.open(size)
+    return image
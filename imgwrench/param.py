@@ -21,7 +21,7 @@ class Color(click.ParamType):
 
 
 class Ratio(click.ParamType):
-    """Parameter type representing a ratio or rational number"""
+    """Parameter type representing a ratio (3:2 or 1/8) or rational number"""
 
     name = "ratio"
 
@@ -31,7 +31,7 @@ class Ratio(click.ParamType):
             # https://github.com/pallets/click/issues/1898
             return value
         try:
-            a, b = value.split(":")
+            a, b = value.replace("/", ":").split(":")
             a, b = float(a), float(b)
             ratio = a / b
         except ValueError:
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""Timing of pipeline stages."""
+
+import json
+import threading
+import time
+from functools import wraps
+
+
+def _percentile(values, p):
+    """Nearest-rank percentile p (0 to 100) of a non-empty list of values."""
+    values = sorted(values)
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def _pixels(image):
+    size = getattr(image, "size", None)
+    return size[0] * size[1] if size else 0
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.latencies = []
+        self.pixels = 0
+
+    def report(self):
+        latencies = self.latencies or [0.0]
+        return {
+            "name": self.name,
+            "images": len(self.latencies),
+            "wall_seconds": self.wall,
+            "cpu_seconds": self.cpu,
+            "latency_seconds": {
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+                "max": max(latencies),
+            },
+            "pixels": self.pixels,
+            "pixels_per_second": self.pixels / self.wall if self.wall else None,
+        }
+
+
+class Profile:
+    """Wall and CPU time spent by the stages of a pipeline.
+
+    Stages are either iterators of (info, image) tuples (see `iterate`)
+    or functions called once per image (see `timed`). Time spent by an
+    iterator waiting for its upstream iterator is not counted for it.
+    CPU time is the time of the measuring thread; work done in worker
+    processes only shows up as wall time of the stage waiting for it."""
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.perf_counter(), time.process_time()
+        self.bytes_written = 0
+
+    def _record(self, name, wall, cpu, image=None):
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = _Stage(name)
+            stage.wall += wall
+            stage.cpu += cpu
+            if image is not None:
+                stage.latencies.append(wall)
+                stage.pixels += _pixels(image)
+
+    def iterate(self, name, images):
+        """Yield from images, timing every step as stage name."""
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        images = iter(images)
+        while True:
+            # wall and CPU time of nested stages
+            nested = [0.0, 0.0]
+            stack.append(nested)
+            wall, cpu = time.perf_counter(), time.thread_time()
+            item = None
+            try:
+                item = next(images, None)
+            finally:
+                stack.pop()
+                wall = time.perf_counter() - wall
+                cpu = time.thread_time() - cpu
+                if stack:
+                    stack[-1][0] += wall
+                    stack[-1][1] += cpu
+                image = None if item is None else item[1]
+                self._record(name, wall - nested[0], cpu - nested[1], image)
+            if item is None:
+                return
+            yield item
+
+    def timed(self, name, func):
+        """Wrap func, taking an image as its first argument, timing every
+        call as stage name."""
+
+        @wraps(func)
+        def _timed(image, *args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return func(image, *args, **kwargs)
+            finally:
+                wall = time.perf_counter() - wall
+                cpu = time.thread_time() - cpu
+                self._record(name, wall, cpu, image)
+
+        return _timed
+
+    def report(self):
+        """Report of all stages in order of their first appearance."""
+        wall = time.perf_counter() - self._start[0]
+        cpu = time.process_time() - self._start[1]
+        with self._lock:
+            stages = [stage.report() for stage in self._stages.values()]
+        return {
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "bytes_written": self.bytes_written,
+            "stages": stages,
+        }
+
+    def save(self, path):
+        """Write the report as JSON to path."""
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""Connecting image processors to a processing pipeline."""
+
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, wraps
+
+import click
+
+
+def _subcommand_params():
+    """Name and parameters of the subcommand currently creating
+    an image processor, if any."""
+    ctx = click.get_current_context(silent=True)
+    if ctx is not None:
+        return ctx.info_name, sorted(ctx.params.items())
+
+
+def per_image(func):
+    """Turn a function processing a single image into an image processor.
+
+    Image processors created this way do not depend on any other image
+    of the pipeline, which allows them to be executed in parallel."""
+
+    @wraps(func)
+    def _process(images):
+        for info, image in images:
+            yield info, func(image)
+
+    _process.per_image = func
+    _process.params = _subcommand_params()
+    return _process
+
+
+def chunks(size=None):
+    """Grouping of consecutive input images into chunks of the given size
+    (all images if size is None) for use with `aggregate`."""
+
+    def _groups(indices):
+        n = len(indices)
+        step = size or n
+        return [list(range(i, min(i + step, n))) for i in range(0, n, step)]
+
+    return _groups
+
+
+def rolls(size=None):
+    """Grouping of every input image with all images of its chunk of the
+    given size (all images if size is None) for use with `aggregate`, for
+    image processors producing one output image per input image from the
+    combined chunk."""
+    chunk_groups = chunks(size)
+
+    def _groups(indices):
+        return [
+            [i] + [j for j in chunk if j != i]
+            for chunk in chunk_groups(indices)
+            for i in chunk
+        ]
+
+    return _groups
+
+
+def aggregate(groups):
+    """Decorator declaring how an image processor combines input images.
+
+    groups(indices) takes the image indices (see `imgwrench.info.ImageInfo`)
+    of all input images and returns a list containing, for every output
+    image, the list of positions of the input images it is made of."""
+
+    def _decorate(image_processor):
+        image_processor.groups = groups
+        image_processor.params = _subcommand_params()
+        return image_processor
+
+    return _decorate
+
+
+def lazy_input(image_processor):
+    """Decorator declaring that an image processor accepts instances of
+    `imgwrench.lazy.LazyImage` as input images, i.e. it only needs the
+    sizes of its images until it decodes them one by one."""
+    image_processor.lazy_input = True
+    return image_processor
+
+
+def _same_size(size):
+    return size
+
+
+def _same_scale(size, scale):
+    return scale
+
+
+def full_resolution(size, scale):
+    """input_scale (see `resolution`) of image processors requiring their
+    input images at full resolution, e.g. as they compute statistics of
+    pixel values which are changed by decoding at reduced resolution."""
+    return 1.0
+
+
+def resolution(output_size=_same_size, input_scale=_same_scale):
+    """Decorator declaring how an image processor changes image sizes and
+    which resolution it requires from its input images.
+
+    output_size(size) returns the size of an output image given the size
+    of an input image, or None if it cannot be known in advance.
+    input_scale(size, scale) returns the factor (at most 1) by which an
+    input image of the given size may be scaled down, given the factor
+    by which the output of the processor may be scaled down.
+    The defaults describe processors that keep image sizes and work at
+    any resolution. Undeclared processors require full resolution."""
+
+    def _decorate(image_processor):
+        image_processor.output_size = output_size
+        image_processor.input_scale = input_scale
+        return image_processor
+
+    return _decorate
+
+
+def _planned_sizes(image_processors, size):
+    sizes = [size]
+    for image_processor in image_processors:
+        output_size = getattr(image_processor, "output_size", None)
+        if output_size is None or sizes[-1] is None:
+            sizes.append(None)
+        else:
+            sizes.append(output_size(sizes[-1]))
+    return sizes
+
+
+def planned_size(image_processors, size):
+    """Size of the output images of image processors given the size of a
+    source image; if it cannot be known in advance, the last size known in
+    the pipeline (at the latest the size of the source image itself).
+    A source image may be scaled down (see `input_scale`) only if this
+    does not change the planned size, as crop boxes and resized sizes are
+    rounded at the reduced resolution."""
+    return [s for s in _planned_sizes(image_processors, size) if s is not None][-1]
+
+
+def input_scale(image_processors, size):
+    """Factor (at most 1) by which a source image of the given size may be
+    scaled down without losing resolution required by image processors."""
+    sizes = _planned_sizes(image_processors, size)
+    scale = 1.0
+    for image_processor, size in reversed(list(zip(image_processors, sizes))):
+        processor_scale = getattr(image_processor, "input_scale", None)
+        if processor_scale is None or size is None:
+            scale = 1.0
+        else:
+            scale = min(processor_scale(size, scale), 1.0)
+    return scale
+
+
+def bounded_map(executor, fn, iterable, window):
+    """Map fn over iterable using executor, yielding results in order.
+    At most window items are submitted but not yet yielded at any time,
+    so the iterable is consumed only as fast as results are requested."""
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def read_ahead(fn, iterable, depth):
+    """Map fn over iterable in depth background threads, yielding results
+    in order. At most depth results are computed ahead of the consumer;
+    a depth smaller than one maps lazily in the calling thread."""
+    if depth < 1:
+        yield from map(fn, iterable)
+        return
+    with ThreadPoolExecutor(depth) as executor:
+        yield from bounded_map(executor, fn, iterable, depth)
+
+
+def _links(image_processors):
+    """Group consecutive per-image processors into lists;
+    aggregate processors are passed through unchanged."""
+    chain = []
+    for image_processor in image_processors:
+        if not hasattr(image_processor, "per_image"):
+            if chain:
+                yield chain
+                chain = []
+            yield image_processor
+        else:
+            chain.append(image_processor)
+    if chain:
+        yield chain
+
+
+_worker_chains = None
+
+
+def _init_worker(chains):
+    global _worker_chains
+    _worker_chains = chains
+
+
+def _run_chain(chain_index, item):
+    info, image = item
+    for func in _worker_chains[chain_index]:
+        image = func(image)
+    return info, image
+
+
+def _shutdown_after(images, executor):
+    try:
+        yield from images
+    finally:
+        executor.shutdown()
+
+
+def can_fork():
+    """True if worker processes can be forked on this platform."""
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def _no_wrap(image_processors, images):
+    return images
+
+
+def _chains(links):
+    return [
+        [image_processor.per_image for image_processor in link]
+        for link in links
+        if isinstance(link, list)
+    ]
+
+
+def worker_pool(image_processors, jobs):
+    """Pool of jobs worker processes executing the per-image processors
+    of a pipeline (see `connect`), or None if no pool is required.
+    The pool must be created before the pipeline spawns any threads
+    and is shut down by the caller."""
+    chains = _chains(_links(image_processors))
+    if jobs <= 1 or not chains or not can_fork():
+        return None
+    # processors are closures which cannot be pickled; forking the
+    # worker processes makes them available without pickling
+    executor = ProcessPoolExecutor(
+        jobs,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(chains,),
+    )
+    # start workers right away, before the pipeline spawns any threads
+    executor.submit(int).result()
+    return executor
+
+
+def connect(images, image_processors, jobs=1, wrap=_no_wrap, executor=None):
+    """Connect image processors to a pipeline fed by images.
+
+    If jobs is larger than one, consecutive per-image processors are
+    executed in a pool of jobs worker processes. Results are passed on
+    in input order, so aggregate processors (e.g. collage or grid) see
+    exactly the same sequence of images as in a serial run.
+    executor may be a pool created by `worker_pool` for the same image
+    processors, shared by several pipelines and left running.
+    wrap(processors, images) may wrap the output images of every stage,
+    i.e. of a single processor or of a chain executed by the workers."""
+    shared = executor is not None
+    if not shared:
+        executor = worker_pool(image_processors, jobs)
+    if executor is None:
+        for image_processor in image_processors:
+            images = wrap([image_processor], image_processor(images))
+        return images
+    chain_index = 0
+    for link in _links(image_processors):
+        if isinstance(link, list):
+            run_chain = partial(_run_chain, chain_index)
+            images = bounded_map(executor, run_chain, images, 2 * jobs)
+            images = wrap(link, images)
+            chain_index += 1
+        else:
+            images = wrap([link], link(images))
+    return images if shared else _shutdown_after(images, executor)
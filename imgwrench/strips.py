@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+"""Processing of images in horizontal strips of bounded height."""
+
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from .fusion import STRIP_PIXELS, Points
+from .geometry import (
+    CROP,
+    FRAME,
+    PENDING_TRANSPOSE,
+    TRANSPOSE,
+    transposed_size,
+    untranspose_box,
+)
+from .stages import resolution
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# modes written by `save_png` and their PNG color types
+PNG_COLOR_TYPES = {"L": 0, "RGB": 2}
+
+
+def is_local(image_processor):
+    """True if an image processor can be applied strip by strip, i.e. it is
+    a point operation (see `imgwrench.fusion.point`) without a finishing
+    step or a geometric operation without resampling (see
+    `imgwrench.geometry.geometric`)."""
+    if not hasattr(image_processor, "per_image"):
+        return False
+    if hasattr(image_processor, "point"):
+        return image_processor.finish is None
+    if hasattr(image_processor, "geometry"):
+        return not image_processor.resampling
+    return False
+
+
+def _strip_boxes(size, rows):
+    width, height = size
+    for upper in range(0, height, rows):
+        yield 0, upper, width, min(upper + rows, height)
+
+
+class _Source:
+    """Image at the start of a chain of strip operations"""
+
+    def __init__(self, image):
+        self.image = image
+        self.size = image.size
+        self.mode = image.mode
+
+    def region(self, box):
+        return self.image.crop(box)
+
+
+class _PointRegions:
+    """Point operations applied to regions of an upstream operation"""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.size = upstream.size
+        self.mode = upstream.mode
+        self.operations = []
+
+    def apply(self, mode, luts):
+        self.operations.append((mode, luts))
+        self.mode = "L" if luts is None else mode
+
+    def region(self, box):
+        points = Points(self.upstream.region(box))
+        for operation in self.operations:
+            if not points.apply(*operation):
+                points = Points(points.render())
+                points.apply(*operation)
+        return points.render()
+
+
+class _Geometry:
+    """Crop, transpositions and frames applied to regions of an upstream
+    operation"""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.mode = upstream.mode
+        self.box = (0, 0) + upstream.size
+        self.transpositions = []
+        self.frames = []
+
+    def _sizes(self):
+        """Sizes of the cropped image before every transposition"""
+        left, upper, right, lower = self.box
+        sizes = [(right - left, lower - upper)]
+        for method in self.transpositions:
+            sizes.append(transposed_size(sizes[-1], method))
+        return sizes
+
+    @property
+    def size(self):
+        width, height = self._sizes()[-1]
+        frame_pixels = sum(frame[0] for frame in self.frames)
+        return width + 2 * frame_pixels, height + 2 * frame_pixels
+
+    def _source_box(self, box):
+        """Box in the upstream image covered by a box in the cropped and
+        transposed image"""
+        sizes = self._sizes()
+        for method, size in zip(reversed(self.transpositions), reversed(sizes[:-1])):
+            box = untranspose_box(box, size, method)
+        left, upper = self.box[:2]
+        return left + box[0], upper + box[1], left + box[2], upper + box[3]
+
+    def apply(self, operation):
+        """Apply a primitive operation, returning False if this is not possible"""
+        kind = operation[0]
+        if kind == TRANSPOSE:
+            self.transpositions.append(operation[1])
+        elif kind == FRAME:
+            self.frames.append(operation[1:])
+            self.mode = "RGB"
+        elif kind == CROP and not self.frames:
+            self.box = self._source_box(operation[1])
+        else:
+            return False
+        return True
+
+    def region(self, box):
+        left, upper, right, lower = box
+        offset = sum(frame[0] for frame in self.frames)
+        width, height = self._sizes()[-1]
+        inner = (
+            max(left, offset),
+            max(upper, offset),
+            min(right, offset + width),
+            min(lower, offset + height),
+        )
+        content = None
+        if inner[0] < inner[2] and inner[1] < inner[3]:
+            content_box = tuple(value - offset for value in inner)
+            content = self.upstream.region(self._source_box(content_box))
+            for method in self.transpositions:
+                content = content.transpose(method)
+        if not self.frames:
+            return content
+        # paint the frames intersecting the region from outside in
+        frames = list(reversed(self.frames))
+        region = Image.new("RGB", (right - left, lower - upper), frames[0][1])
+        full_width, full_height = self.size
+        frame_offset = frames[0][0]
+        for frame_pixels, color in frames[1:]:
+            frame_box = (
+                max(left, frame_offset) - left,
+                max(upper, frame_offset) - upper,
+                min(right, full_width - frame_offset) - left,
+                min(lower, full_height - frame_offset) - upper,
+            )
+            if frame_box[0] < frame_box[2] and frame_box[1] < frame_box[3]:
+                region.paste(color, frame_box)
+            frame_offset += frame_pixels
+        if content is not None:
+            region.paste(content, (inner[0] - left, inner[1] - upper))
+        return region
+
+
+class StripImage:
+    """Stand-in for the result of local operations on an image, which is
+    computed in horizontal strips of at most rows rows (see `strips`), such
+    that only a single strip is held in memory at a time."""
+
+    def __init__(self, operation, rows):
+        self._operation = operation
+        self.rows = rows
+        self.size = operation.size
+        self.mode = operation.mode
+
+    def strips(self):
+        """Yield boxes of all strips from top to bottom with their pixels."""
+        for box in _strip_boxes(self.size, self.rows):
+            yield box, self._operation.region(box)
+
+    def render(self):
+        """Compute the whole image."""
+        image = Image.new(self.mode, self.size)
+        for box, strip in self.strips():
+            image.paste(strip, box)
+        return image
+
+
+def _histogram(operation, rows, func):
+    """Histograms computed by func summed over all strips of an operation,
+    e.g. `imgwrench.commands.colorfix.histogram` of the whole image"""
+    total = 0
+    for box in _strip_boxes(operation.size, rows):
+        total = total + func(operation.region(box))
+    return total
+
+
+def _plan(image_processors, image, rows):
+    operation = _Source(image)
+    pending = image.info.get(PENDING_TRANSPOSE)
+    if pending is not None:
+        operation = _Geometry(operation)
+        operation.apply((TRANSPOSE, pending))
+    for image_processor in image_processors:
+        if hasattr(image_processor, "point"):
+            result = image_processor.point(
+                operation.mode, lambda func: _histogram(operation, rows, func)
+            )
+            if result is None:
+                # not a point operation for this mode, apply it as usual
+                image = StripImage(operation, rows).render()
+                operation = _Source(image_processor.per_image(image))
+                continue
+            if not isinstance(operation, _PointRegions):
+                operation = _PointRegions(operation)
+            operation.apply(*result)
+            continue
+        for primitive in image_processor.geometry(operation.size):
+            if not isinstance(operation, _Geometry) or not operation.apply(primitive):
+                operation = _Geometry(operation)
+                operation.apply(primitive)
+    return StripImage(operation, rows)
+
+
+def fuse_strips(image_processors, rows):
+    """Single per-image processor applying local image processors (see
+    `is_local`) in horizontal strips of at most rows rows. It yields
+    instances of `StripImage`, so it must end the pipeline; the strips are
+    computed while saving images. Transpositions deferred while loading
+    images are applied (see `imgwrench.geometry.defer_transpose`).
+
+    Histograms of point operations are summed over all strips, so they must
+    be additive (e.g. `imgwrench.commands.colorfix.histogram` of sampled
+    pixels is estimated from samples of every strip)."""
+
+    def _run_strips(image):
+        return _plan(image_processors, image, rows)
+
+    def _process(images):
+        for info, image in images:
+            yield info, _run_strips(image)
+
+    _process.__name__ = "+".join(p.__name__ for p in image_processors)
+    _process.per_image = _run_strips
+    _process.fused = image_processors
+    _process.geometry_fused = True
+    return resolution()(_process)
+
+
+def _png_chunk(f, chunk_type, data):
+    f.write(struct.pack(">I", len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def _paeth(rows, previous, bands):
+    """Rows of 8 bit samples filtered by the PNG Paeth filter and prefixed
+    by its filter type, given the (unfiltered) row above them"""
+    raw = rows.astype(np.int16)
+    up = np.vstack([previous[np.newaxis].astype(np.int16), raw[:-1]])
+    left = np.zeros_like(raw)
+    left[:, bands:] = raw[:, :-bands]
+    upper_left = np.zeros_like(raw)
+    upper_left[:, bands:] = up[:, :-bands]
+    estimate = left + up - upper_left
+    distance_left = np.abs(estimate - left)
+    distance_up = np.abs(estimate - up)
+    distance_upper_left = np.abs(estimate - upper_left)
+    predictor = np.where(
+        (distance_left <= distance_up) & (distance_left <= distance_upper_left),
+        left,
+        np.where(distance_up <= distance_upper_left, up, upper_left),
+    )
+    filtered = (raw - predictor).astype(np.uint8)
+    filter_types = np.full((len(rows), 1), 4, dtype=np.uint8)
+    return np.hstack([filter_types, filtered])
+
+
+def save_png(image, path, exif=None, compress_level=6):
+    """Write a `StripImage` of mode L or RGB as PNG strip by strip, so
+    the whole image is never held in memory; exif is written as eXIf
+    chunk if given."""
+    width, height = image.size
+    bands = len(image.mode)
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        header = struct.pack(
+            ">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[image.mode], 0, 0, 0
+        )
+        _png_chunk(f, b"IHDR", header)
+        if exif:
+            if exif.startswith(b"Exif\x00\x00"):
+                exif = exif[6:]
+            _png_chunk(f, b"eXIf", exif)
+        compressor = zlib.compressobj(compress_level)
+        previous = np.zeros(width * bands, dtype=np.uint8)
+        # rows filtered at once, bounding the memory of filtering large strips
+        n_rows = max(1, STRIP_PIXELS // width)
+        for _, strip in image.strips():
+            # np.asarray of images leaks their data with some versions of
+            # Pillow and numpy, which would defeat streaming
+            strip_rows = np.frombuffer(strip.tobytes(), dtype=np.uint8).reshape(
+                strip.size[1], width * bands
+            )
+            for upper in range(0, len(strip_rows), n_rows):
+                rows = strip_rows[upper : upper + n_rows]
+                data = compressor.compress(_paeth(rows, previous, bands).tobytes())
+                previous = rows[-1]
+                if data:
+                    _png_chunk(f, b"IDAT", data)
+        _png_chunk(f, b"IDAT", compressor.flush())
+        _png_chunk(f, b"IEND", b"")
+    return path
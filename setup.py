@@ -34,6 +34,7 @@ setup(
     entry_points={
         "console_scripts": [
             "imgwrench=imgwrench:cli_imgwrench",
+            "imgwrench-bench=imgwrench.bench:cli_bench",
         ],
     },
     install_requires=requirements,
@@ -0,0 +1,109 @@
+"""Tests for the benchmark suite."""
+
+import json
+import os
+import unittest
+
+from click.testing import CliRunner
+from PIL import Image
+
+from imgwrench import cli
+from imgwrench.bench import (
+    case_name,
+    cli_bench,
+    compare,
+    run_case,
+    synthetic_image,
+    write_image,
+)
+
+
+class TestBench(unittest.TestCase):
+    """Tests for the benchmark suite."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.runner = CliRunner()
+
+    def test_synthetic_image(self):
+        """Test size and orientation of synthetic images."""
+        img = synthetic_image(0.06)
+        self.assertEqual((300, 200), img.size)
+        self.assertEqual("RGB", img.mode)
+        with self.runner.isolated_filesystem():
+            write_image("rotated.jpg", 0.06, True)
+            with Image.open("rotated.jpg") as img:
+                self.assertEqual(6, img.getexif()[0x0112])
+
+    def test_compare(self):
+        """Test detection of regressions."""
+        baseline = {"a": {"median_seconds": 1.0}, "b": {"median_seconds": 1.0}}
+        results = {
+            "a": {"median_seconds": 1.05},
+            "b": {"median_seconds": 1.5},
+            "c": {"median_seconds": 9.0},
+        }
+        self.assertEqual([("b", 1.5)], compare(results, baseline, 0.1))
+        self.assertEqual([], compare(results, baseline, 0.6))
+        self.assertEqual(
+            "grid -r 2 @ 12MP rotated", case_name(["grid", "-r", "2"], 12, True)
+        )
+
+    def test_run_case(self):
+        """Test decoding every copy of the image of a benchmark case."""
+        caches = []
+        decode_cache = cli.DecodeCache
+
+        def _decode_cache(*args, **kwargs):
+            caches.append(decode_cache(*args, **kwargs))
+            return caches[-1]
+
+        with self.runner.isolated_filesystem():
+            write_image("bench.jpg", 0.01, False)
+            cli.DecodeCache = _decode_cache
+            try:
+                timings = run_case(os.path.abspath("bench.jpg"), ["save"], 3, 2, ".")
+            finally:
+                cli.DecodeCache = decode_cache
+            self.assertEqual(2, len(timings))
+            self.assertEqual([], caches)
+            self.assertTrue(os.path.exists("img_0002.jpg"))
+
+    def test_command_line_interface(self):
+        """Test writing and comparing against baselines."""
+        with self.runner.isolated_filesystem():
+            args = ["-s", "0.01", "-k", "resize", "-b", "1", "-n", "1"]
+            result = self.runner.invoke(cli_bench, args + ["-o", "base.json"])
+            self.assertEqual(0, result.exit_code, result.output)
+            with open("base.json") as f:
+                baseline = json.load(f)
+            self.assertEqual(
+                ["resize @ 0.01MP", "resize @ 0.01MP rotated"],
+                sorted(baseline["results"]),
+            )
+            for result in baseline["results"].values():
+                result["median_seconds"] = 1e-9
+            with open("base.json", "w") as f:
+                json.dump(baseline, f)
+            result = self.runner.invoke(cli_bench, args + ["-c", "base.json"])
+            self.assertEqual(1, result.exit_code, result.output)
+            self.assertIn("Regression: resize @ 0.01MP", result.output)
+            self.assertFalse(os.path.exists("images.txt"))
+
+    def test_layouts(self):
+        """Test benchmarking collage layout solvers."""
+        result = self.runner.invoke(cli_bench, ["-l", "3,20", "-n", "1"])
+        self.assertEqual(0, result.exit_code, result.output)
+        for case in ["dense @ 3", "linear @ 3", "dense @ 20", "linear @ 20"]:
+            self.assertIn("bric {} images".format(case), result.output)
+        self.assertIn("score @ 20 images", result.output)
+
+    def test_composites(self):
+        """Test benchmarking resampling of composite subcommands."""
+        args = ["-m", "-s", "0.05", "-n", "1", "-k", "quad", "-k", "stack"]
+        result = self.runner.invoke(cli_bench, args)
+        self.assertEqual(0, result.exit_code, result.output)
+        for case in ["quad @ 0.05MP", "stack @ 0.05MP"]:
+            self.assertIn(case + " exact", result.output)
+            self.assertIn("Speedup: " + case, result.output)
+        self.assertNotIn("grid", result.output)
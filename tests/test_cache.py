@@ -0,0 +1,79 @@
+"""Tests for the cache of decoded images."""
+
+import threading
+import time
+import unittest
+
+from PIL import Image
+
+from imgwrench.cache import DecodeCache, image_bytes
+
+
+class TestCache(unittest.TestCase):
+    """Tests for the cache of decoded images."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.loads = []
+
+    def _loader(self, value, seconds=0):
+        def _load():
+            self.loads.append(value)
+            time.sleep(seconds)
+            return value
+
+        return _load
+
+    def test_image_bytes(self):
+        """Test memory estimation of images."""
+        self.assertEqual(600, image_bytes(Image.new("RGB", (10, 20))))
+        self.assertEqual(200, image_bytes(Image.new("L", (10, 20))))
+
+    def test_hits(self):
+        """Test that cached values are loaded only once."""
+        cache = DecodeCache(100, size=lambda value: 1)
+        self.assertEqual("a", cache.get("a", self._loader("a")))
+        self.assertEqual("a", cache.get("a", self._loader("other")))
+        self.assertEqual("b", cache.get("b", self._loader("b")))
+        self.assertEqual(["a", "b"], self.loads)
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_eviction(self):
+        """Test least recently used eviction by count and bytes."""
+        cache = DecodeCache(100, max_count=2, size=lambda value: 1)
+        for key in ["a", "b", "a", "c", "a", "b"]:
+            cache.get(key, self._loader(key))
+        self.assertEqual(["a", "b", "c", "b"], self.loads)
+        self.loads = []
+        cache = DecodeCache(10, size=len)
+        for key in ["aaaaaa", "bbbbb", "bbbbb", "aaaaaa", "ccccccccccc"]:
+            cache.get(key, self._loader(key))
+        self.assertEqual(["aaaaaa", "bbbbb", "aaaaaa", "ccccccccccc"], self.loads)
+
+    def test_errors(self):
+        """Test that failed loads are not cached."""
+        cache = DecodeCache(100, size=len)
+
+        def _fail():
+            raise OSError("broken")
+
+        with self.assertRaises(OSError):
+            cache.get("a", _fail)
+        self.assertEqual("a", cache.get("a", self._loader("a")))
+
+    def test_concurrent_loads(self):
+        """Test that concurrent requests for a key are loaded only once."""
+        cache = DecodeCache(100, size=lambda value: 1)
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(cache.get("a", self._loader("a", 0.05)))
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(["a"] * 4, results)
+        self.assertEqual(["a"], self.loads)
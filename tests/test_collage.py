@@ -6,6 +6,7 @@ from random import Random
 
 from click.testing import CliRunner
 import numpy as np
+from PIL import Image
 
 from .utils import execute_and_test_output_images
 
@@ -14,8 +15,18 @@ from imgwrench.commands.collage import (
     Row,
     Column,
     _binary_tree_recursive,
+    anneal,
+    anneal_steps,
+    best_seed,
     bric_tree,
+    collage,
+    exhaustive_tree,
+    permute_images,
+    random_tree,
+    render,
+    render_bands,
 )
+from imgwrench.lazy import LazyImage
 
 
 class MockLeaf(LayoutLeaf):
@@ -86,6 +97,31 @@ class TestCollage(unittest.TestCase):
                     leafs_set.discard(node)
             self.assertFalse(leafs_set)
 
+    def test_score(self):
+        """Test scoring layouts in a single traversal."""
+        width, height = 300, 200
+        positions = self.tree.positions(0, 0, width, height)
+        areas = [w * h / (width * height) for _, _, w, h, _ in positions]
+        self.assertEqual(areas, self.tree.relative_areas(width, height))
+        target_area = 1 / 3
+        balance_score = np.prod(np.minimum(np.array(areas) / target_area, 1)) ** (
+            target_area
+        )
+        self.assertEqual(balance_score, self.tree.balance_score(width, height))
+        cut_loss = self.tree.cut_loss(width / height) / 3
+        self.assertEqual((1 - cut_loss) * balance_score, self.tree.score(width, height))
+
+    def test_cached_metrics(self):
+        """Test metrics cached when assigning content."""
+        column = self.tree.content[0][1]
+        self.assertEqual(3, self.tree.leaf_count)
+        self.assertEqual([0.6, 0.4], [w for w, _ in self.tree.normalized_content])
+        self.tree.content = [(1, column), (1, column.content[1][1])]
+        self.assertEqual(3, self.tree.leaf_count)
+        self.assertEqual([0.5, 0.5], [w for w, _ in self.tree.normalized_content])
+        with self.assertRaises(AttributeError):
+            self.tree.weights = [1, 1]
+
     def test_binary_tree_recursive(self):
         for i in range(1, 50):
             images = []
@@ -134,6 +170,151 @@ class TestCollage(unittest.TestCase):
         a, b = tree.linear_equations
         sol = np.linalg.solve(a, b)
         self.assertTrue(np.allclose(sol_expected[idx], sol))
+        widths = tree.bric_widths()
+        self.assertTrue(np.allclose(sol, [widths[leaf] for leaf in tree.leafs]))
+
+    def test_bric_widths(self):
+        """Test linear time solution of BRIC equations."""
+        rnd = Random(3)
+        for n in [1, 2, 5, 40]:
+            images = []
+            for i in range(n):
+                img = Mock()
+                img.size = (rnd.randint(50, 400), rnd.randint(50, 400))
+                images.append(img)
+            tree = _binary_tree_recursive(images, Random(n), n % 2 == 0)
+            a, b = tree.linear_equations
+            sol = np.linalg.solve(a, b)
+            widths = tree.bric_widths()
+            self.assertTrue(np.allclose(sol, [widths[leaf] for leaf in tree.leafs]))
+            tree.set_weights_from_widths(widths)
+            self.assertAlmostEqual(0, tree.cut_loss(tree.uncropped_aspect_ratio({})))
+
+    def test_best_seed(self):
+        """Test parallel layout search choosing the serial search result."""
+        rnd = Random(5)
+        sizes = [
+            (rnd.choice([100, 150, 300]), rnd.choice([100, 150])) for _ in range(9)
+        ]
+        images = [LazyImage(size, None) for size in sizes]
+        scores = [
+            bric_tree(images, 1.5, Random(i)).score(300, 200) for i in range(10, 40)
+        ]
+        expected = 10 + scores.index(max(scores))
+        self.assertEqual(expected, best_seed(images, 300, 200, 10, 30))
+        self.assertEqual(expected, best_seed(images, 300, 200, 10, 30, jobs=2))
+        # all layouts of two square images into a square score the same
+        images = [LazyImage((100, 100), None)] * 2
+        self.assertEqual(7, best_seed(images, 100, 100, 7, 5, jobs=2))
+
+    def test_anneal(self):
+        """Test local search improving layouts and keeping images in order."""
+        rnd = Random(3)
+        sizes = [
+            (rnd.choice([100, 150, 300]), rnd.choice([100, 150])) for _ in range(12)
+        ]
+        images = [LazyImage(size, None) for size in sizes]
+        tree = bric_tree(images, 1.5, Random(0))
+        best, steps = anneal(tree, 300, 200, Random(1), 2000)
+        self.assertEqual(2000, steps)
+        self.assertEqual(images, [leaf.image for leaf in best.leafs])
+        self.assertGreater(best.score(300, 200), tree.score(300, 200))
+        # the explored layouts only depend on the random number generator
+        again, _ = anneal(tree, 300, 200, Random(1), 2000)
+        self.assertEqual(best.score(300, 200), again.score(300, 200))
+        # no steps keep the layout
+        same, steps = anneal(tree, 300, 200, Random(1), 0)
+        self.assertEqual(0, steps)
+        self.assertEqual(tree.score(300, 200), same.score(300, 200))
+        # time budgets are converted to the same number of steps everywhere
+        self.assertEqual(anneal_steps(12, 1.0), anneal_steps(12, 1.0))
+        self.assertGreater(anneal_steps(12, 1.0), anneal_steps(120, 1.0))
+        self.assertEqual(0, anneal_steps(12, 0))
+
+    def test_exhaustive_tree(self):
+        """Test exhaustive search choosing the best of all layouts."""
+        rnd = Random(8)
+        sizes = [
+            (rnd.choice([100, 150, 300]), rnd.choice([100, 150])) for _ in range(7)
+        ]
+        images = [LazyImage(size, None) for size in sizes]
+        tree = exhaustive_tree(images, 300, 200)
+        self.assertEqual(images, [leaf.image for leaf in tree.leafs])
+        score = tree.score(300, 200)
+        for i in range(200):
+            other = bric_tree(images, 1.5, Random(i)).score(300, 200)
+            self.assertLessEqual(other, score + 1e-12)
+        annealed, _ = anneal(tree, 300, 200, Random(0), 2000)
+        self.assertAlmostEqual(score, annealed.score(300, 200))
+        self.assertIsInstance(exhaustive_tree(images[:1], 100, 100), LayoutLeaf)
+
+    def test_permute_images(self):
+        """Test assigning images to leafs improving layouts."""
+        rnd = Random(4)
+        sizes = [rnd.choice([(400, 100), (100, 300), (200, 200)]) for _ in range(12)]
+        images = [LazyImage(size, None) for size in sizes]
+        tree = bric_tree(images, 1.5, Random(0))
+        permuted = permute_images(tree, 300, 200, Random(0))
+        self.assertCountEqual(images, [leaf.image for leaf in permuted.leafs])
+        self.assertGreater(permuted.score(300, 200), tree.score(300, 200))
+        # the best of fewer tries is better than keeping the order of images
+        i = best_seed(images, 300, 200, 0, 10, permute=True)
+        self.assertEqual(i, best_seed(images, 300, 200, 0, 10, jobs=2, permute=True))
+        best = random_tree(images, 300, 200, i, permute=True).score(300, 200)
+        j = best_seed(images, 300, 200, 0, 100)
+        self.assertGreater(best, random_tree(images, 300, 200, j).score(300, 200))
+        annealed, _ = anneal(tree, 300, 200, Random(1), 1000, permute=True)
+        self.assertCountEqual(images, [leaf.image for leaf in annealed.leafs])
+        self.assertGreater(annealed.score(300, 200), tree.score(300, 200))
+
+    def test_render_bands(self):
+        """Test rendering collages band by band."""
+        rnd = np.random.default_rng(2)
+        sizes = [(90, 60), (40, 80), (50, 50), (120, 40), (70, 70)]
+        images = [
+            Image.fromarray(rnd.integers(0, 256, (h, w, 3), dtype=np.uint8))
+            for w, h in sizes
+        ]
+        tree = bric_tree(images, 1.5, Random(3))
+        expected = render(tree, 150, 100, 0.02, "green")
+        for rows in [1, 7, 100]:
+            bands = render_bands(tree, 150, 100, 0.02, "green", rows)
+            self.assertEqual(expected.size, bands.size)
+            self.assertTrue(all(band.size[1] <= rows for _, band in bands.strips()))
+            # bands may be rendered more than once
+            for _ in range(2):
+                self.assertEqual(expected.tobytes(), bands.render().tobytes())
+        # images may be resampled concurrently
+        actual = render(tree, 150, 100, 0.02, "green", threads=3)
+        self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    def test_lazy_images(self):
+        """Test layout of lazy images and decoding only for rendering."""
+        decoded = []
+
+        def _loader(size):
+            def _load(target_size):
+                decoded.append(target_size)
+                return Image.new("RGB", size, "red")
+
+            return _load
+
+        sizes = [(300, 200), (200, 300), (100, 100), (400, 100)]
+        images = [LazyImage(size, _loader(size)) for size in sizes]
+        tree = bric_tree(images, 1.5, Random(1))
+        self.assertEqual(4, tree.leaf_count)
+        self.assertFalse(decoded)
+        img = collage(images, 60, 40, 0.0, "white", 0, 3)
+        self.assertEqual((60, 40), img.size)
+        self.assertEqual(4, len(decoded))
+        for target_size in decoded:
+            self.assertEqual(2, len(target_size))
+        img = collage(images, 60, 40, 0.0, "white", 0, 3, time_budget=0.1)
+        self.assertEqual((60, 40), img.size)
+        img = collage(images, 60, 40, 0.0, "white", 0, exhaustive=True)
+        self.assertEqual((60, 40), img.size)
+        img = collage(images, 60, 40, 0.0, "white", 0, 3, permute=True)
+        self.assertEqual((60, 40), img.size)
 
     def test_collage_output(self):
         """Test output of filmstrip command."""
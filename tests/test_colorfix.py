@@ -4,18 +4,37 @@
 """Tests for `colorfix` subcommand."""
 
 
+import json
+import tempfile
 import unittest
 from io import BytesIO
 from base64 import encodebytes
+from itertools import product
+from math import log, sqrt
+from pathlib import Path
 
+import click
+import numpy as np
 from click.testing import CliRunner
+from PIL import Image
+from imgwrench import cli_imgwrench
+from imgwrench.cli import _load_lazy
 from imgwrench.commands.colorfix import (
+    colorfix_rolls,
+    histogram,
+    histogram_quantiles,
     quantiles,
+    sample,
+    stretch_histogram,
     colorfix_quantiles,
     colorfix_fixed_cutoff,
     colorfix_quantiles_fixed_cutoff,
+    cli_colorfix,
 )
 
+from imgwrench.commands.resize import cli_resize
+from imgwrench.stages import input_scale
+
 from .utils import execute_and_test_output_images
 from .images import (
     colorcast_img,
@@ -68,6 +87,11 @@ IMAGES_QUANTILES_FIXED_CUTOFF_TARGETS = [
 ]
 
 
+def _processor(command, args):
+    with click.Context(command):
+        return command.main(args, standalone_mode=False)
+
+
 def _tobytes(img):
     b = BytesIO()
     img.save(b, format="JPEG")
@@ -102,6 +126,13 @@ class TestBlackwhite(unittest.TestCase):
         args = ["colorfix", "-m", "quantiles-fixed-cutoff"]
         execute_and_test_output_images(self, CliRunner(), 3, 3, "colorfix_", args)
 
+    def test_colorfixed_output_stats_scale(self):
+        """Test output of colorfix command with sampled quantiles."""
+        args = ["colorfix", "-m", "quantiles", "-s", "1/2"]
+        execute_and_test_output_images(self, CliRunner(), 3, 3, "colorfix_", args)
+        result = CliRunner().invoke(cli_colorfix, ["-s", "2"])
+        self.assertNotEqual(0, result.exit_code)
+
     def test_quantiles(self):
         """Regression test for quantiles."""
         for level, target in QUANTILES_TARGETS:
@@ -109,6 +140,107 @@ class TestBlackwhite(unittest.TestCase):
                 target, quantiles(colorcast_img, level), "level {} fail".format(level)
             )
 
+    def test_stretch_histogram(self):
+        """Test stretching against per-pixel computation."""
+        arr = np.arange(256 * 3, dtype=np.uint8).reshape(16, 16, 3)
+        img = Image.fromarray(arr)
+        for cutoffs in [[(0, 255)] * 3, [(10, 200), (0, 255), (100, 101)]]:
+            expected = arr.astype(np.int16)
+            for idx_channel, (low, high) in enumerate(cutoffs):
+                stretched = (expected[:, :, idx_channel] - low) / (high - low) * 256
+                stretched = stretched.astype(np.int16)
+                expected[:, :, idx_channel] = np.clip(stretched, 0, 255)
+            stretched = np.asarray(stretch_histogram(img, cutoffs))
+            self.assertTrue((expected == stretched).all(), cutoffs)
+
+    def test_sampled_quantiles(self):
+        """Test quantiles estimated from samples against exact quantiles."""
+        town = Image.open(Path(__file__).parent / "images" / "town.jpg")
+        noise = Image.merge(
+            "RGB",
+            [
+                Image.effect_noise((300, 200), sigma).convert("L")
+                for sigma in [10, 40, 80]
+            ],
+        )
+        gradient = Image.linear_gradient("L").resize((400, 300)).convert("RGB")
+        corpus = [colorcast_img, town.convert("RGB"), noise, gradient]
+        for img, level, stats_scale in product(corpus, [0.01, 0.05], [1 / 2, 1 / 4]):
+            estimated = quantiles(img, level, stats_scale)
+            n = sample(img, stats_scale).size[0] * sample(img, stats_scale).size[1]
+            # DKW bound exceeded with probability 0.001 for random samples
+            eps = sqrt(log(2 / 0.001) / (2 * n))
+            h = np.array(img.histogram()).reshape(-1, 256)[:3]
+            for channel_h, (low, high) in zip(h, estimated):
+                cdf = np.cumsum(channel_h) / channel_h.sum()
+                self.assertGreaterEqual(cdf[low], level - eps)
+                self.assertLessEqual(cdf[low - 1] if low else 0, level + eps)
+                self.assertGreaterEqual(cdf[high], 1 - level - eps)
+                self.assertLessEqual(cdf[high - 1], 1 - level + eps)
+        self.assertEqual(quantiles(town, 0.01), quantiles(town, 0.01, 1))
+
+    def test_colorfix_rolls(self):
+        """Test common quantiles for rolls of images."""
+        town = Image.open(Path(__file__).parent / "images" / "town.jpg")
+        images = [(0, colorcast_img), (1, town), (2, colorcast_img)]
+        fixed = []
+
+        def _fix(image, channel_quantiles):
+            fixed.append(channel_quantiles)
+            return image
+
+        output = list(colorfix_rolls(images, _fix, 2, 0.01))
+        self.assertEqual(images, output)
+        combined = histogram_quantiles(histogram(colorcast_img) + histogram(town))
+        self.assertEqual([combined, combined, quantiles(colorcast_img)], fixed)
+        fixed = []
+        list(colorfix_rolls(images, _fix, 0, 0.01))
+        self.assertEqual(1, len(set(fixed)))
+
+    def test_colorfix_rolls_lazy(self):
+        """Test equal quantiles of rolls of lazy and decoded images."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "town.jpg"
+            with Image.open(Path(__file__).parent / "images" / "town.jpg") as img:
+                img.resize((1200, 800)).save(path)
+            lazy = [_load_lazy(path, i, False)[::-1] for i in range(2)]
+            decoded = [(info, image.open()) for info, image in lazy]
+            fixed = []
+
+            def _fix(image, channel_quantiles):
+                fixed.append(channel_quantiles)
+                return image
+
+            for images in [lazy, decoded]:
+                list(colorfix_rolls(images, _fix, 2, 0.01, 1 / 8))
+            self.assertEqual(fixed[0], fixed[2])
+
+    def test_full_resolution(self):
+        """Test that colorfix requires input images at full resolution."""
+        resize = _processor(cli_resize, ["-m", "100"])
+        self.assertEqual(0.05, input_scale([resize], (2000, 1000)))
+        for args in [[], ["-m", "quantiles", "-r", "2"]]:
+            colorfix = _processor(cli_colorfix, args)
+            self.assertEqual(1.0, input_scale([colorfix, resize], (2000, 1000)))
+
+    def test_colorfixed_output_rolls(self):
+        """Test output of colorfix command in roll mode with stats cache."""
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            colorcast_img.save("a.jpg")
+            colorcast_img.save("b.jpg")
+            with open("images.txt", "w") as f:
+                f.write("a.jpg\nb.jpg\n")
+            args = ["-i", "images.txt", "-f", "colorfix", "-m", "quantiles"]
+            args += ["-r", "0", "-s", "1/2", "-c", "stats.json", "resize", "-m", "20"]
+            for _ in range(2):
+                result = runner.invoke(cli_imgwrench, args)
+                self.assertEqual(0, result.exit_code, result.output)
+                with open("stats.json") as f:
+                    self.assertEqual(2, len(json.load(f)))
+            with Image.open("img_0001.jpg") as img:
+                self.assertEqual(20, max(img.size))
+
     def test_colorfix_quantiles_regression(self):
         """Regression test for colorfix quantiles algorithm."""
         for level, target in IMAGES_TARGETS:
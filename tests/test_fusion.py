@@ -0,0 +1,82 @@
+"""Tests for fusion of point operations."""
+
+import unittest
+from itertools import product
+
+import click
+import numpy as np
+from PIL import Image, ImageEnhance
+
+from imgwrench.commands.blackwhite import cli_blackwhite
+from imgwrench.commands.colorfix import cli_colorfix
+from imgwrench.commands.dither import cli_dither
+from imgwrench.commands.flip import cli_flip
+from imgwrench.fusion import fuse, probe_lut
+
+
+def _processor(command, args):
+    with click.Context(command):
+        return command.main(args, standalone_mode=False)
+
+
+def _unfused(image_processors, image):
+    for image_processor in image_processors:
+        image = image_processor.per_image(image)
+    return image
+
+
+class TestFusion(unittest.TestCase):
+    """Tests for fusion of point operations."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        rng = np.random.default_rng(0)
+        noise = rng.integers(30, 220, (37, 53, 3), dtype=np.uint8)
+        self.images = [Image.fromarray(noise), Image.fromarray(noise).convert("L")]
+        self.processors = [
+            _processor(cli_colorfix, []),
+            _processor(cli_colorfix, ["-m", "quantiles", "-s", "1/2"]),
+            _processor(cli_blackwhite, []),
+            _processor(cli_dither, ["-b", "0.7"]),
+            _processor(cli_flip, []),
+        ]
+
+    def test_probe_lut(self):
+        """Test lookup tables derived from Pillow operations."""
+
+        def brighten(image):
+            return ImageEnhance.Brightness(image).enhance(1.5)
+
+        lut = probe_lut(brighten, "L")[0]
+        self.assertEqual(0, lut[0])
+        self.assertEqual(150, lut[100])
+        self.assertEqual(255, lut[200])
+        self.assertEqual(3, len(probe_lut(brighten, "RGB")))
+
+    def test_fuse(self):
+        """Test that runs of point operations are fused."""
+        colorfix, _, blackwhite, dither, flip = self.processors
+        fused = fuse([colorfix, blackwhite, flip, dither, flip, colorfix, dither])
+        self.assertEqual(5, len(fused))
+        self.assertEqual([colorfix, blackwhite], fused[0].fused)
+        self.assertEqual([flip, dither, flip], fused[1:4])
+        self.assertEqual([colorfix, dither], fused[4].fused)
+        self.assertTrue(hasattr(fused[0], "per_image"))
+
+    def test_identical_output(self):
+        """Test that fused point operations produce identical images."""
+        for n in [2, 3]:
+            for chain in product(self.processors[:4], repeat=n):
+                fused = fuse(chain)
+                for image in self.images:
+                    try:
+                        expected = _unfused(chain, image)
+                    except (AssertionError, ValueError) as e:
+                        # colorfix requires RGB images, fused or not
+                        with self.assertRaises(type(e)):
+                            _unfused(fused, image)
+                        continue
+                    output = _unfused(fused, image)
+                    self.assertIsNot(image, output)
+                    self.assertEqual(expected.mode, output.mode)
+                    self.assertEqual(expected.tobytes(), output.tobytes())
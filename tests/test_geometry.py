@@ -0,0 +1,154 @@
+"""Tests for fusion of geometric operations."""
+
+import unittest
+from itertools import product
+
+import click
+import numpy as np
+from PIL import Image
+
+from imgwrench.commands.blackwhite import cli_blackwhite
+from imgwrench.commands.crop import cli_crop
+from imgwrench.commands.flip import cli_flip
+from imgwrench.commands.frame import cli_frame
+from imgwrench.commands.framecrop import cli_framecrop
+from imgwrench.commands.resize import cli_resize
+from imgwrench.geometry import (
+    PENDING_TRANSPOSE,
+    defer_transpose,
+    defers_transpose,
+    fuse_geometric,
+    resample,
+    untranspose_box,
+)
+
+ROTATIONS = [None, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270]
+
+
+def _processor(command, args):
+    with click.Context(command):
+        return command.main(args, standalone_mode=False)
+
+
+def _unfused(image_processors, image):
+    for image_processor in image_processors:
+        image = image_processor.per_image(image)
+    return image
+
+
+class TestGeometry(unittest.TestCase):
+    """Tests for fusion of geometric operations."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        rng = np.random.default_rng(0)
+        noise = rng.integers(0, 256, (97, 131, 3), dtype=np.uint8)
+        self.image = Image.fromarray(noise)
+        self.chains = [
+            [
+                _processor(cli_crop, ["-a", "4:3"]),
+                _processor(cli_flip, []),
+                _processor(cli_crop, ["-a", "1:1"]),
+            ],
+            [
+                _processor(cli_flip, []),
+                _processor(cli_resize, ["-m", "60"]),
+                _processor(cli_frame, ["-w", "0.05", "-c", "red"]),
+                _processor(cli_frame, []),
+            ],
+            [
+                _processor(cli_crop, ["-a", "16:9"]),
+                _processor(cli_resize, ["-m", "80"]),
+                _processor(cli_crop, ["-a", "1:1"]),
+                _processor(cli_framecrop, ["-a", "4:3"]),
+            ],
+        ]
+
+    def test_untranspose_box(self):
+        """Test mapping boxes in transposed images back."""
+        methods = ROTATIONS[1:] + [Image.FLIP_LEFT_RIGHT, Image.FLIP_TOP_BOTTOM]
+        for method in methods:
+            transposed = self.image.transpose(method)
+            box = (5, 7, 30, 19)
+            source_box = untranspose_box(box, self.image.size, method)
+            self.assertEqual(
+                transposed.crop(box).tobytes(),
+                self.image.crop(source_box).transpose(method).tobytes(),
+            )
+
+    def test_fuse(self):
+        """Test that runs of geometric operations are fused."""
+        crop, flip, _ = self.chains[0]
+        blackwhite = _processor(cli_blackwhite, [])
+        fused = fuse_geometric([blackwhite, crop, blackwhite, crop, flip])
+        self.assertEqual(4, len(fused))
+        self.assertEqual([crop, flip], fused[3].fused)
+        self.assertFalse(defers_transpose(fused))
+        # a single geometric operation at the start applies deferred rotations
+        fused = fuse_geometric([crop, blackwhite])
+        self.assertEqual([crop], fused[0].fused)
+        self.assertTrue(defers_transpose(fused))
+
+    def test_exact(self):
+        """Test that exact fused operations give identical results."""
+        for chain, rotation in product(self.chains, ROTATIONS):
+            expected = self.image
+            image = self.image.copy()
+            if rotation is not None:
+                expected = expected.transpose(rotation)
+                defer_transpose(image, rotation)
+            expected = _unfused(chain, expected)
+            (fused,) = fuse_geometric(chain, exact=True)
+            actual = fused.per_image(image)
+            self.assertNotIn(PENDING_TRANSPOSE, actual.info)
+            self.assertEqual(expected.mode, actual.mode)
+            self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    def test_single_resampling(self):
+        """Test that fused operations resample images once."""
+        resizes = []
+        resize = Image.Image.resize
+
+        def _resize(*args, **kwargs):
+            resizes.append(args[1])
+            return resize(*args, **kwargs)
+
+        for chain, rotation in product(self.chains, ROTATIONS):
+            expected = self.image
+            image = self.image.copy()
+            if rotation is not None:
+                expected = expected.transpose(rotation)
+                defer_transpose(image, rotation)
+            expected = _unfused(chain, expected)
+            (fused,) = fuse_geometric(chain)
+            resizes.clear()
+            Image.Image.resize = _resize
+            try:
+                actual = fused.per_image(image)
+            finally:
+                Image.Image.resize = resize
+            self.assertLessEqual(len(resizes), 1)
+            self.assertEqual(expected.size, actual.size)
+            difference = np.abs(
+                np.asarray(expected, dtype=int) - np.asarray(actual, dtype=int)
+            )
+            # frames are identical, contents are resampled differently
+            self.assertEqual(0, difference[0].max())
+            self.assertLess(difference.mean(), 8)
+
+    def test_resample(self):
+        """Test transposing, cropping and resampling in a single call."""
+        box = (10, 3, 80, 90)
+        for method, size in product(ROTATIONS, [(40, 60), (10, 12), (140, 230)]):
+            expected = self.image
+            if method is not None:
+                expected = expected.transpose(method)
+            expected = expected.crop(box).resize(size, Image.LANCZOS)
+            exact = resample(self.image, size, box, method, exact=True)
+            self.assertEqual(expected.tobytes(), exact.tobytes())
+            actual = resample(self.image, size, box, method)
+            self.assertEqual(size, actual.size)
+            difference = np.abs(
+                np.asarray(expected, dtype=int) - np.asarray(actual, dtype=int)
+            )
+            self.assertLess(difference.mean(), 8)
@@ -0,0 +1,34 @@
+"""Tests for `grid` subcommand."""
+
+import unittest
+
+from click.testing import CliRunner
+import numpy as np
+from PIL import Image
+
+from imgwrench.commands.grid import grid
+
+from .utils import execute_and_test_output_images
+
+
+class TestGrid(unittest.TestCase):
+    """Tests for `grid` subcommand."""
+
+    def test_grid_threads(self):
+        """Test resampling images of grid concurrently."""
+        rng = np.random.default_rng(0)
+        images = [
+            Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+            for w, h in [(90, 60), (40, 70), (50, 50), (120, 40), (60, 90)]
+        ]
+        for width, height in [(120, 80), (80, 120)]:
+            expected = grid(images, 2, 3, width, height, 0.02, True, "red")
+            self.assertEqual((width, height), expected.size)
+            actual = grid(images, 2, 3, width, height, 0.02, True, "red", threads=4)
+            self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    def test_grid_output(self):
+        """Test output of grid command."""
+        execute_and_test_output_images(
+            self, CliRunner(), 5, 2, "grid_", ["grid", "-r", "2", "-n", "2", "-T", "2"]
+        )
@@ -4,6 +4,7 @@
 """Tests for `imgwrench` package."""
 
 
+import json
 import os
 import unittest
 import doctest
@@ -14,7 +15,7 @@ from PIL.TiffImagePlugin import IFDRational
 from click.testing import CliRunner
 
 from imgwrench import cli_imgwrench
-from imgwrench.cli import _xmp_from_image
+from imgwrench.cli import _xmp_from_image, _insert_xmp, _load_image, _load_lazy
 from imgwrench import cli
 
 from .images import pixel1x1, png1x1, badexif
@@ -262,6 +263,18 @@ class TestImgwrenchMainCli(unittest.TestCase):
                 self.assertFalse(hasattr(img, "_getexif") and img._getexif())
                 self.assertFalse(_xmp_from_image(img))
 
+    def test_xmp_insertion(self):
+        """Test splicing of XMP segments into encoded JPEG data."""
+        app1 = b"\xFF\xE1\x00\x06Exif"
+        data = b"\xFF\xD8" + app1 + b"\xFF\xDBrest"
+        self.assertEqual(
+            b"\xFF\xD8" + app1 + b"\xFF\xE1\x00\x05xmp\xFF\xDBrest",
+            _insert_xmp(data, b"xmp"),
+        )
+        self.assertEqual(
+            b"\xFF\xD8\xFF\xDBrest", _insert_xmp(b"\xFF\xD8\xFF\xDBrest", b"xmp")
+        )
+
     def test_image_rotation(self):
         """Test rotation if images depending on exif preservation"""
         img_path = str(self.images_path / "town.jpg")
@@ -319,6 +332,378 @@ class TestImgwrenchMainCli(unittest.TestCase):
             outfile = outdir / fname
             self.assertTrue(outfile.exists(), "{0} missing".format(outfile))
 
+    def test_jobs(self):
+        """Test identical output of parallel and serial pipeline execution."""
+        img_path = str(self.images_path / "town.jpg")
+        with open(img_path, "rb") as f:
+            img_data = f.read()
+        pipeline = ["colorfix", "resize", "-m", 100, "flip", "quad", "-w", 120]
+        pipeline += ["-s", 80, "frame"]
+        with self.runner.isolated_filesystem():
+            with open("town.jpg", "wb") as f:
+                f.write(img_data)
+            with open("pixel1x1.jpg", "wb") as f:
+                f.write(pixel1x1)
+            with open("images.txt", "w") as f:
+                for i in range(5):
+                    f.write("town.jpg\npixel1x1.jpg\n")
+            for jobs, outdir in [(1, "serial"), (3, "parallel")]:
+                result = self.runner.invoke(
+                    cli_imgwrench,
+                    ["-i", "images.txt", "-o", outdir, "-J", jobs] + pipeline,
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+            serial = sorted(Path("serial").iterdir())
+            parallel = sorted(Path("parallel").iterdir())
+            self.assertEqual(3, len(serial))
+            self.assertEqual([p.name for p in serial], [p.name for p in parallel])
+            for s, p in zip(serial, parallel):
+                self.assertEqual(s.read_bytes(), p.read_bytes(), s.name)
+
+    def test_prefetch(self):
+        """Test identical output with and without prefetching."""
+        img_path = str(self.images_path / "town.jpg")
+        with open(img_path, "rb") as f:
+            img_data = f.read()
+        with self.runner.isolated_filesystem():
+            with open("town.jpg", "wb") as f:
+                f.write(img_data)
+            with open("images.txt", "w") as f:
+                for i in range(7):
+                    f.write("town.jpg\n")
+            for depth, outdir in [(0, "serial"), (3, "prefetched")]:
+                result = self.runner.invoke(
+                    cli_imgwrench,
+                    ["-i", "images.txt", "-o", outdir, "-P", depth, "colorfix"],
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+            serial = sorted(Path("serial").iterdir())
+            prefetched = sorted(Path("prefetched").iterdir())
+            self.assertEqual(7, len(serial))
+            self.assertEqual([p.name for p in serial], [p.name for p in prefetched])
+            for s, p in zip(serial, prefetched):
+                self.assertEqual(s.read_bytes(), p.read_bytes(), s.name)
+
+    def test_writers(self):
+        """Test saving output images in background threads."""
+        with self.runner.isolated_filesystem():
+            with open("pixel1x1.jpg", "wb") as f:
+                f.write(pixel1x1)
+            with open("images.txt", "w") as f:
+                for i in range(10):
+                    f.write("pixel1x1.jpg\n")
+            args = ["-i", "images.txt", "-o", "out", "-W", 3]
+            result = self.runner.invoke(cli_imgwrench, args + ["save"])
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertEqual(10, len(list(Path("out").iterdir())))
+            # existing files must not be overwritten without --force-overwrite
+            result = self.runner.invoke(cli_imgwrench, args + ["save"])
+            self.assertNotEqual(0, result.exit_code)
+            self.assertIn("already exists", str(result.exception))
+            result = self.runner.invoke(cli_imgwrench, args + ["-f", "save"])
+            self.assertEqual(0, result.exit_code, result.output)
+            # repeated file names are written one after another
+            args = ["-i", "images.txt", "-o", "kept", "-W", 3, "-k"]
+            result = self.runner.invoke(cli_imgwrench, args + ["save"])
+            self.assertIn("already exists", str(result.exception))
+            result = self.runner.invoke(cli_imgwrench, args + ["-f", "save"])
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertEqual(["pixel1x1.jpg"], [p.name for p in Path("kept").iterdir()])
+
+    def test_draft_loading(self):
+        """Test loading of JPEG images at reduced resolution."""
+        img_path = self.images_path / "town.jpg"
+        img, _ = _load_image(img_path, 0, False)
+        self.assertEqual((200, 300), img.size)
+        sizes = []
+        img, _ = _load_image(img_path, 0, False, lambda size: sizes.append(size) or 1)
+        self.assertEqual([(200, 300)], sizes)
+        self.assertEqual((200, 300), img.size)
+        img, _ = _load_image(img_path, 0, False, lambda size: 0.5)
+        self.assertEqual((100, 150), img.size)
+        img, _ = _load_image(img_path, 0, False, lambda size: 0.3)
+        self.assertEqual((100, 150), img.size)
+        img, _ = _load_image(img_path, 0, False, lambda size: 0.2)
+        self.assertEqual((50, 75), img.size)
+        img, _ = _load_image(img_path, 0, True, lambda size: 0.5)
+        self.assertEqual((150, 100), img.size)
+        img, _ = _load_image(self.images_path / "red-blue.png", 0, False, lambda s: 0.1)
+        self.assertEqual(Image.open(self.images_path / "red-blue.png").size, img.size)
+
+    def test_exact(self):
+        """Test output sizes with and without reduced resolution decoding."""
+        img_path = str(self.images_path / "town.jpg")
+        with open(img_path, "rb") as f:
+            img_data = f.read()
+        with self.runner.isolated_filesystem():
+            with open("town.jpg", "wb") as f:
+                f.write(img_data)
+            with open("images.txt", "w") as f:
+                f.write("town.jpg\n")
+            for args in [["-p", "exact_", "-x"], ["-p", "draft_"]]:
+                result = self.runner.invoke(
+                    cli_imgwrench,
+                    ["-i", "images.txt"]
+                    + args
+                    + ["crop", "-a", "1", "resize", "-m", 60],
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+            with Image.open("exact_0000.jpg") as exact:
+                with Image.open("draft_0000.jpg") as draft:
+                    self.assertEqual((60, 60), exact.size)
+                    self.assertEqual(exact.size, draft.size)
+
+    def test_exact_sizes(self):
+        """Test equal output sizes of geometric operations with and without
+        reduced resolution decoding."""
+        chains = [
+            ["crop", "-a", "3:2", "flip", "resize", "-m", 411, "frame"],
+            ["framecrop", "resize", "-m", 300],
+            ["resize", "-m", 301],
+            ["crop", "-a", "1", "resize", "-m", 77, "frame", "-w", "0.1"],
+        ]
+        with self.runner.isolated_filesystem():
+            with Image.open(self.images_path / "town.jpg") as img:
+                img.resize((1999, 1333)).save("town.jpg")
+            with open("images.txt", "w") as f:
+                f.write("town.jpg\n")
+            for chain in chains:
+                sizes = []
+                for args in [["-x"], []]:
+                    result = self.runner.invoke(
+                        cli_imgwrench, ["-i", "images.txt", "-f"] + args + chain
+                    )
+                    self.assertEqual(0, result.exit_code, result.output)
+                    with Image.open("img_0000.jpg") as img:
+                        sizes.append(img.size)
+                self.assertEqual(sizes[0], sizes[1], chain)
+
+    def test_lazy_loading(self):
+        """Test deferred decoding of images."""
+        img_path = self.images_path / "town.jpg"
+        lazy, info = _load_lazy(img_path, 3, False)
+        self.assertEqual(3, info.index)
+        self.assertEqual("town.jpg", info.fname)
+        self.assertEqual((200, 300), lazy.size)
+        self.assertEqual((200, 300), lazy.open().size)
+        self.assertEqual((50, 75), lazy.open((40, 60)).size)
+        lazy, _ = _load_lazy(img_path, 3, False, draft=False)
+        self.assertEqual((200, 300), lazy.open((40, 60)).size)
+        lazy, _ = _load_lazy(img_path, 3, True)
+        self.assertEqual((300, 200), lazy.size)
+        self.assertEqual((300, 200), lazy.open().size)
+
+    def test_incremental(self):
+        """Test skipping of up-to-date output images."""
+        img_path = str(self.images_path / "town.jpg")
+        with open(img_path, "rb") as f:
+            img_data = f.read()
+        with self.runner.isolated_filesystem():
+            for fname in ["a.jpg", "b.jpg", "c.jpg"]:
+                with open(fname, "wb") as f:
+                    f.write(img_data)
+            with open("images.txt", "w") as f:
+                f.write("a.jpg\nb.jpg\nc.jpg\n")
+            args = ["-i", "images.txt", "-I", "-o", "out", "resize", "-m", 60]
+            result = self.runner.invoke(cli_imgwrench, args)
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertEqual(3, result.output.count("-> Saved"))
+            # nothing to do
+            result = self.runner.invoke(cli_imgwrench, args)
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertIn("Skipping 3 up-to-date output images", result.output)
+            self.assertNotIn("-> Saved", result.output)
+            # changed input and deleted output image
+            stat = os.stat("b.jpg")
+            os.utime("b.jpg", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            os.remove(os.path.join("out", "img_0002.jpg"))
+            result = self.runner.invoke(cli_imgwrench, args)
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertIn("b.jpg...", result.output)
+            self.assertNotIn("a.jpg...", result.output)
+            self.assertEqual(2, result.output.count("-> Saved"))
+            # changed parameters
+            args[-1] = 50
+            result = self.runner.invoke(cli_imgwrench, args)
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertEqual(3, result.output.count("-> Saved"))
+            with Image.open(os.path.join("out", "img_0000.jpg")) as img:
+                self.assertEqual(50, max(img.size))
+
+    def test_incremental_rolls(self):
+        """Test skipping of up-to-date output images of rolls."""
+        img_path = str(self.images_path / "town.jpg")
+        with open(img_path, "rb") as f:
+            img_data = f.read()
+        with self.runner.isolated_filesystem():
+            for fname in ["a.jpg", "b.jpg", "c.jpg"]:
+                with open(fname, "wb") as f:
+                    f.write(img_data)
+            with open("images.txt", "w") as f:
+                f.write("a.jpg\nb.jpg\nc.jpg\n")
+            for roll_size in [2, 0]:
+                args = ["-i", "images.txt", "-I", "-f", "-o", str(roll_size)]
+                args += ["colorfix", "-r", roll_size]
+                result = self.runner.invoke(cli_imgwrench, args)
+                self.assertEqual(0, result.exit_code, result.output)
+                self.assertEqual(3, result.output.count("-> Saved"))
+                result = self.runner.invoke(cli_imgwrench, args)
+                self.assertEqual(0, result.exit_code, result.output)
+                self.assertNotIn("-> Saved", result.output)
+            # all images of a changed roll are processed again
+            stat = os.stat("b.jpg")
+            os.utime("b.jpg", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            result = self.runner.invoke(
+                cli_imgwrench,
+                ["-i", "images.txt", "-I", "-o", "2", "colorfix", "-r", 2],
+            )
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertIn("Skipping 1 up-to-date output images", result.output)
+            self.assertIn("a.jpg...", result.output)
+            self.assertNotIn("c.jpg...", result.output)
+            self.assertEqual(2, result.output.count("-> Saved"))
+
+    def test_profile_report(self):
+        """Test reporting of stage timings."""
+        img_path = str(self.images_path / "town.jpg")
+        with open(img_path, "rb") as f:
+            img_data = f.read()
+        with self.runner.isolated_filesystem():
+            with open("town.jpg", "wb") as f:
+                f.write(img_data)
+            with open("images.txt", "w") as f:
+                f.write("town.jpg\ntown.jpg\n")
+            result = self.runner.invoke(
+                cli_imgwrench,
+                ["-i", "images.txt", "-R", "report.json"]
+                + ["resize", "-m", 60, "resize", "-m", 30, "stack"],
+            )
+            self.assertEqual(0, result.exit_code, result.output)
+            with open("report.json") as f:
+                report = json.load(f)
+            names = [stage["name"] for stage in report["stages"]]
+            # consecutive geometric operations are fused into a single stage
+            self.assertEqual(["load", "resize+resize#2", "stack", "save"], names)
+            self.assertEqual(os.path.getsize("img_0000.jpg"), report["bytes_written"])
+            self.assertEqual(1, report["stages"][-1]["images"])
+            # incremental execution reports the same stages
+            result = self.runner.invoke(
+                cli_imgwrench,
+                ["-i", "images.txt", "-I", "-R", "incremental.json", "-o", "out"]
+                + ["resize", "-m", 60],
+            )
+            self.assertEqual(0, result.exit_code, result.output)
+            with open("incremental.json") as f:
+                report = json.load(f)
+            names = [stage["name"] for stage in report["stages"]]
+            self.assertEqual(["load", "resize", "save"], names)
+
+    def test_cache(self):
+        """Test decoding repeated images only once."""
+        img_path = str(self.images_path / "town.jpg")
+        decoded = []
+        decode_image = cli._decode_image
+
+        def _decode_image(*args):
+            decoded.append(args[0])
+            return decode_image(*args)
+
+        with self.runner.isolated_filesystem():
+            with open("images.txt", "w") as f:
+                f.write(img_path + "\n" + img_path + "\n")
+            cli._decode_image = _decode_image
+            try:
+                result = self.runner.invoke(
+                    cli_imgwrench, ["-i", "images.txt", "-r", "2", "grid", "-r", "2"]
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+                self.assertEqual(1, len(decoded))
+                result = self.runner.invoke(
+                    cli_imgwrench, ["-i", "images.txt", "-C", "0", "-f", "save"]
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+                self.assertEqual(1, len(decoded))
+            finally:
+                cli._decode_image = decode_image
+            self.assertTrue(os.path.exists("img_0001.jpg"))
+            # distinct images are not kept in memory
+            caches = []
+            decode_cache = cli.DecodeCache
+
+            def _decode_cache(*args, **kwargs):
+                caches.append(decode_cache(*args, **kwargs))
+                return caches[-1]
+
+            with open("distinct.txt", "w") as f:
+                f.write(img_path + "\n" + "img_0000.jpg\n")
+            cli.DecodeCache = _decode_cache
+            try:
+                result = self.runner.invoke(
+                    cli_imgwrench, ["-i", "distinct.txt", "-o", "out", "save"]
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+                self.assertEqual([], caches)
+                result = self.runner.invoke(
+                    cli_imgwrench, ["-i", "distinct.txt", "-r", "2", "-f", "save"]
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+                self.assertEqual(1, len(caches))
+            finally:
+                cli.DecodeCache = decode_cache
+
+    def test_strip_rows(self):
+        """Test processing images in strips."""
+        img_path = str(self.images_path / "town.jpg")
+        pipeline = ["colorfix", "crop", "-a", "4:3", "frame", "blackwhite", "flip"]
+        with self.runner.isolated_filesystem():
+            with open("images.txt", "w") as f:
+                f.write(img_path + "\n")
+            for strip_rows in ["0", "5"]:
+                result = self.runner.invoke(
+                    cli_imgwrench,
+                    ["-i", "images.txt", "-S", strip_rows, "-o", strip_rows, "--png"]
+                    + pipeline,
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+            with Image.open("0/img_0000.png") as whole:
+                with Image.open("5/img_0000.png") as strips:
+                    self.assertEqual("L", strips.mode)
+                    self.assertEqual(whole.tobytes(), strips.tobytes())
+            result = self.runner.invoke(
+                cli_imgwrench, ["-i", "images.txt", "-S", "5"] + pipeline
+            )
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertTrue(os.path.exists("img_0000.jpg"))
+
+    def test_collage_band_rows(self):
+        """Test rendering collages in bands while saving them."""
+        img_path = str(self.images_path / "town.jpg")
+        collage = ["collage", "-w", "120", "-s", "90", "-n", "5"]
+        with self.runner.isolated_filesystem():
+            with open("images.txt", "w") as f:
+                f.write((img_path + "\n") * 3)
+            for band_rows in ["0", "8"]:
+                result = self.runner.invoke(
+                    cli_imgwrench,
+                    ["-i", "images.txt", "-o", band_rows, "--png"]
+                    + collage
+                    + ["-b", band_rows],
+                )
+                self.assertEqual(0, result.exit_code, result.output)
+            with Image.open("0/img_0000.png") as whole:
+                with Image.open("8/img_0000.png") as bands:
+                    self.assertEqual(whole.tobytes(), bands.tobytes())
+            result = self.runner.invoke(
+                cli_imgwrench, ["-i", "images.txt"] + collage + ["-b", "8", "flip"]
+            )
+            self.assertNotEqual(0, result.exit_code)
+            # exhaustive search is not improved by annealing
+            result = self.runner.invoke(
+                cli_imgwrench, ["-i", "images.txt"] + collage + ["-e", "-t", "1"]
+            )
+            self.assertNotEqual(0, result.exit_code)
+            self.assertIn("--exhaustive", result.output)
+
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(cli))
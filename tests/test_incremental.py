@@ -0,0 +1,84 @@
+"""Tests for incremental pipeline execution."""
+
+import os
+import tempfile
+import unittest
+
+import click
+
+from imgwrench.incremental import load_manifest, plan, save_manifest, stale_runs
+from imgwrench.stages import aggregate, chunks, per_image, rolls
+
+
+def _unplanned(images):
+    yield from images
+
+
+def _processor(decorator):
+    """Image processor created by a subcommand."""
+
+    def _process(images):
+        yield from images
+
+    with click.Context(click.Command("test")):
+        return decorator(_process)
+
+
+class TestIncremental(unittest.TestCase):
+    """Tests for incremental pipeline execution."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sources = []
+        for i in range(5):
+            path = os.path.join(self.tmpdir.name, "{}.jpg".format(i))
+            with open(path, "w") as f:
+                f.write(str(i))
+            self.sources.append((i, path))
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        self.tmpdir.cleanup()
+
+    def test_plan(self):
+        """Test planning of output images."""
+        identity = _processor(lambda p: per_image(lambda image: image))
+        outputs = plan([identity], self.sources, "settings")
+        self.assertEqual([[i] for i in range(5)], [o.positions for o in outputs])
+        self.assertEqual(5, len(set(o.key for o in outputs)))
+        self.assertEqual(
+            outputs[0].key, plan([identity], self.sources, "settings")[0].key
+        )
+        self.assertNotEqual(
+            outputs[0].key, plan([identity], self.sources, "other")[0].key
+        )
+        pairs = _processor(aggregate(chunks(2)))
+        outputs = plan([identity, pairs], self.sources, "settings")
+        self.assertEqual([[0, 1], [2, 3], [4]], [o.positions for o in outputs])
+        self.assertEqual((2, 3), (outputs[1].first, outputs[1].last))
+        self.assertIsNone(plan([identity, _unplanned], self.sources, "settings"))
+
+    def test_stale_runs(self):
+        """Test runs of outputs to be processed."""
+        outputs = plan([_processor(aggregate(chunks(2)))], self.sources, None)
+        runs = stale_runs(outputs, lambda i, output: True)
+        self.assertEqual([(0, 2, 0, 4)], runs)
+        runs = stale_runs(outputs, lambda i, output: i != 1)
+        self.assertEqual([(0, 0, 0, 1), (2, 2, 4, 4)], runs)
+        self.assertEqual([], stale_runs(outputs, lambda i, output: False))
+        # outputs of a roll are processed together
+        outputs = plan([_processor(aggregate(rolls(2)))], self.sources, None)
+        self.assertEqual(
+            [[0, 1], [1, 0], [2, 3], [3, 2], [4]], [o.positions for o in outputs]
+        )
+        runs = stale_runs(outputs, lambda i, output: i == 1)
+        self.assertEqual([(0, 1, 0, 1)], runs)
+        runs = stale_runs(outputs, lambda i, output: i in (1, 2))
+        self.assertEqual([(0, 3, 0, 3)], runs)
+
+    def test_manifest(self):
+        """Test loading and saving of manifests."""
+        self.assertEqual({}, load_manifest(self.tmpdir.name))
+        save_manifest(self.tmpdir.name, {"image_0000.jpg": "key"})
+        self.assertEqual({"image_0000.jpg": "key"}, load_manifest(self.tmpdir.name))
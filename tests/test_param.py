@@ -69,9 +69,16 @@ class TestRatio(unittest.TestCase):
         self.assertEqual(1 / 3, _ratio("1:3"))
         self.assertEqual(1 / 3, _ratio("-1:-3"))
 
+    def test_slash_ratios(self):
+        """Test several good ratio specifications using slashes."""
+        self.assertEqual(0.125, _ratio("1/8"))
+        self.assertEqual(1.5, _ratio("3/2"))
+        self.assertEqual(1 / 3, _ratio("1/3"))
+
     def test_bad_ratios(self):
         """Test several bad ratio specifications which must raise errors."""
         bad_ratios = ["asd", "0", "0.0", "0:1", "-1", "-1.2", "-1:3", "one half", ""]
+        bad_ratios += ["0/1", "1/2:3", "1/"]
         for bad_ratio in bad_ratios:
             with self.assertRaises(BadParameter):
                 _ratio(bad_ratio)
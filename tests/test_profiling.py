@@ -0,0 +1,63 @@
+"""Tests for timing of pipeline stages."""
+
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from PIL import Image
+
+from imgwrench.profiling import Profile, _percentile
+
+
+def _slow(images, seconds):
+    for info, image in images:
+        time.sleep(seconds)
+        yield info, image
+
+
+class TestProfiling(unittest.TestCase):
+    """Tests for timing of pipeline stages."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.images = [(i, Image.new("RGB", (10, 20))) for i in range(4)]
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        values = list(range(1, 21))
+        self.assertEqual(10, _percentile(values, 50))
+        self.assertEqual(19, _percentile(values, 95))
+        self.assertEqual(20, _percentile(values, 100))
+        self.assertEqual(3, _percentile([3], 50))
+
+    def test_iterate(self):
+        """Test exclusive timing of nested stages."""
+        profile = Profile()
+        images = profile.iterate("upstream", _slow(self.images, 0.02))
+        images = profile.iterate("downstream", _slow(images, 0.01))
+        self.assertEqual(self.images, list(images))
+        upstream, downstream = profile.report()["stages"]
+        self.assertEqual("upstream", upstream["name"])
+        self.assertEqual(4, upstream["images"])
+        self.assertEqual(800, upstream["pixels"])
+        self.assertGreaterEqual(upstream["wall_seconds"], 0.08)
+        self.assertGreaterEqual(downstream["wall_seconds"], 0.04)
+        self.assertLess(downstream["wall_seconds"], 0.07)
+        self.assertGreaterEqual(upstream["latency_seconds"]["max"], 0.02)
+
+    def test_timed(self):
+        """Test timing of functions and saving of reports."""
+        profile = Profile()
+        save = profile.timed("save", lambda image, n: n)
+        self.assertEqual(3, save(self.images[0][1], 3))
+        profile.bytes_written = 42
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "report.json")
+            profile.save(path)
+            with open(path) as f:
+                report = json.load(f)
+        self.assertEqual(42, report["bytes_written"])
+        self.assertEqual(["save"], [stage["name"] for stage in report["stages"]])
+        self.assertEqual(200, report["stages"][0]["pixels"])
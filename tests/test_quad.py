@@ -3,6 +3,7 @@
 import unittest
 
 from click.testing import CliRunner
+import numpy as np
 from PIL import Image
 
 from imgwrench.commands.quad import quad
@@ -66,6 +67,17 @@ class TestQuad(unittest.TestCase):
                     self.assertEqual(255, g, f"i={i}, j={j}")
                     self.assertEqual(255, b, f"i={i}, j={j}")
 
+    def test_quad_threads(self):
+        """Test resampling images of quad concurrently."""
+        rng = np.random.default_rng(0)
+        images = [
+            Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+            for w, h in [(90, 60), (40, 70), (50, 50), (120, 40)]
+        ]
+        expected = quad(images, 100, 50, 0.02, False, "red")
+        actual = quad(images, 100, 50, 0.02, False, "red", threads=3)
+        self.assertEqual(expected.tobytes(), actual.tobytes())
+
     def test_quad_output(self):
         """Test output of quad command."""
         execute_and_test_output_images(self, CliRunner(), 3, 1, "quad_", ["quad"])
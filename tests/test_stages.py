@@ -0,0 +1,110 @@
+"""Tests for connecting image processors to a pipeline."""
+
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from imgwrench.stages import (
+    bounded_map,
+    connect,
+    input_scale,
+    per_image,
+    planned_size,
+    read_ahead,
+    resolution,
+    worker_pool,
+)
+
+
+def _double(images):
+    for info, image in images:
+        yield info, image
+        yield info, image
+
+
+class TestStages(unittest.TestCase):
+    """Tests for pipeline stages."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.add_one = per_image(lambda image: image + 1)
+        self.times_ten = per_image(lambda image: image * 10)
+        self.images = [(i, i) for i in range(20)]
+
+    def test_per_image(self):
+        """Test image processors created from single image functions."""
+        self.assertEqual([(1, 2), (2, 3)], list(self.add_one([(1, 1), (2, 2)])))
+        self.assertTrue(hasattr(self.add_one, "per_image"))
+        self.assertFalse(hasattr(_double, "per_image"))
+
+    def test_input_scale(self):
+        """Test propagation of resolution requirements through processors."""
+        keep = resolution()(per_image(lambda image: image))
+        half = resolution(
+            output_size=lambda size: (size[0] // 2, size[1] // 2),
+            input_scale=lambda size, scale: scale / 2,
+        )(per_image(lambda image: image))
+        fixed = resolution(
+            output_size=lambda size: (100, 100),
+            input_scale=lambda size, scale: 100 / max(size) * scale,
+        )(per_image(lambda image: image))
+        unknown = resolution(output_size=lambda size: None)(_double)
+        self.assertEqual(1.0, input_scale([], (1000, 800)))
+        self.assertEqual(1.0, input_scale([keep, keep], (1000, 800)))
+        self.assertEqual(0.1, input_scale([keep, fixed, keep], (1000, 800)))
+        self.assertEqual(0.1, input_scale([half, fixed], (1000, 800)))
+        self.assertEqual(0.05, input_scale([fixed, half], (1000, 800)))
+        self.assertEqual(0.1, input_scale([fixed, _double], (1000, 800)))
+        self.assertEqual(1.0, input_scale([_double, fixed], (1000, 800)))
+        self.assertEqual(1.0, input_scale([keep, unknown, fixed], (1000, 800)))
+        self.assertEqual(1.0, input_scale([fixed], (10, 8)))
+        self.assertEqual((100, 100), planned_size([half, fixed], (1000, 800)))
+        self.assertEqual((500, 400), planned_size([half, unknown], (1000, 800)))
+        self.assertEqual((1000, 800), planned_size([_double], (1000, 800)))
+
+    def test_bounded_map(self):
+        """Test order and bounded consumption of bounded_map."""
+        consumed = []
+
+        def _items():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        with ThreadPoolExecutor(4) as executor:
+            results = bounded_map(executor, lambda x: x * x, _items(), 3)
+            self.assertEqual(0, next(results))
+            self.assertEqual(3, len(consumed))
+            self.assertEqual([i * i for i in range(1, 10)], list(results))
+
+    def test_read_ahead(self):
+        """Test order and depth of read_ahead."""
+        consumed = []
+
+        def _items():
+            for i in range(10):
+                consumed.append(i)
+                yield i
+
+        for depth in [0, 1, 4]:
+            consumed.clear()
+            results = read_ahead(lambda x: -x, _items(), depth)
+            self.assertEqual(0, next(results))
+            self.assertEqual(max(depth, 1), len(consumed))
+            self.assertEqual([-i for i in range(1, 10)], list(results))
+
+    def test_connect_jobs(self):
+        """Test identical results of serial and parallel pipelines."""
+        processors = [self.add_one, _double, self.times_ten, self.add_one]
+        serial = list(connect(iter(self.images), processors))
+        parallel = list(connect(iter(self.images), processors, jobs=3))
+        self.assertEqual(40, len(serial))
+        self.assertEqual(serial, parallel)
+        # several pipelines sharing a pool of worker processes
+        executor = worker_pool(processors, 3)
+        try:
+            for _ in range(2):
+                shared = connect(iter(self.images), processors, 3, executor=executor)
+                self.assertEqual(serial, list(shared))
+        finally:
+            executor.shutdown()
+        self.assertIsNone(worker_pool(processors, 1))
@@ -0,0 +1,99 @@
+"""Tests for processing images in strips."""
+
+import os
+import tempfile
+import unittest
+from itertools import product
+
+import click
+import numpy as np
+from PIL import Image
+
+from imgwrench.commands.blackwhite import cli_blackwhite
+from imgwrench.commands.colorfix import cli_colorfix
+from imgwrench.commands.crop import cli_crop
+from imgwrench.commands.dither import cli_dither
+from imgwrench.commands.flip import cli_flip
+from imgwrench.commands.frame import cli_frame
+from imgwrench.commands.framecrop import cli_framecrop
+from imgwrench.commands.resize import cli_resize
+from imgwrench.geometry import defer_transpose
+from imgwrench.strips import fuse_strips, is_local, save_png
+
+ROTATIONS = [None, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270]
+
+
+def _processor(command, args):
+    with click.Context(command):
+        return command.main(args, standalone_mode=False)
+
+
+def _unfused(image_processors, image):
+    for image_processor in image_processors:
+        image = image_processor.per_image(image)
+    return image
+
+
+class TestStrips(unittest.TestCase):
+    """Tests for processing images in strips."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        rng = np.random.default_rng(0)
+        noise = rng.integers(30, 220, (61, 83, 3), dtype=np.uint8)
+        self.image = Image.fromarray(noise)
+        self.chains = [
+            [
+                _processor(cli_colorfix, []),
+                _processor(cli_crop, ["-a", "1:1"]),
+                _processor(cli_frame, ["-c", "red"]),
+                _processor(cli_flip, []),
+                _processor(cli_frame, ["-w", "0.1"]),
+            ],
+            [
+                _processor(cli_crop, ["-a", "4:3"]),
+                _processor(cli_colorfix, ["-m", "quantiles"]),
+                _processor(cli_blackwhite, []),
+                _processor(cli_framecrop, ["-a", "3:2"]),
+                _processor(cli_crop, ["-a", "1:1"]),
+            ],
+        ]
+
+    def test_is_local(self):
+        """Test which image processors can be applied in strips."""
+        self.assertTrue(all(is_local(p) for chain in self.chains for p in chain))
+        self.assertFalse(is_local(_processor(cli_resize, [])))
+        # dithering diffuses errors across the whole image
+        self.assertFalse(is_local(_processor(cli_dither, [])))
+
+    def test_strips(self):
+        """Test that strips give results identical to whole images."""
+        for chain, rotation, rows in product(self.chains, ROTATIONS, [1, 8, 100]):
+            expected = self.image
+            image = self.image.copy()
+            if rotation is not None:
+                expected = expected.transpose(rotation)
+                defer_transpose(image, rotation)
+            expected = _unfused(chain, expected)
+            strip_image = fuse_strips(chain, rows).per_image(image)
+            self.assertEqual(expected.size, strip_image.size)
+            self.assertTrue(
+                all(strip.size[1] <= rows for _, strip in strip_image.strips())
+            )
+            actual = strip_image.render()
+            self.assertEqual(expected.mode, actual.mode)
+            self.assertEqual(expected.tobytes(), actual.tobytes())
+
+    def test_save_png(self):
+        """Test writing PNG images strip by strip."""
+        exif = Image.Exif()
+        exif[0x010F] = "imgwrench"
+        for chain in self.chains:
+            strip_image = fuse_strips(chain, 8).per_image(self.image)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, "strips.png")
+                save_png(strip_image, path, exif.tobytes())
+                with Image.open(path) as image:
+                    self.assertEqual(strip_image.mode, image.mode)
+                    self.assertEqual(strip_image.render().tobytes(), image.tobytes())
+                    self.assertEqual("imgwrench", image.getexif()[0x010F])